@@ -1,21 +1,2557 @@
 #!/usr/bin/env python3
-from flask import Flask, request, jsonify
+from flask import Flask, Response, has_request_context, request, jsonify, send_file, stream_with_context
 import base64
+import hashlib
+import json
 import logging
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, wraps
 from weasyprint import HTML, CSS
-from jinja2 import Template
+from weasyprint.text.fonts import FontConfiguration
+from jinja2.sandbox import SandboxedEnvironment, SecurityError
+from prometheus_client import Counter, Gauge, Histogram
+from reportlab import rl_config
 import io
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Template registry: sources live on disk so every gunicorn worker can see
+# them, compiled templates and parsed stylesheets are cached per worker.
+TEMPLATE_DIR = os.environ.get('TEMPLATE_DIR', os.path.join(tempfile.gettempdir(), 'zugferd-templates'))
+TEMPLATE_CACHE_SIZE = int(os.environ.get('TEMPLATE_CACHE_SIZE', 64))
+CSS_CACHE_SIZE = int(os.environ.get('CSS_CACHE_SIZE', 32))
+WATERMARK_CACHE_SIZE = int(os.environ.get('WATERMARK_CACHE_SIZE', 64))
+
+# Uploads larger than this are spooled to a temp file instead of RAM
+SPOOL_MAX_SIZE = int(os.environ.get('SPOOL_MAX_SIZE', 8 * 1024 * 1024))
+
+PDF_BODY_TYPES = ('application/pdf', 'application/octet-stream')
+
+# Async jobs: request bodies, status and results are stored on disk so any
+# gunicorn worker can answer /jobs/<id>, the work runs in a bounded thread
+# pool inside the worker that accepted the job.
+JOB_DIR = os.environ.get('JOB_DIR', os.path.join(tempfile.gettempdir(), 'zugferd-jobs'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_LIMIT = int(os.environ.get('JOB_QUEUE_LIMIT', 50))
+JOB_TTL = int(os.environ.get('JOB_TTL', 3600))
+
+# Hosts job callbacks may be sent to, comma-separated (empty: any host).
+# Callbacks to loopback, link-local, private or reserved addresses are
+# always refused.
+CALLBACK_ALLOWED_HOSTS = {host.strip().lower() for host in os.environ.get('CALLBACK_ALLOWED_HOSTS', '').split(',') if host.strip()}
+
+# Results of idempotent endpoints (/generate-pdf, /pdf/compress, ...) are
+# cached on disk by a hash of the request, shared by all gunicorn workers.
+# RESULT_CACHE_MAX_BYTES=0 disables the cache.
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'zugferd-results'))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+
+def available_cpus():
+    """Number of CPU cores this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# Process pool for CPU-bound batch work (one pool per gunicorn worker)
+BATCH_PROCESSES = int(os.environ.get('BATCH_PROCESSES', available_cpus()))
+
+# Merges decode and parse upcoming inputs in a thread pool while the
+# current one is copied; MERGE_PREFETCH bounds how many are read ahead
+MERGE_THREADS = int(os.environ.get('MERGE_THREADS', 4))
+MERGE_PREFETCH = int(os.environ.get('MERGE_PREFETCH', 2))
+
+# /image-to-pdf decodes, resizes and encodes pages in a thread pool (Pillow
+# releases the GIL for that work) while the canvas takes them in order
+IMAGE_THREADS = int(os.environ.get('IMAGE_THREADS', 4))
+
+# reportlab stores image streams binary instead of ASCII85, which makes
+# JPEGs 25% larger and costs an encode pass. Process-wide setting, made
+# once here rather than per request.
+rl_config.useA85 = 0
+
+# Text extraction of documents longer than one shard is split into shards
+# of EXTRACT_SHARD_PAGES pages that run in parallel on the process pool
+EXTRACT_SHARD_PAGES = int(os.environ.get('EXTRACT_SHARD_PAGES', 20))
+
+# /pdf/metadata returns page details only on request, at most this many per
+# response; the rest is left for follow-up requests (see pages_next)
+METADATA_PAGE_LIMIT = int(os.environ.get('METADATA_PAGE_LIMIT', 500))
+
+# Optional ZUGFeRD XML validation against the CII XSD and the EN16931
+# Schematron (.sch source or a compiled XSLT 1.0 stylesheet producing SVRL)
+ZUGFERD_XSD_PATH = os.environ.get('ZUGFERD_XSD_PATH', '')
+ZUGFERD_SCHEMATRON_PATH = os.environ.get('ZUGFERD_SCHEMATRON_PATH', '')
+ZUGFERD_VALIDATE = os.environ.get('ZUGFERD_VALIDATE', 'false').lower() in ('1', 'true', 'yes')
+
+# Import heavy dependencies and prime font caches at startup. With gunicorn
+# --preload this runs once in the master and every forked worker starts warm.
+WARMUP = os.environ.get('WARMUP', 'true').lower() in ('1', 'true', 'yes')
+
+# Registered templates come from clients: the sandbox blocks access to
+# attributes like __class__ or __globals__ that lead to code execution
+jinja_env = SandboxedEnvironment(autoescape=True)
+
+
+class LRUCache:
+    """Small thread-safe LRU mapping with hit/miss counters"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+class ResultCache:
+    """
+    Size-bounded LRU cache of complete responses in a directory shared by all workers
+
+    Each entry is one file named after its key: a JSON line with status
+    and headers, followed by the body. The body is written to a temp file
+    while the response streams to the client and only renamed into place
+    once it is complete, so no worker ever reads a partial entry. A hit
+    touches the file's mtime; evict() deletes the least recently used
+    files once the directory holds more than max_bytes. Hit/miss counters
+    are per worker.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Cached response for key, or None"""
+        entry = None
+        try:
+            entry = open(self.path(key), 'rb')
+            meta = json.loads(entry.readline())
+            status, headers = meta['status'], meta['headers']
+            os.utime(self.path(key))
+        except (OSError, ValueError, KeyError, TypeError):
+            # Missing or corrupt entry: a miss, the next store replaces it
+            if entry is not None:
+                entry.close()
+            with self._lock:
+                self.misses += 1
+            return None
+
+        body_size = os.fstat(entry.fileno()).st_size - entry.tell()
+
+        def generate():
+            try:
+                while True:
+                    chunk = entry.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                entry.close()
+
+        with self._lock:
+            self.hits += 1
+        response = Response(generate(), status=status, headers=headers)
+        response.headers['Content-Length'] = str(body_size)
+        return response
+
+    def store(self, key, response):
+        """
+        Wrap response so its body is written to the cache as it is sent
+
+        A streamed body that fails after the 200 has gone out reports it
+        with mark_result_failed(); such a response is not stored.
+        """
+        environ = request.environ
+        headers = [
+            (name, value) for name, value in response.headers.items()
+            if name in ('Content-Type', 'Content-Disposition') or name.startswith('X-')
+        ]
+        meta = json.dumps({'status': response.status_code, 'headers': headers}).encode('utf-8') + b'\n'
+
+        def generate():
+            complete = False
+            tmp_path = None
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as entry:
+                    entry.write(meta)
+                    for chunk in response.iter_encoded():
+                        entry.write(chunk)
+                        yield chunk
+                complete = True
+            finally:
+                response.close()
+                if complete and not environ.get('zugferd.result_failed'):
+                    os.replace(tmp_path, self.path(key))
+                    with self._lock:
+                        self.stores += 1
+                    self.evict()
+                elif tmp_path:
+                    # Client went away or the body failed; never cache a partial or failed result
+                    try:
+                        os.remove(tmp_path)
+                    except OSError:
+                        pass
+
+        return Response(generate(), status=response.status_code, headers=response.headers)
+
+    def entries(self):
+        """(mtime, size, path) of every complete entry; removes stale temp files"""
+        now = time.time()
+        entries = []
+        try:
+            listing = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return entries
+        for item in listing:
+            try:
+                stat = item.stat()
+                if item.name.endswith('.tmp'):
+                    # Left behind by a worker that was killed mid-response
+                    if now - stat.st_mtime > 3600:
+                        os.remove(item.path)
+                    continue
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, item.path))
+        return entries
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits max_bytes"""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                with self._lock:
+                    self.evictions += 1
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self):
+        entries = self.entries()
+        with self._lock:
+            return {
+                'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'evictions': self.evictions
+            }
+
+
+def mark_result_failed():
+    """Keep the current response out of the result cache (for errors inside a streamed 200)"""
+    request.environ['zugferd.result_failed'] = True
+
+
+template_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+css_cache = LRUCache(CSS_CACHE_SIZE)
+watermark_cache = LRUCache(WATERMARK_CACHE_SIZE)
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+
+# One font configuration per worker, shared by every render so fontconfig
+# setup and @font-face loading are not repeated per request
+font_config = FontConfiguration()
+
+# Async jobs render in background threads; WeasyPrint and the shared font
+# configuration are not thread-safe, so renders are serialized per worker
+render_lock = threading.Lock()
+
+# Prometheus metrics. Under gunicorn, gunicorn.conf.py points
+# PROMETHEUS_MULTIPROC_DIR at a shared directory so /metrics aggregates
+# every worker (and pool process); without it they are per process.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2.5, 5, 10, 30, 60, 120)
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = tuple(1024 * 4 ** n for n in range(10))
+PAGE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# source is "http" for requests and "job" for async jobs replayed in a
+# background thread, so the quick 202 and the real work stay apart
+REQUEST_LABELS = ('endpoint', 'source')
+
+requests_total = Counter(
+    'zugferd_http_requests_total', 'Requests by endpoint and status', REQUEST_LABELS + ('status',))
+request_seconds = Histogram(
+    'zugferd_http_request_duration_seconds', 'Time until the response has been sent',
+    REQUEST_LABELS, buckets=LATENCY_BUCKETS)
+request_bytes = Histogram(
+    'zugferd_http_request_size_bytes', 'Request body size', REQUEST_LABELS, buckets=SIZE_BUCKETS)
+response_bytes = Histogram(
+    'zugferd_http_response_size_bytes', 'Response body size', REQUEST_LABELS, buckets=SIZE_BUCKETS)
+requests_in_progress = Gauge(
+    'zugferd_http_requests_in_progress', 'Requests being handled', REQUEST_LABELS,
+    multiprocess_mode='livesum')
+document_pages = Histogram(
+    'zugferd_document_pages', 'Pages of rendered, produced or inspected PDFs', ('endpoint',),
+    buckets=PAGE_BUCKETS)
+stage_seconds = Histogram(
+    'zugferd_stage_duration_seconds', 'Time spent in one processing stage',
+    ('endpoint', 'stage'), buckets=STAGE_BUCKETS)
+
+
+def metric_endpoint():
+    """Route pattern of the current request, "background" outside of one (pool processes, threads)"""
+    if has_request_context():
+        return request.url_rule.rule if request.url_rule else 'unmatched'
+    return 'background'
+
+
+@contextmanager
+def stage_timer(stage, endpoint=None):
+    """
+    Time a block as one processing stage of an endpoint (default: the current one)
+
+    Stages: decode (base64 and image input), parse (HTML and PDF input),
+    render (layout and drawing), recompress (image downsampling in
+    /pdf/compress), serialize (writing the PDF) and base64 (encoding the
+    output).
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.labels(endpoint or metric_endpoint(), stage).observe(time.perf_counter() - started)
+
+
+def observe_pages(count):
+    """Record the page count of a document handled by the current endpoint"""
+    if isinstance(count, int):
+        document_pages.labels(metric_endpoint()).observe(count)
+
+
+def get_css(css):
+    """Return a parsed stylesheet for a CSS string, cached by content hash"""
+    key = hashlib.sha256(css.encode('utf-8')).hexdigest()
+    css_obj = css_cache.get(key)
+    if css_obj is None:
+        css_obj = CSS(string=css, font_config=font_config)
+        css_cache.put(key, css_obj)
+    return css_obj
+
+
+def render_pdf(html_content, stylesheets=None, **options):
+    """
+    Render HTML to PDF using the shared font configuration
+
+    Returns (pdf_bytes, page_count). Same steps as HTML.write_pdf, split so
+    parsing, layout and writing are timed as separate stages.
+    """
+    finisher = options.pop('finisher', None)
+    with stage_timer('parse'):
+        html_obj = HTML(string=html_content)
+    with render_lock:
+        with stage_timer('render'):
+            document = html_obj.render(font_config=font_config, stylesheets=stylesheets or None, **options)
+        with stage_timer('serialize'):
+            pdf_bytes = document.write_pdf(finisher=finisher, **options)
+    observe_pages(len(document.pages))
+    return pdf_bytes, len(document.pages)
+
+
+ZUGFERD_FILENAME = 'factur-x.xml'
+
+# Document info written into every generated ZUGFeRD PDF
+ZUGFERD_INFO = {
+    'Title': 'ZUGFeRD Rechnung',
+    'Author': 'futalis GmbH',
+    'Subject': 'ZUGFeRD Invoice',
+    'Producer': 'futalis ZUGFeRD Generator'
+}
+
+# Info keys mirrored in the XMP metadata. PDF/A requires both to match, so
+# any other key of an input PDF is dropped.
+INFO_KEYS = ('Title', 'Author', 'Subject', 'Keywords', 'Creator', 'Producer', 'CreationDate', 'ModDate')
+
+# Factur-X conformance level by marker in the guideline ID
+# (GuidelineSpecifiedDocumentContextParameter/ID), first match wins
+ZUGFERD_PROFILES = (
+    ('xrechnung', 'XRECHNUNG'),
+    ('extended', 'EXTENDED'),
+    ('basicwl', 'BASIC WL'),
+    ('minimum', 'MINIMUM'),
+    ('basic', 'BASIC'),
+    ('en16931', 'EN 16931'),
+)
+DEFAULT_CONFORMANCE_LEVEL = 'EN 16931'
+
+# These profiles are no complete invoice, their XML is attached as /Data
+# instead of /Alternative
+DATA_ONLY_LEVELS = ('MINIMUM', 'BASIC WL')
+
+XMP_TEMPLATE = '''<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+<rdf:Description rdf:about="" xmlns:pdfaid="http://www.aiim.org/pdfa/ns/id/">
+<pdfaid:part>3</pdfaid:part>
+<pdfaid:conformance>B</pdfaid:conformance>
+</rdf:Description>
+<rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:format>application/pdf</dc:format>
+<dc:title><rdf:Alt><rdf:li xml:lang="x-default">{{ info.Title }}</rdf:li></rdf:Alt></dc:title>
+<dc:creator><rdf:Seq><rdf:li>{{ info.Author }}</rdf:li></rdf:Seq></dc:creator>
+<dc:description><rdf:Alt><rdf:li xml:lang="x-default">{{ info.Subject }}</rdf:li></rdf:Alt></dc:description>
+</rdf:Description>
+<rdf:Description rdf:about="" xmlns:pdf="http://ns.adobe.com/pdf/1.3/">
+<pdf:Producer>{{ info.Producer }}</pdf:Producer>
+{%- if info.Keywords %}
+<pdf:Keywords>{{ info.Keywords }}</pdf:Keywords>
+{%- endif %}
+</rdf:Description>
+<rdf:Description rdf:about="" xmlns:xmp="http://ns.adobe.com/xap/1.0/">
+{%- if info.Creator %}
+<xmp:CreatorTool>{{ info.Creator }}</xmp:CreatorTool>
+{%- endif %}
+<xmp:CreateDate>{{ create_date }}</xmp:CreateDate>
+<xmp:ModifyDate>{{ modify_date }}</xmp:ModifyDate>
+</rdf:Description>
+<rdf:Description rdf:about="" xmlns:fx="urn:factur-x:pdfa:CrossIndustryDocument:invoice:1p0#">
+<fx:DocumentType>INVOICE</fx:DocumentType>
+<fx:DocumentFileName>{{ filename }}</fx:DocumentFileName>
+<fx:Version>1.0</fx:Version>
+<fx:ConformanceLevel>{{ level }}</fx:ConformanceLevel>
+</rdf:Description>
+<rdf:Description rdf:about=""
+    xmlns:pdfaExtension="http://www.aiim.org/pdfa/ns/extension/"
+    xmlns:pdfaSchema="http://www.aiim.org/pdfa/ns/schema#"
+    xmlns:pdfaProperty="http://www.aiim.org/pdfa/ns/property#">
+<pdfaExtension:schemas><rdf:Bag><rdf:li rdf:parseType="Resource">
+<pdfaSchema:schema>Factur-X PDFA Extension Schema</pdfaSchema:schema>
+<pdfaSchema:namespaceURI>urn:factur-x:pdfa:CrossIndustryDocument:invoice:1p0#</pdfaSchema:namespaceURI>
+<pdfaSchema:prefix>fx</pdfaSchema:prefix>
+<pdfaSchema:property><rdf:Seq>
+{%- for name, description in fx_properties %}
+<rdf:li rdf:parseType="Resource">
+<pdfaProperty:name>{{ name }}</pdfaProperty:name>
+<pdfaProperty:valueType>Text</pdfaProperty:valueType>
+<pdfaProperty:category>external</pdfaProperty:category>
+<pdfaProperty:description>{{ description }}</pdfaProperty:description>
+</rdf:li>
+{%- endfor %}
+</rdf:Seq></pdfaSchema:property>
+</rdf:li></rdf:Bag></pdfaExtension:schemas>
+</rdf:Description>
+</rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>'''
+
+FX_PROPERTIES = (
+    ('DocumentFileName', 'The name of the embedded XML document'),
+    ('DocumentType', 'The type of the hybrid document in capital letters, e.g. INVOICE or ORDER'),
+    ('Version', 'The actual version of the standard applying to the embedded XML document'),
+    ('ConformanceLevel', 'The conformance level of the embedded XML document'),
+)
+
+# Compiled once per worker, rendering is the only per-invoice XMP cost
+xmp_template = jinja_env.from_string(XMP_TEMPLATE)
+
+
+def pdf_date():
+    """Current UTC time as a PDF date string"""
+    return time.strftime("D:%Y%m%d%H%M%S+00'00'", time.gmtime())
+
+
+def xmp_date(date):
+    """Convert a PDF date string (D:YYYYMMDDHHmmSS+HH'mm') to XMP format, None if invalid"""
+    match = re.match(r"D:(\d{4})(\d\d)(\d\d)(\d\d)(\d\d)(\d\d)(?:([Z+-])(\d\d)?'?(\d\d)?'?)?$", date or '')
+    if not match:
+        return None
+    year, month, day, hour, minute, second, sign, tz_hour, tz_minute = match.groups()
+    value = f'{year}-{month}-{day}T{hour}:{minute}:{second}'
+    if sign == 'Z':
+        return value + 'Z'
+    if sign:
+        return f'{value}{sign}{tz_hour or "00"}:{tz_minute or "00"}'
+    return value
+
+
+def conformance_level(xml_bytes):
+    """
+    Factur-X conformance level of a CII invoice, read from its guideline ID
+
+    Only the head of the document is parsed, iterparse stops at the
+    GuidelineSpecifiedDocumentContextParameter/ID element. Raises
+    ValueError for malformed XML.
+    """
+    from lxml import etree
+
+    elements = etree.iterparse(io.BytesIO(xml_bytes), tag='{*}ID', resolve_entities=False, no_network=True)
+    try:
+        for _, element in elements:
+            parent = element.getparent()
+            if parent is not None and etree.QName(parent).localname == 'GuidelineSpecifiedDocumentContextParameter':
+                return guideline_level(element.text)
+    except etree.XMLSyntaxError as e:
+        raise ValueError(f'xml_content ist kein gültiges XML: {str(e)}')
+
+    return guideline_level(None)
+
+
+def guideline_level(guideline):
+    """Map a GuidelineSpecifiedDocumentContextParameter/ID to its conformance level"""
+    if not guideline:
+        logger.warning(f'No ZUGFeRD guideline ID found, using {DEFAULT_CONFORMANCE_LEVEL}')
+        return DEFAULT_CONFORMANCE_LEVEL
+    guideline = guideline.strip().lower()
+    for marker, level in ZUGFERD_PROFILES:
+        if marker in guideline:
+            return level
+    logger.warning(f'Unknown ZUGFeRD guideline {guideline!r}, using {DEFAULT_CONFORMANCE_LEVEL}')
+    return DEFAULT_CONFORMANCE_LEVEL
+
+
+def parse_xml(xml_bytes):
+    """Parse untrusted XML without entity expansion or network access"""
+    from lxml import etree
+    return etree.fromstring(xml_bytes, etree.XMLParser(resolve_entities=False, no_network=True))
+
+
+def af_relationship(level):
+    """AFRelationship name of the factur-x.xml attachment for a conformance level"""
+    return '/Data' if level in DATA_ONLY_LEVELS else '/Alternative'
+
+
+def document_info(existing=None):
+    """
+    Info dictionary values ({key: str}) of a ZUGFeRD PDF
+
+    Keeps the non-empty INFO_KEYS of an existing info dictionary, sets
+    ZUGFERD_INFO and stamps the modification date.
+    """
+    now = pdf_date()
+    info = {key: str(value) for key, value in (existing or {}).items() if key in INFO_KEYS and str(value)}
+    info.update(ZUGFERD_INFO)
+    if xmp_date(info.get('CreationDate')) is None:
+        info['CreationDate'] = now
+    info['ModDate'] = now
+    return info
+
+
+def xmp_metadata(info, level):
+    """XMP packet with PDF/A-3B identification, document info and Factur-X schema"""
+    return xmp_template.render(
+        info=info,
+        level=level,
+        filename=ZUGFERD_FILENAME,
+        fx_properties=FX_PROPERTIES,
+        create_date=xmp_date(info['CreationDate']),
+        modify_date=xmp_date(info['ModDate'])
+    ).encode('utf-8')
+
+
+@lru_cache(maxsize=None)
+def srgb_icc_profile():
+    """Flate-compressed sRGB ICC profile (shipped with WeasyPrint) for the PDF/A OutputIntent"""
+    from importlib.resources import files
+    return zlib.compress(files('weasyprint.pdf').joinpath('sRGB2014.icc').read_bytes())
+
+
+def zugferd_finisher(xml_bytes, level):
+    """
+    WeasyPrint finisher that turns the rendered document into a ZUGFeRD PDF/A-3
+
+    The attachment, its catalog entries, OutputIntent, XMP metadata and the
+    document info are added to the pydyf document before serialization, so
+    the rendered PDF never has to be parsed again.
+    """
+    import pydyf
+
+    def finisher(document, pdf):
+        embedded_file = pydyf.Stream([xml_bytes], pydyf.Dictionary({
+            'Type': '/EmbeddedFile',
+            'Subtype': '/text#2Fxml',
+            'Params': pydyf.Dictionary({
+                'Size': len(xml_bytes),
+                'ModDate': pydyf.String(pdf_date()),
+                'CheckSum': pydyf.String(hashlib.md5(xml_bytes).digest())
+            })
+        }), compress=True)
+        pdf.add_object(embedded_file)
+
+        file_spec = pydyf.Dictionary({
+            'Type': '/Filespec',
+            'F': pydyf.String(ZUGFERD_FILENAME),
+            'UF': pydyf.String(ZUGFERD_FILENAME),
+            'Desc': pydyf.String('ZUGFeRD Invoice'),
+            'AFRelationship': af_relationship(level),
+            'EF': pydyf.Dictionary({'F': embedded_file.reference, 'UF': embedded_file.reference})
+        })
+        pdf.add_object(file_spec)
+
+        # Keep attachments WeasyPrint may already have written (<link rel=attachment>)
+        names = pdf.catalog.setdefault('Names', pydyf.Dictionary())
+        if 'EmbeddedFiles' in names:
+            embedded_files = pdf.objects[int(names['EmbeddedFiles'].split()[0])]
+        else:
+            embedded_files = pydyf.Dictionary({'Names': pydyf.Array()})
+            pdf.add_object(embedded_files)
+            names['EmbeddedFiles'] = embedded_files.reference
+        entries = list(zip(embedded_files['Names'][::2], embedded_files['Names'][1::2]))
+        entries.append((pydyf.String(ZUGFERD_FILENAME), file_spec.reference))
+        entries.sort(key=lambda entry: entry[0].string)
+        embedded_files['Names'] = pydyf.Array([value for entry in entries for value in entry])
+
+        # PDF/A-3: every attachment needs an AFRelationship, annotations must print
+        associated = pdf.catalog.setdefault('AF', pydyf.Array())
+        for pdf_object in pdf.objects:
+            if not isinstance(pdf_object, dict):
+                continue
+            if pdf_object.get('Type') == '/Filespec' and 'AFRelationship' not in pdf_object:
+                pdf_object['AFRelationship'] = '/Unspecified'
+                associated.append(pdf_object.reference)
+            elif pdf_object.get('Type') == '/Annot':
+                pdf_object['F'] = 4
+        associated.append(file_spec.reference)
+
+        if 'OutputIntents' not in pdf.catalog:
+            profile = pydyf.Stream([srgb_icc_profile()], pydyf.Dictionary({
+                'N': 3,
+                'Alternate': '/DeviceRGB',
+                'Filter': '/FlateDecode'
+            }))
+            pdf.add_object(profile)
+            pdf.catalog['OutputIntents'] = pydyf.Array([pydyf.Dictionary({
+                'Type': '/OutputIntent',
+                'S': '/GTS_PDFA1',
+                'OutputConditionIdentifier': pydyf.String('sRGB IEC61966-2.1'),
+                'DestOutputProfile': profile.reference
+            })])
+
+        info = document_info({
+            key: value.string for key, value in pdf.info.items() if isinstance(value, pydyf.String)
+        })
+        pdf.info.clear()
+        for key, value in info.items():
+            pdf.info[key] = pydyf.String(value)
+
+        metadata = pydyf.Stream([xmp_metadata(info, level)], pydyf.Dictionary({
+            'Type': '/Metadata',
+            'Subtype': '/XML'
+        }))
+        pdf.add_object(metadata)
+        pdf.catalog['Metadata'] = metadata.reference
+
+    return finisher
+
+
+def iter_name_tree(node):
+    """Yield (name, value) pairs of a PDF name tree, values stay unresolved"""
+    node = node.get_object()
+    names = node.get('/Names')
+    if names is not None:
+        for i in range(0, len(names) - 1, 2):
+            yield str(names[i].get_object()), names[i + 1]
+    for kid in node.get('/Kids', []):
+        yield from iter_name_tree(kid)
+
+
+def incremental_update(pdf_stream, reader, objects, trailer_updates=None):
+    """
+    Append objects to a PDF as an incremental update and return the new bytes
+
+    The original bytes are copied unchanged and only the given objects plus
+    a new cross-reference section are written after them. objects maps
+    object numbers to (generation, PdfObject); numbers already in use
+    replace the old object. The new cross-reference section uses the same
+    form (table or stream) as the original one, as PDF readers expect.
+    """
+    import struct
+    from pypdf.generic import ArrayObject, DictionaryObject, NameObject, NumberObject, StreamObject
+
+    output = io.BytesIO()
+    pdf_stream.seek(0)
+    shutil.copyfileobj(pdf_stream, output)
+
+    # Offset of the last cross-reference section, read from the file tail
+    output.seek(max(0, output.tell() - 1024))
+    tail = output.read()
+    prev = int(tail[tail.rindex(b'startxref') + len(b'startxref'):].split()[0])
+    output.seek(prev)
+    uses_xref_stream = not output.read(4).startswith(b'xref')
+    output.seek(0, os.SEEK_END)
+    if not tail.endswith(b'\n'):
+        output.write(b'\n')
+
+    offsets = {}
+    for number in sorted(objects):
+        generation, obj = objects[number]
+        offsets[number] = (output.tell(), generation)
+        output.write(f'{number} {generation} obj\n'.encode())
+        obj.write_to_stream(output)
+        output.write(b'\nendobj\n')
+
+    trailer = DictionaryObject()
+    for key in ('/Root', '/Info', '/ID'):
+        if key in reader.trailer:
+            trailer[NameObject(key)] = reader.trailer.raw_get(key)
+    trailer.update(trailer_updates or {})
+    size = max(int(reader.trailer['/Size']), max(offsets) + 1)
+    trailer[NameObject('/Prev')] = NumberObject(prev)
+
+    xref_offset = output.tell()
+    if uses_xref_stream:
+        offsets[size] = (xref_offset, 0)
+        size += 1
+        xref = StreamObject()
+        xref.update(trailer)
+        xref[NameObject('/Type')] = NameObject('/XRef')
+        xref[NameObject('/Size')] = NumberObject(size)
+        xref[NameObject('/W')] = ArrayObject([NumberObject(1), NumberObject(4), NumberObject(2)])
+        xref[NameObject('/Index')] = ArrayObject(
+            NumberObject(value) for number in sorted(offsets) for value in (number, 1))
+        xref.set_data(b''.join(
+            struct.pack('>BIH', 1, *offsets[number]) for number in sorted(offsets)))
+        output.write(f'{size - 1} 0 obj\n'.encode())
+        xref.write_to_stream(output)
+        output.write(b'\nendobj\n')
+    else:
+        trailer[NameObject('/Size')] = NumberObject(size)
+        output.write(b'xref\n0 1\n0000000000 65535 f \n')
+        for number in sorted(offsets):
+            offset, generation = offsets[number]
+            output.write(f'{number} 1\n{offset:010d} {generation:05d} n \n'.encode())
+        output.write(b'trailer\n')
+        trailer.write_to_stream(output)
+        output.write(b'\n')
+
+    output.write(f'startxref\n{xref_offset}\n%%EOF\n'.encode())
+    return output.getvalue()
+
+
+def append_zugferd(pdf_stream, xml_bytes):
+    """
+    Return (pdf_bytes, page_count) of the PDF as ZUGFeRD PDF/A-3 with the
+    XML attached as factur-x.xml
+
+    Written as an incremental update: pages are neither parsed nor copied,
+    only the attachment, the updated catalog (AF, OutputIntent, XMP) and
+    the document info are appended to the original bytes. The page content
+    itself is not checked for PDF/A conformance. Raises ValueError for
+    malformed XML and encrypted PDFs.
+    """
+    from pypdf import PdfReader
+    from pypdf.generic import (
+        ArrayObject, ByteStringObject, DictionaryObject, IndirectObject, NameObject,
+        NumberObject, StreamObject, TextStringObject
+    )
+
+    level = conformance_level(xml_bytes)
+
+    with stage_timer('parse'):
+        reader = PdfReader(pdf_stream)
+    if reader.is_encrypted:
+        raise ValueError('Verschlüsselte PDFs können nicht in ZUGFeRD umgewandelt werden')
+
+    objects = {}
+    next_number = int(reader.trailer['/Size'])
+
+    def add_object(obj):
+        nonlocal next_number
+        objects[next_number] = (0, obj)
+        next_number += 1
+        return IndirectObject(next_number - 1, 0, reader)
+
+    embedded_file = StreamObject()
+    embedded_file[NameObject('/Type')] = NameObject('/EmbeddedFile')
+    embedded_file[NameObject('/Subtype')] = NameObject('/text/xml')
+    embedded_file[NameObject('/Params')] = DictionaryObject({
+        NameObject('/Size'): NumberObject(len(xml_bytes)),
+        NameObject('/ModDate'): TextStringObject(pdf_date()),
+        NameObject('/CheckSum'): ByteStringObject(hashlib.md5(xml_bytes).digest())
+    })
+    embedded_file.set_data(xml_bytes)
+    embedded_file_ref = add_object(embedded_file.flate_encode())
+
+    file_spec_ref = add_object(DictionaryObject({
+        NameObject('/Type'): NameObject('/Filespec'),
+        NameObject('/F'): TextStringObject(ZUGFERD_FILENAME),
+        NameObject('/UF'): TextStringObject(ZUGFERD_FILENAME),
+        NameObject('/Desc'): TextStringObject('ZUGFeRD Invoice'),
+        NameObject('/AFRelationship'): NameObject(af_relationship(level)),
+        NameObject('/EF'): DictionaryObject({
+            NameObject('/F'): embedded_file_ref,
+            NameObject('/UF'): embedded_file_ref
+        })
+    }))
+
+    # Updated catalog: existing attachments are kept, an older factur-x.xml is replaced
+    root_ref = reader.trailer.raw_get('/Root')
+    root = root_ref.get_object()
+    catalog = DictionaryObject({key: root.raw_get(key) for key in root})
+
+    names = DictionaryObject()
+    replaced = []
+    entries = []
+    if '/Names' in root:
+        old_names = root['/Names']
+        names.update({key: old_names.raw_get(key) for key in old_names})
+        if '/EmbeddedFiles' in old_names:
+            for name, value in iter_name_tree(old_names['/EmbeddedFiles']):
+                if name == ZUGFERD_FILENAME:
+                    replaced.append(value)
+                else:
+                    entries.append((name, value))
+    entries.append((ZUGFERD_FILENAME, file_spec_ref))
+    entries.sort(key=lambda entry: entry[0])
+    names[NameObject('/EmbeddedFiles')] = add_object(DictionaryObject({
+        NameObject('/Names'): ArrayObject(
+            value for name, file_ref in entries for value in (TextStringObject(name), file_ref))
+    }))
+    catalog[NameObject('/Names')] = names
+
+    associated = [ref for ref in root.get('/AF', []) if ref not in replaced]
+    catalog[NameObject('/AF')] = ArrayObject(associated + [file_spec_ref])
+
+    if '/OutputIntents' not in root:
+        profile = StreamObject()
+        profile.update({
+            NameObject('/N'): NumberObject(3),
+            NameObject('/Alternate'): NameObject('/DeviceRGB'),
+            NameObject('/Filter'): NameObject('/FlateDecode')
+        })
+        profile.set_data(srgb_icc_profile())
+        catalog[NameObject('/OutputIntents')] = ArrayObject([DictionaryObject({
+            NameObject('/Type'): NameObject('/OutputIntent'),
+            NameObject('/S'): NameObject('/GTS_PDFA1'),
+            NameObject('/OutputConditionIdentifier'): TextStringObject('sRGB IEC61966-2.1'),
+            NameObject('/DestOutputProfile'): add_object(profile)
+        })])
+
+    # Document info: rewrite the existing info object or add a new one
+    trailer_updates = {}
+    info_ref = reader.trailer.raw_get('/Info') if '/Info' in reader.trailer else None
+    old_info = info_ref.get_object() if info_ref is not None else {}
+    info = document_info({key[1:]: value.get_object() for key, value in old_info.items()})
+    info_object = DictionaryObject({
+        NameObject(f'/{key}'): TextStringObject(value) for key, value in info.items()
+    })
+    if isinstance(info_ref, IndirectObject):
+        objects[info_ref.idnum] = (info_ref.generation, info_object)
+    else:
+        trailer_updates[NameObject('/Info')] = add_object(info_object)
+
+    metadata = StreamObject()
+    metadata.update({
+        NameObject('/Type'): NameObject('/Metadata'),
+        NameObject('/Subtype'): NameObject('/XML')
+    })
+    metadata.set_data(xmp_metadata(info, level))
+    catalog[NameObject('/Metadata')] = add_object(metadata)
+    objects[root_ref.idnum] = (root_ref.generation, catalog)
+
+    # PDF/A requires a file identifier
+    if '/ID' not in reader.trailer:
+        identifier = ByteStringObject(hashlib.md5(xml_bytes + str(time.time()).encode()).digest())
+        trailer_updates[NameObject('/ID')] = ArrayObject([identifier, identifier])
+
+    with stage_timer('serialize'):
+        pdf_bytes = incremental_update(pdf_stream, reader, objects, trailer_updates)
+    # Pages are unchanged, the page tree root knows how many there are
+    return pdf_bytes, root['/Pages'].get_object().get('/Count')
+
+
+SVRL_NS = 'http://purl.oclc.org/dsdl/svrl'
+
+# lxml validators keep per-object error state, so validation runs serialized
+validation_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_xml_schema():
+    """CII XML schema compiled once per worker, None if ZUGFERD_XSD_PATH is not set"""
+    if not ZUGFERD_XSD_PATH:
+        return None
+    from lxml import etree
+    logger.info(f'Compiling ZUGFeRD XSD {ZUGFERD_XSD_PATH}')
+    return etree.XMLSchema(etree.parse(ZUGFERD_XSD_PATH))
+
+
+@lru_cache(maxsize=None)
+def get_schematron():
+    """
+    Schematron compiled once per worker into an XSLT transform producing SVRL
+
+    None if ZUGFERD_SCHEMATRON_PATH is not set. .sch files are compiled by
+    lxml's ISO Schematron implementation, anything else is loaded as an
+    already compiled XSLT 1.0 stylesheet (libxslt has no XSLT 2.0).
+    """
+    if not ZUGFERD_SCHEMATRON_PATH:
+        return None
+    from lxml import etree, isoschematron
+    logger.info(f'Compiling ZUGFeRD Schematron {ZUGFERD_SCHEMATRON_PATH}')
+    document = etree.parse(ZUGFERD_SCHEMATRON_PATH)
+    if ZUGFERD_SCHEMATRON_PATH.endswith('.sch'):
+        document = isoschematron.Schematron(document, store_xslt=True).validator_xslt
+    return etree.XSLT(document)
+
+
+def validate_zugferd_xml(xml_bytes):
+    """
+    Check ZUGFeRD XML against the configured XSD and Schematron
+
+    Returns {"valid": bool, "checks": [...], "errors": [...], "warnings": [...]}.
+    Without configured validators only well-formedness is checked.
+    """
+    from lxml import etree
+
+    result = {'valid': True, 'checks': ['well-formed'], 'errors': [], 'warnings': []}
+    try:
+        document = parse_xml(xml_bytes)
+    except etree.XMLSyntaxError as e:
+        result['valid'] = False
+        result['errors'].append({'source': 'well-formed', 'line': e.lineno, 'message': e.msg})
+        return result
+
+    schema = get_xml_schema()
+    schematron = get_schematron()
+
+    with validation_lock:
+        if schema is not None:
+            result['checks'].append('xsd')
+            schema.validate(document)
+            for entry in schema.error_log:
+                result['errors'].append({'source': 'xsd', 'line': entry.line, 'message': entry.message})
+
+        report = None
+        if schematron is not None:
+            result['checks'].append('schematron')
+            report = schematron(document)
+
+    if report is not None:
+        for failure in report.iter(f'{{{SVRL_NS}}}failed-assert', f'{{{SVRL_NS}}}successful-report'):
+            default_flag = 'fatal' if failure.tag.endswith('failed-assert') else 'warning'
+            entry = {
+                'source': 'schematron',
+                'id': failure.get('id'),
+                'location': failure.get('location'),
+                'message': ' '.join(failure.findtext(f'{{{SVRL_NS}}}text', '').split())
+            }
+            if failure.get('flag', default_flag) in ('fatal', 'error'):
+                result['errors'].append(entry)
+            else:
+                result['warnings'].append(entry)
+
+    result['valid'] = not result['errors']
+    return result
+
+
+def validation_summary(validation):
+    """One-line error message for a failed validation"""
+    first = validation['errors'][0]
+    message = f"xml_content ist kein gültiges ZUGFeRD XML ({first['source']}: {first['message']})"
+    if len(validation['errors']) > 1:
+        message += f" und {len(validation['errors']) - 1} weitere Fehler"
+    return message
+
+
+def invalid_xml_response(validation):
+    """422 response for XML that failed validation"""
+    return jsonify({
+        'success': False,
+        'error': validation_summary(validation),
+        'validation': validation
+    }), 422
+
+
+def generate_complete_pdf(html_content, stylesheets, xml_content):
+    """
+    Render HTML as ZUGFeRD PDF/A-3 with the XML embedded, see render_pdf
+
+    Shared by /generate-complete and its batch variant. Raises ValueError
+    for malformed XML before anything is rendered.
+    """
+    xml_bytes = xml_content.encode('utf-8')
+    finisher = zugferd_finisher(xml_bytes, conformance_level(xml_bytes))
+    return render_pdf(html_content, stylesheets, finisher=finisher, pdf_version='1.7', pdf_identifier=True)
+
+
+def render_batch_item(item):
+    """
+    Render one /generate-complete/batch item inside a pool process
+
+    Errors are returned instead of raised so one bad invoice only fails
+    its own item.
+    """
+    filename = item.get('filename') or 'zugferd.pdf'
+    try:
+        html_content = item.get('html_content', '')
+        xml_content = item.get('xml_content', '')
+        stylesheets = []
+
+        if item.get('template_id'):
+            html_content, stylesheets = render_template_request(item)
+
+        if not html_content or not xml_content:
+            raise ValueError('html_content und xml_content sind erforderlich')
+
+        if item.get('validate'):
+            validation = validate_zugferd_xml(xml_content.encode('utf-8'))
+            if not validation['valid']:
+                return {
+                    'filename': filename,
+                    'success': False,
+                    'error': validation_summary(validation),
+                    'validation': validation
+                }
+
+        if item.get('css'):
+            stylesheets = stylesheets + [get_css(item['css'])]
+
+        pdf_bytes, _ = generate_complete_pdf(html_content, stylesheets, xml_content)
+        return {'filename': filename, 'success': True, 'pdf': pdf_bytes}
+
+    except Exception as e:
+        return {'filename': filename, 'success': False, 'error': str(e)}
+
+
+# Attachment names used by Factur-X, ZUGFeRD 2.x and XRechnung-in-PDF
+ZUGFERD_ATTACHMENT_NAMES = ('factur-x.xml', 'zugferd-invoice.xml', 'xrechnung.xml')
+
+CII_NS = {
+    'rsm': 'urn:un:unece:uncefact:data:standard:CrossIndustryInvoice:100',
+    'ram': 'urn:un:unece:uncefact:data:standard:ReusableAggregateBusinessInformationEntity:100',
+    'udt': 'urn:un:unece:uncefact:data:standard:UnqualifiedDataType:100'
+}
+
+
+def find_zugferd_attachment(reader):
+    """
+    Return (filename, xml_bytes) of the ZUGFeRD XML embedded in a PDF
+
+    Only the catalog's EmbeddedFiles name tree is walked, the page tree is
+    never loaded. Raises LookupError if there is no ZUGFeRD attachment.
+    """
+    root = reader.trailer['/Root']
+    names = root.get('/Names')
+    if names is not None and '/EmbeddedFiles' in names.get_object():
+        for name, value in iter_name_tree(names.get_object()['/EmbeddedFiles']):
+            file_spec = value.get_object()
+            filenames = [str(file_spec[key]) for key in ('/UF', '/F') if key in file_spec] + [name]
+            for filename in filenames:
+                if filename.lower() in ZUGFERD_ATTACHMENT_NAMES:
+                    embedded_files = file_spec['/EF']
+                    embedded_file = embedded_files['/UF' if '/UF' in embedded_files else '/F']
+                    return filename, embedded_file.get_data()
+    raise LookupError('Keine ZUGFeRD XML im PDF gefunden')
+
+
+def cii_find(element, path):
+    """element.find() with the CII namespaces that tolerates a missing element"""
+    return element.find(path, CII_NS) if element is not None else None
+
+
+def cii_text(element, path):
+    """Stripped text of the first match of path, or None"""
+    found = cii_find(element, path)
+    if found is None or found.text is None:
+        return None
+    return found.text.strip()
+
+
+def cii_date(element, path):
+    """udt:DateTimeString as YYYY-MM-DD (format 102), other formats as-is"""
+    found = cii_find(element, path)
+    if found is None or not found.text:
+        return None
+    value = found.text.strip()
+    if found.get('format') == '102' and len(value) == 8:
+        return f'{value[:4]}-{value[4:6]}-{value[6:]}'
+    return value
+
+
+def cii_party(party):
+    """Seller or buyer trade party as a dict"""
+    if party is None:
+        return None
+    return {
+        'name': cii_text(party, 'ram:Name'),
+        'id': cii_text(party, 'ram:ID'),
+        'global_id': cii_text(party, 'ram:GlobalID'),
+        'vat_id': cii_text(party, "ram:SpecifiedTaxRegistration/ram:ID[@schemeID='VA']"),
+        'tax_number': cii_text(party, "ram:SpecifiedTaxRegistration/ram:ID[@schemeID='FC']"),
+        'email': cii_text(party, 'ram:URIUniversalCommunication/ram:URIID'),
+        'address': {
+            'line_one': cii_text(party, 'ram:PostalTradeAddress/ram:LineOne'),
+            'line_two': cii_text(party, 'ram:PostalTradeAddress/ram:LineTwo'),
+            'postcode': cii_text(party, 'ram:PostalTradeAddress/ram:PostcodeCode'),
+            'city': cii_text(party, 'ram:PostalTradeAddress/ram:CityName'),
+            'country': cii_text(party, 'ram:PostalTradeAddress/ram:CountryID')
+        }
+    }
+
+
+def cii_tax(tax):
+    """ram:ApplicableTradeTax as a dict"""
+    return {
+        'type_code': cii_text(tax, 'ram:TypeCode'),
+        'category_code': cii_text(tax, 'ram:CategoryCode'),
+        'rate': cii_text(tax, 'ram:RateApplicablePercent'),
+        'basis_amount': cii_text(tax, 'ram:BasisAmount'),
+        'calculated_amount': cii_text(tax, 'ram:CalculatedAmount'),
+        'exemption_reason': cii_text(tax, 'ram:ExemptionReason')
+    }
+
+
+def parse_cii(root):
+    """
+    Normalized view of a CII invoice: header, seller, buyer, payment,
+    totals, tax breakdown and line items
+
+    Amounts and quantities stay strings so no decimal places are lost.
+    Fields missing in the invoice are None.
+    """
+    document = cii_find(root, 'rsm:ExchangedDocument')
+    transaction = cii_find(root, 'rsm:SupplyChainTradeTransaction')
+    agreement = cii_find(transaction, 'ram:ApplicableHeaderTradeAgreement')
+    settlement = cii_find(transaction, 'ram:ApplicableHeaderTradeSettlement')
+    summation = cii_find(settlement, 'ram:SpecifiedTradeSettlementHeaderMonetarySummation')
+    currency = cii_text(settlement, 'ram:InvoiceCurrencyCode')
+
+    # TaxTotalAmount may be given in several currencies
+    tax_total = None
+    for amount in (summation.iterfind('ram:TaxTotalAmount', CII_NS) if summation is not None else []):
+        if tax_total is None or amount.get('currencyID') == currency:
+            tax_total = (amount.text or '').strip() or None
+
+    lines = []
+    for item in (transaction.iterfind('ram:IncludedSupplyChainTradeLineItem', CII_NS) if transaction is not None else []):
+        quantity = cii_find(item, 'ram:SpecifiedLineTradeDelivery/ram:BilledQuantity')
+        lines.append({
+            'line_id': cii_text(item, 'ram:AssociatedDocumentLineDocument/ram:LineID'),
+            'name': cii_text(item, 'ram:SpecifiedTradeProduct/ram:Name'),
+            'seller_assigned_id': cii_text(item, 'ram:SpecifiedTradeProduct/ram:SellerAssignedID'),
+            'description': cii_text(item, 'ram:SpecifiedTradeProduct/ram:Description'),
+            'quantity': quantity.text.strip() if quantity is not None and quantity.text else None,
+            'unit_code': quantity.get('unitCode') if quantity is not None else None,
+            'net_price': cii_text(item, 'ram:SpecifiedLineTradeAgreement/ram:NetPriceProductTradePrice/ram:ChargeAmount'),
+            'gross_price': cii_text(item, 'ram:SpecifiedLineTradeAgreement/ram:GrossPriceProductTradePrice/ram:ChargeAmount'),
+            'tax_category': cii_text(item, 'ram:SpecifiedLineTradeSettlement/ram:ApplicableTradeTax/ram:CategoryCode'),
+            'tax_rate': cii_text(item, 'ram:SpecifiedLineTradeSettlement/ram:ApplicableTradeTax/ram:RateApplicablePercent'),
+            'line_total': cii_text(
+                item, 'ram:SpecifiedLineTradeSettlement/ram:SpecifiedTradeSettlementLineMonetarySummation/ram:LineTotalAmount')
+        })
+
+    return {
+        'number': cii_text(document, 'ram:ID'),
+        'type_code': cii_text(document, 'ram:TypeCode'),
+        'issue_date': cii_date(document, 'ram:IssueDateTime/udt:DateTimeString'),
+        'currency': currency,
+        'buyer_reference': cii_text(agreement, 'ram:BuyerReference'),
+        'order_reference': cii_text(agreement, 'ram:BuyerOrderReferencedDocument/ram:IssuerAssignedID'),
+        'notes': [note.text.strip() for note in (document.iterfind('ram:IncludedNote/ram:Content', CII_NS)
+                                                 if document is not None else []) if note.text],
+        'seller': cii_party(cii_find(agreement, 'ram:SellerTradeParty')),
+        'buyer': cii_party(cii_find(agreement, 'ram:BuyerTradeParty')),
+        'payment': {
+            'due_date': cii_date(settlement, 'ram:SpecifiedTradePaymentTerms/ram:DueDateDateTime/udt:DateTimeString'),
+            'terms': cii_text(settlement, 'ram:SpecifiedTradePaymentTerms/ram:Description'),
+            'reference': cii_text(settlement, 'ram:PaymentReference'),
+            'means_code': cii_text(settlement, 'ram:SpecifiedTradeSettlementPaymentMeans/ram:TypeCode'),
+            'iban': cii_text(
+                settlement, 'ram:SpecifiedTradeSettlementPaymentMeans/ram:PayeePartyCreditorFinancialAccount/ram:IBANID'),
+            'bic': cii_text(
+                settlement, 'ram:SpecifiedTradeSettlementPaymentMeans/ram:PayeeSpecifiedCreditorFinancialInstitution/ram:BICID')
+        },
+        'totals': {
+            'line_total': cii_text(summation, 'ram:LineTotalAmount'),
+            'charge_total': cii_text(summation, 'ram:ChargeTotalAmount'),
+            'allowance_total': cii_text(summation, 'ram:AllowanceTotalAmount'),
+            'tax_basis_total': cii_text(summation, 'ram:TaxBasisTotalAmount'),
+            'tax_total': tax_total,
+            'grand_total': cii_text(summation, 'ram:GrandTotalAmount'),
+            'prepaid': cii_text(summation, 'ram:TotalPrepaidAmount'),
+            'due_payable': cii_text(summation, 'ram:DuePayableAmount')
+        },
+        'taxes': [cii_tax(tax) for tax in (settlement.iterfind('ram:ApplicableTradeTax', CII_NS)
+                                           if settlement is not None else [])],
+        'lines': lines
+    }
+
+
+def extract_zugferd(pdf_stream, include_xml=True):
+    """
+    Find, parse and normalize the ZUGFeRD XML of a PDF
+
+    Raises LookupError if the PDF has no ZUGFeRD attachment and ValueError
+    for encrypted PDFs or malformed XML. "invoice" is None for XML that is
+    not a CII invoice (e.g. ZUGFeRD 1.0).
+    """
+    from lxml import etree
+    from pypdf import PdfReader
+
+    with stage_timer('parse'):
+        reader = PdfReader(pdf_stream)
+    if reader.is_encrypted and not reader.decrypt(''):
+        raise ValueError('PDF ist verschlüsselt')
+
+    filename, xml_bytes = find_zugferd_attachment(reader)
+    try:
+        root = parse_xml(xml_bytes)
+    except etree.XMLSyntaxError as e:
+        raise ValueError(f'Eingebettete XML ist ungültig: {str(e)}')
+
+    is_cii = root.tag == f"{{{CII_NS['rsm']}}}CrossIndustryInvoice"
+    guideline = cii_text(root, 'rsm:ExchangedDocumentContext/ram:GuidelineSpecifiedDocumentContextParameter/ram:ID')
+
+    result = {
+        'attachment': filename,
+        'guideline': guideline,
+        'conformance_level': guideline_level(guideline) if is_cii else None,
+        'invoice': parse_cii(root) if is_cii else None
+    }
+    if include_xml:
+        result['xml_content'] = xml_bytes.decode('utf-8', errors='replace')
+    return result
+
+
+def extract_zugferd_item(item):
+    """
+    Extract one /zugferd/extract/batch item inside a pool process
+
+    The item carries the PDF as bytes ("pdf") or base64 ("pdf_base64"),
+    decoding happens here so the request process only forwards the data.
+    """
+    filename = item.get('filename') or 'invoice.pdf'
+    try:
+        pdf_bytes = item.get('pdf') or base64.b64decode(item.get('pdf_base64') or '')
+        if not pdf_bytes:
+            raise ValueError('pdf_base64 ist erforderlich')
+        result = extract_zugferd(io.BytesIO(pdf_bytes), item.get('include_xml', True))
+        return {'filename': filename, 'success': True, **result}
+
+    except Exception as e:
+        return {'filename': filename, 'success': False, 'error': str(e)}
+
+
+def wants_binary(data=None):
+    """
+    Check whether the client asked for raw PDF bytes instead of base64 JSON
+
+    Either via "response": "binary" (body or query string) or an Accept
+    header that prefers application/pdf over application/json.
+    """
+    if request.args.get('response') == 'binary':
+        return True
+    if data and data.get('response') == 'binary':
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', 'application/pdf'])
+    return best == 'application/pdf'
+
+
+def wants_validation(data=None):
+    """
+    Check whether xml_content should be validated before embedding
+
+    Via "validate": true in the body or ?validate=true, defaults to
+    ZUGFERD_VALIDATE.
+    """
+    value = request.args.get('validate')
+    if value is None and data:
+        value = data.get('validate')
+    if value is None:
+        return ZUGFERD_VALIDATE
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+def get_form_data():
+    """
+    Form fields plus query string parameters
+
+    Raw application/pdf (or image) bodies carry their options in the query
+    string, multipart uploads can use either.
+    """
+    data = request.args.to_dict()
+    data.update(request.form.to_dict())
+    return data
+
+
+def spool_stream(source):
+    """Copy a readable stream into a seekable spooled temp file"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    shutil.copyfileobj(source, spooled, 1024 * 1024)
+    spooled.seek(0)
+    return spooled
+
+
+def open_binary_input(data, field, upload_field, body_types):
+    """
+    Return a seekable binary stream with the request's input file, or None
+
+    Sources, in order:
+    1. multipart/form-data file part named upload_field (or field)
+    2. raw request body whose Content-Type is in body_types
+    3. base64 string in data[field]
+
+    Uploads and raw bodies stay on disk (werkzeug spools large file parts,
+    raw bodies go through spool_stream), so they are never base64-decoded
+    or copied into RAM. Raises ValueError for invalid base64.
+    """
+    upload = request.files.get(upload_field) or request.files.get(field)
+    if upload:
+        upload.stream.seek(0)
+        return upload.stream
+
+    if request.mimetype in body_types or any(
+            t.endswith('/*') and request.mimetype.startswith(t[:-1]) for t in body_types):
+        # Already spooled while computing the result cache key
+        body = request.environ.get('zugferd.body')
+        if body is not None:
+            body.seek(0)
+            return body
+        return spool_stream(request.stream)
+
+    encoded = data.get(field) if data else None
+    if not encoded:
+        return None
+
+    if not isinstance(encoded, str):
+        raise ValueError(f'{field} must be a base64 string')
+
+    try:
+        with stage_timer('decode'):
+            return io.BytesIO(base64.b64decode(encoded))
+    except Exception as e:
+        raise ValueError(f'Invalid base64 in {field}: {str(e)}')
+
+
+def open_pdf_input(data, field='pdf_base64', upload_field='pdf'):
+    """PDF input from a file part, an application/pdf body or base64 (see open_binary_input)"""
+    return open_binary_input(data, field, upload_field, PDF_BODY_TYPES)
+
+
+def as_pdf_stream(item, endpoint=None):
+    """Turn one entry of a PDF list (base64 string or uploaded stream) into a stream"""
+    if isinstance(item, str):
+        with stage_timer('decode', endpoint):
+            return io.BytesIO(base64.b64decode(item))
+    item.seek(0)
+    return item
+
+
+def get_text_input(data, field, upload_field):
+    """Text field from the body, or the UTF-8 content of an uploaded file part"""
+    upload = request.files.get(upload_field) or request.files.get(field)
+    if upload:
+        return upload.read().decode('utf-8')
+    return data.get(field, '') if data else ''
+
+
+def stream_size(stream):
+    """Size in bytes of a seekable stream"""
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+
+def metadata_header(key):
+    """Map a response field name like page_count to X-Page-Count"""
+    words = [word.upper() if word == 'pdf' else word.capitalize() for word in key.split('_')]
+    return 'X-' + '-'.join(words)
+
+
+def pdf_response(pdf_bytes, filename, binary=False, base64_key='pdf_base64', **fields):
+    """
+    Build the response for an endpoint that produces a single PDF
+
+    JSON (default): {"success": true, <base64_key>: ..., "pdf_size": ..., "filename": ..., **fields}
+    Binary: raw application/pdf body, fields are sent as X-... headers
+    """
+    if binary:
+        return binary_pdf_response(io.BytesIO(pdf_bytes), len(pdf_bytes), filename, fields)
+
+    with stage_timer('base64'):
+        encoded = base64.b64encode(pdf_bytes).decode('utf-8')
+    payload = {
+        'success': True,
+        base64_key: encoded,
+        'pdf_size': len(pdf_bytes),
+        'filename': filename
+    }
+    payload.update(fields)
+    return jsonify(payload), 200
+
+
+def binary_pdf_response(pdf_file, pdf_size, filename, fields):
+    """application/pdf response for a file object, fields are sent as X-... headers"""
+    response = send_file(
+        pdf_file,
+        mimetype='application/pdf',
+        as_attachment=True,
+        download_name=filename
+    )
+    response.headers['X-PDF-Size'] = str(pdf_size)
+    for key, value in fields.items():
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        response.headers[metadata_header(key)] = str(value)
+    return response
+
+
+def pdf_file_response(pdf_file, filename, binary=False, base64_key='pdf_base64', **fields):
+    """
+    Like pdf_response, for a PDF in a (spooled) temp file positioned at 0
+
+    The body is streamed from the file: binary responses via send_file,
+    JSON responses are written piece by piece with the base64 encoded in
+    chunks, so the PDF is never held in memory as a whole. The file is
+    closed once the response has been sent.
+    """
+    pdf_size = stream_size(pdf_file)
+    if binary:
+        return binary_pdf_response(pdf_file, pdf_size, filename, fields)
+
+    endpoint = metric_endpoint()
+
+    def generate():
+        # Encoding time only, not the time spent waiting for the client
+        encoding = 0.0
+        try:
+            yield '{"success": true, ' + json.dumps(base64_key) + ': "'
+            # Multiple of 3 bytes so the chunks concatenate without padding
+            while True:
+                chunk = pdf_file.read(3 * 256 * 1024)
+                if not chunk:
+                    break
+                started = time.perf_counter()
+                encoded = base64.b64encode(chunk).decode('ascii')
+                encoding += time.perf_counter() - started
+                yield encoded
+            yield '", ' + json.dumps({'pdf_size': pdf_size, 'filename': filename, **fields})[1:]
+        finally:
+            pdf_file.close()
+            stage_seconds.labels(endpoint, 'base64').observe(encoding)
+
+    return Response(generate(), mimetype='application/json'), 200
+
+
+def template_path(template_id):
+    return os.path.join(TEMPLATE_DIR, f'{template_id}.json')
+
+
+def template_version(template_id):
+    """Modification time of a template file in ns, None if it does not exist"""
+    # IDs are hex digests; reject anything else before touching the filesystem
+    if not template_id or not all(c in '0123456789abcdef' for c in str(template_id)):
+        return None
+    try:
+        return os.stat(template_path(template_id)).st_mtime_ns
+    except OSError:
+        return None
+
+
+def save_template(html_content, css=''):
+    """Store a template source on disk and return its content-derived ID"""
+    digest = hashlib.sha256(html_content.encode('utf-8') + b'\0' + css.encode('utf-8'))
+    template_id = digest.hexdigest()[:32]
+    path = template_path(template_id)
+
+    if not os.path.exists(path):
+        os.makedirs(TEMPLATE_DIR, exist_ok=True)
+        # Write to a temp file first so other workers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=TEMPLATE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'html_content': html_content, 'css': css}, f)
+        os.replace(tmp_path, path)
+
+    return template_id
+
+
+def load_template(template_id):
+    """
+    Return (compiled Jinja template, parsed CSS or None) for a template ID
+
+    Returns None if the template is unknown. Compiled objects are kept in a
+    per-worker LRU so the hot path skips both Jinja compilation and CSS parsing.
+    Every lookup stats the file: a template deleted or re-registered through
+    another worker is not served from this worker's cache.
+    """
+    version = template_version(template_id)
+    if version is None:
+        template_cache.discard(template_id)
+        return None
+
+    cached = template_cache.get(template_id)
+    if cached is not None and cached[0] == version:
+        return cached[1:]
+
+    try:
+        with open(template_path(template_id), encoding='utf-8') as f:
+            source = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    compiled = jinja_env.from_string(source['html_content'])
+    css_obj = get_css(source['css']) if source.get('css') else None
+
+    template_cache.put(template_id, (version, compiled, css_obj))
+    return compiled, css_obj
+
+
+def render_template_request(data):
+    """
+    Render the template referenced by data['template_id'] with data['data']
+
+    Returns (html_content, stylesheets) or raises LookupError/ValueError.
+    """
+    template_id = data.get('template_id', '')
+    template_data = data.get('data', {})
+
+    # Form data sends the data dict as a JSON string
+    if isinstance(template_data, str):
+        try:
+            template_data = json.loads(template_data) if template_data else {}
+        except ValueError as e:
+            raise ValueError(f'data must be a JSON object: {str(e)}')
+
+    if not isinstance(template_data, dict):
+        raise ValueError('data must be a JSON object')
+
+    loaded = load_template(template_id)
+    if loaded is None:
+        raise LookupError(f'Unknown template_id: {template_id}')
+
+    compiled, css_obj = loaded
+    stylesheets = [css_obj] if css_obj is not None else []
+    try:
+        return compiled.render(template_data), stylesheets
+    except SecurityError as e:
+        raise ValueError(f'Template uses a forbidden operation: {str(e)}')
+
+job_executor = None
+job_executor_pid = None
+job_executor_lock = threading.Lock()
+pending_jobs = 0
+last_job_cleanup = 0
+
+
+def get_job_executor():
+    """Per-process job thread pool, created lazily so it survives gunicorn forking"""
+    global job_executor, job_executor_pid
+    with job_executor_lock:
+        if job_executor is None or job_executor_pid != os.getpid():
+            job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+            job_executor_pid = os.getpid()
+        return job_executor
+
+
+def job_path(job_id, name=''):
+    return os.path.join(JOB_DIR, job_id, name)
+
+
+def read_job(job_id):
+    """Load a job's status record, or None if it does not exist"""
+    # Job IDs are uuid4 hex strings; reject anything else before touching the filesystem
+    if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+        return None
+    try:
+        with open(job_path(job_id, 'job.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_job(job):
+    """Atomically replace a job's status record"""
+    fd, tmp_path = tempfile.mkstemp(dir=job_path(job['job_id']), suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(job, f)
+    os.replace(tmp_path, job_path(job['job_id'], 'job.json'))
+
+
+def cleanup_jobs():
+    """Delete job directories older than JOB_TTL (at most once a minute per worker)"""
+    global last_job_cleanup
+    now = time.time()
+    if now - last_job_cleanup < 60 or not os.path.isdir(JOB_DIR):
+        return
+    last_job_cleanup = now
+
+    for job_id in os.listdir(JOB_DIR):
+        try:
+            if now - os.path.getmtime(job_path(job_id)) > JOB_TTL:
+                shutil.rmtree(job_path(job_id), ignore_errors=True)
+        except OSError:
+            pass
+
+
+def job_status_payload(job):
+    """Public view of a job record, as returned by GET /jobs/<id> and callbacks"""
+    payload = {
+        'success': True,
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'endpoint': job['request']['path'],
+        'created_at': job['created_at'],
+        'started_at': job.get('started_at'),
+        'finished_at': job.get('finished_at'),
+        'status_url': f'/jobs/{job["job_id"]}'
+    }
+    if job['status'] in ('succeeded', 'failed'):
+        payload['http_status'] = job.get('http_status')
+        payload['result_url'] = f'/jobs/{job["job_id"]}/result'
+    if job.get('error'):
+        payload['error'] = job['error']
+    return payload
+
+
+def wants_async():
+    """
+    Check whether the client asked for async execution
+
+    Via ?async=true, a "Prefer: respond-async" header or "async": true in
+    a JSON or urlencoded body. Multipart and raw bodies must use the query
+    string or header so the upload is not parsed twice.
+    """
+    if request.environ.get('zugferd.job_id'):
+        return False
+    if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        return True
+    if 'respond-async' in request.headers.get('Prefer', ''):
+        return True
+    if request.is_json:
+        body = request.get_json(silent=True)
+        return isinstance(body, dict) and str(body.get('async', '')).lower() in ('1', 'true', 'yes')
+    if request.mimetype == 'application/x-www-form-urlencoded':
+        # Cache the raw body first so it can still be stored with the job
+        request.get_data(cache=True)
+        return request.form.get('async', '').lower() in ('1', 'true', 'yes')
+    return False
+
+
+def submit_job():
+    """Store the current request on disk and queue it for background execution"""
+    global pending_jobs
+    cleanup_jobs()
+
+    callback_url = request.args.get('callback_url') or request.headers.get('X-Callback-Url')
+    if not callback_url and request.is_json:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            callback_url = body.get('callback_url')
+    if not callback_url and request.mimetype == 'application/x-www-form-urlencoded':
+        callback_url = request.form.get('callback_url')
+
+    if callback_url:
+        try:
+            check_callback_url(callback_url)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+    with job_executor_lock:
+        if pending_jobs >= JOB_QUEUE_LIMIT:
+            return jsonify({'success': False, 'error': 'Job queue is full, try again later'}), 503
+        pending_jobs += 1
+
+    try:
+        job_id = uuid.uuid4().hex
+        os.makedirs(job_path(job_id))
+
+        # JSON/urlencoded bodies are already cached, uploads are streamed to disk
+        with open(job_path(job_id, 'body'), 'wb') as f:
+            if request.is_json or request.mimetype == 'application/x-www-form-urlencoded':
+                f.write(request.get_data(cache=True))
+            else:
+                shutil.copyfileobj(request.stream, f, 1024 * 1024)
+
+        job = {
+            'job_id': job_id,
+            'status': 'queued',
+            'created_at': time.time(),
+            'callback_url': callback_url,
+            'request': {
+                'path': request.path,
+                'query_string': request.query_string.decode('latin-1'),
+                'headers': {
+                    key: value for key, value in request.headers.items()
+                    if key.lower() in ('content-type', 'accept')
+                }
+            }
+        }
+        write_job(job)
+
+        get_job_executor().submit(run_job, job_id)
+    except Exception:
+        with job_executor_lock:
+            pending_jobs -= 1
+        raise
+
+    logger.info(f'Queued job {job_id} for {request.path}')
+
+    response = jsonify(job_status_payload(job))
+    response.status_code = 202
+    response.headers['Location'] = f'/jobs/{job_id}'
+    return response
+
+
+def run_job(job_id):
+    """Replay a stored request through the Flask app and store its response"""
+    global pending_jobs
+    job = read_job(job_id)
+    try:
+        if job is None:
+            return
+        job['status'] = 'running'
+        job['started_at'] = time.time()
+        write_job(job)
+
+        stored = job['request']
+        with open(job_path(job_id, 'body'), 'rb') as body:
+            with app.test_request_context(
+                stored['path'],
+                method='POST',
+                query_string=stored['query_string'],
+                headers=stored['headers'],
+                input_stream=body,
+                content_length=os.path.getsize(job_path(job_id, 'body')),
+                environ_overrides={'zugferd.job_id': job_id}
+            ):
+                response = app.full_dispatch_request()
+                with open(job_path(job_id, 'result'), 'wb') as result:
+                    for chunk in response.iter_encoded():
+                        result.write(chunk)
+                response.close()
+
+        job['http_status'] = response.status_code
+        job['mimetype'] = response.mimetype
+        job['headers'] = {
+            key: value for key, value in response.headers.items()
+            if key.startswith('X-') or key == 'Content-Disposition'
+        }
+        job['status'] = 'succeeded' if response.status_code < 400 else 'failed'
+        if response.status_code >= 400 and response.is_json:
+            job['error'] = (response.get_json(silent=True) or {}).get('error')
+
+    except Exception as e:
+        logger.error(f'Job {job_id} crashed: {str(e)}', exc_info=True)
+        if job is not None:
+            job['status'] = 'failed'
+            job['error'] = str(e)
+
+    finally:
+        with job_executor_lock:
+            pending_jobs -= 1
+
+    job['finished_at'] = time.time()
+    try:
+        write_job(job)
+        os.remove(job_path(job_id, 'body'))
+    except OSError:
+        # Job was deleted while it was running
+        return
+
+    logger.info(f'Job {job_id} finished: {job["status"]}')
+
+    if job.get('callback_url'):
+        notify_callback(job)
+
+
+def check_callback_url(url):
+    """
+    Raise ValueError unless url is an http(s) URL of an allowed, public host
+
+    The host is resolved and every address it resolves to is checked, so
+    a name pointing into the internal network is refused as well.
+    """
+    import ipaddress
+    import socket
+    from urllib.parse import urlsplit
+
+    try:
+        parts = urlsplit(str(url))
+        port = parts.port
+    except ValueError:
+        raise ValueError('callback_url is not a valid URL')
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError('callback_url must be an http or https URL')
+
+    host = parts.hostname.lower()
+    if CALLBACK_ALLOWED_HOSTS and host not in CALLBACK_ALLOWED_HOSTS:
+        raise ValueError(f'callback_url host {host} is not allowed')
+
+    try:
+        addresses = socket.getaddrinfo(host, port or (443 if parts.scheme == 'https' else 80), proto=socket.IPPROTO_TCP)
+    except OSError:
+        raise ValueError(f'callback_url host {host} cannot be resolved')
+
+    for address in addresses:
+        ip = ipaddress.ip_address(address[4][0].split('%')[0])
+        ip = getattr(ip, 'ipv4_mapped', None) or ip
+        if ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved or ip.is_multicast or ip.is_unspecified:
+            raise ValueError(f'callback_url host {host} resolves to a non-public address')
+
+
+def notify_callback(job):
+    """POST the final job status to the client's callback URL"""
+    import requests
+
+    try:
+        # Checked again: the host may resolve differently than at submit time.
+        # Redirects are not followed, they could lead anywhere.
+        check_callback_url(job['callback_url'])
+        requests.post(job['callback_url'], json=job_status_payload(job), timeout=10, allow_redirects=False)
+    except Exception as e:
+        logger.warning(f'Callback for job {job["job_id"]} failed: {str(e)}')
+
+
+process_pool = None
+process_pool_pid = None
+process_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    """
+    Per-worker process pool, created lazily
+
+    Uses the spawn start method: forking a worker that has job threads
+    running could copy a held render lock into the children.
+    """
+    global process_pool, process_pool_pid
+    with process_pool_lock:
+        if process_pool is None or process_pool_pid != os.getpid():
+            process_pool = ProcessPoolExecutor(
+                max_workers=BATCH_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            process_pool_pid = os.getpid()
+        return process_pool
+
+
+def reset_process_pool():
+    """Drop a broken process pool so the next request starts a fresh one"""
+    global process_pool
+    with process_pool_lock:
+        if process_pool is not None:
+            process_pool.shutdown(wait=False, cancel_futures=True)
+        process_pool = None
+
+
+def iter_pool_results(function, items, window=None):
+    """
+    Run function(item) for every item in the process pool
+
+    Yields (index, result) as soon as each item finishes. At most `window`
+    items are in flight, so inputs and results of huge batches are not all
+    pickled at once. An exception from an item is yielded as its result.
+
+    A crashed child breaks the pool and fails every item in flight. The
+    pool is replaced right away and those items are resubmitted one at a
+    time, so a second crash can only be caused by the item itself: that
+    item gets the BrokenProcessPool as its result and the rest go on.
+    """
+    pool = get_process_pool()
+    window = window or BATCH_PROCESSES * 4
+    pending = {}
+    queue = iter(enumerate(items))
+    retry = deque()
+    retried = set()
+
+    def fill():
+        while len(pending) < window:
+            if retry:
+                if pending:
+                    return
+                entry = retry.popleft()
+            else:
+                entry = next(queue, None)
+                if entry is None:
+                    return
+            pending[pool.submit(function, entry[1])] = entry
+
+    try:
+        fill()
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            broken = []
+            for future in done:
+                index, item = pending.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    broken.append((index, item))
+                    continue
+                except Exception as e:
+                    result = e
+                yield index, result
+
+            if broken:
+                # Every other future of the broken pool fails the same way
+                broken.extend(pending.values())
+                pending.clear()
+                logger.warning(f'Process pool broke down, retrying {len(broken)} items in a new pool')
+                reset_process_pool()
+                pool = get_process_pool()
+                for index, item in sorted(broken, key=lambda entry: entry[0]):
+                    if index in retried:
+                        yield index, BrokenProcessPool('A process in the pool crashed on this item')
+                    else:
+                        retried.add(index)
+                        retry.append((index, item))
+            fill()
+    except Exception:
+        # A crashed child breaks the whole pool; start over next time
+        reset_process_pool()
+        raise
+
+
+class MergeWriter:
+    """
+    Merged PDF written object by object into a binary file
+
+    add_document() copies the selected pages of one PdfReader, and every
+    object they reference, to the output right away and renumbers the
+    references on the way. Only byte offsets, the new page numbers and a
+    hash per written object are kept afterwards, so the reader can be
+    dropped and memory stays proportional to the largest input.
+    finish() writes the page tree, catalog and cross-reference table.
+
+    Objects are copied bottom-up (referenced objects before the objects
+    that reference them) and identical ones are written only once: fonts,
+    logos and ICC profiles shared by inputs made from the same template
+    end up in the output a single time. bytes_saved counts what that saved.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.offsets = [0]
+        self.kids = []
+        self.hashes = {}
+        self.bytes_saved = 0
+        self.objects_deduplicated = 0
+        output.write(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+        self.pages_number = self.reserve()
+
+    @property
+    def page_count(self):
+        return len(self.kids)
+
+    def reserve(self):
+        """Allocate the next object number"""
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+
+    def add_document(self, reader, page_indices=None):
+        """Copy the pages of reader (all, or the given 0-based indices), return the number of pages added"""
+        from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NullObject, StreamObject
+
+        pages = reader.pages
+        selected = [pages[i] for i in (range(len(pages)) if page_indices is None else page_indices)]
+
+        # Number the selected pages first so links between them survive,
+        # references to any other page (or the old page tree) become null.
+        # A page selected twice is written twice.
+        numbers = {}
+        page_numbers = []
+        for page in selected:
+            ref = page.indirect_reference
+            key = (ref.idnum, ref.generation)
+            if key in numbers:
+                page_numbers.append(self.reserve())
+            else:
+                numbers[key] = self.reserve()
+                page_numbers.append(numbers[key])
+        dropped = set()
+        in_progress = set()
+
+        def renumber(obj):
+            if isinstance(obj, IndirectObject):
+                key = (obj.idnum, obj.generation)
+                if key in dropped:
+                    return NullObject()
+                if key in in_progress and key not in numbers:
+                    # Reference cycle: the object needs its number before
+                    # its content is known, so it is not deduplicated
+                    numbers[key] = self.reserve()
+                if key not in numbers:
+                    target = obj.get_object()
+                    if target is None or (isinstance(target, DictionaryObject)
+                                          and target.get('/Type') in ('/Page', '/Pages')):
+                        dropped.add(key)
+                        return NullObject()
+                    in_progress.add(key)
+                    data = serialize(copy(target))
+                    in_progress.discard(key)
+                    if key in numbers:
+                        self.write_bytes(numbers[key], data)
+                    else:
+                        numbers[key] = self.write_unique(data)
+                return IndirectObject(numbers[key], 0, None)
+            if isinstance(obj, DictionaryObject):
+                result = DictionaryObject()
+                for key, value in obj.items():
+                    result[key] = renumber(value)
+                return result
+            if isinstance(obj, ArrayObject):
+                return ArrayObject(renumber(value) for value in obj)
+            return obj
+
+        def copy(obj):
+            if isinstance(obj, StreamObject):
+                # Stream data is copied still encoded, it is never decompressed
+                stream = StreamObject()
+                for key, value in obj.items():
+                    if key != '/Length':
+                        stream[key] = renumber(value)
+                stream.set_data(obj._data)
+                return stream
+            return renumber(obj)
+
+        def serialize(obj):
+            buffer = io.BytesIO()
+            obj.write_to_stream(buffer)
+            return buffer.getvalue()
+
+        for page, number in zip(selected, page_numbers):
+            self.kids.append(number)
+            page_copy = copy(DictionaryObject(
+                {key: value for key, value in page.items() if key != '/Parent'}
+            ))
+            page_copy[NameObject('/Parent')] = IndirectObject(self.pages_number, 0, None)
+            self.write(number, page_copy)
+
+        return len(selected)
+
+    def write_unique(self, data):
+        """Write a serialized object unless an identical one was written before, return its number"""
+        digest = hashlib.sha256(data).digest()
+        number = self.hashes.get(digest)
+        if number is not None:
+            self.bytes_saved += len(data)
+            self.objects_deduplicated += 1
+            return number
+        number = self.reserve()
+        self.write_bytes(number, data)
+        self.hashes[digest] = number
+        return number
+
+    def write_bytes(self, number, data):
+        """Write a serialized object as indirect object number"""
+        self.offsets[number] = self.output.tell()
+        self.output.write(f'{number} 0 obj\n'.encode())
+        self.output.write(data)
+        self.output.write(b'\nendobj\n')
+
+    def write(self, number, obj):
+        """Write a pypdf object as indirect object number"""
+        self.offsets[number] = self.output.tell()
+        self.output.write(f'{number} 0 obj\n'.encode())
+        obj.write_to_stream(self.output)
+        self.output.write(b'\nendobj\n')
+
+    def finish(self):
+        """Write page tree, catalog, cross-reference table and trailer"""
+        from pypdf.generic import (
+            ArrayObject, ByteStringObject, DictionaryObject, IndirectObject, NameObject, NumberObject
+        )
+
+        self.write(self.pages_number, DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): ArrayObject(IndirectObject(number, 0, None) for number in self.kids),
+            NameObject('/Count'): NumberObject(len(self.kids))
+        }))
+        catalog_number = self.reserve()
+        self.write(catalog_number, DictionaryObject({
+            NameObject('/Type'): NameObject('/Catalog'),
+            NameObject('/Pages'): IndirectObject(self.pages_number, 0, None)
+        }))
+
+        xref_offset = self.output.tell()
+        self.output.write(f'xref\n0 {len(self.offsets)}\n0000000000 65535 f \n'.encode())
+        for offset in self.offsets[1:]:
+            self.output.write(f'{offset:010d} 00000 n \n'.encode())
+
+        identifier = ByteStringObject(uuid.uuid4().bytes)
+        trailer = DictionaryObject({
+            NameObject('/Size'): NumberObject(len(self.offsets)),
+            NameObject('/Root'): IndirectObject(catalog_number, 0, None),
+            NameObject('/ID'): ArrayObject([identifier, identifier])
+        })
+        self.output.write(b'trailer\n')
+        trailer.write_to_stream(self.output)
+        self.output.write(f'\nstartxref\n{xref_offset}\n%%EOF\n'.encode())
+
+
+merge_executor = None
+merge_executor_pid = None
+merge_executor_lock = threading.Lock()
+
+
+def get_merge_executor():
+    """Per-process thread pool that reads merge inputs ahead of the writer"""
+    global merge_executor, merge_executor_pid
+    with merge_executor_lock:
+        if merge_executor is None or merge_executor_pid != os.getpid():
+            merge_executor = ThreadPoolExecutor(max_workers=MERGE_THREADS, thread_name_prefix='merge')
+            merge_executor_pid = os.getpid()
+        return merge_executor
+
+
+def parse_page_selection(selection, total_pages):
+    """
+    Turn a page selection into 0-based page indices, None means all pages
+
+    Pages are 1-based. Accepts a list of page numbers and [start, end]
+    ranges ([1, [3, 5]]) or a string like "1,3-5". Order and repeats are
+    kept. Raises ValueError for pages outside the document.
+    """
+    if selection in (None, '', []):
+        return None
+
+    if isinstance(selection, str):
+        parts = [part.strip() for part in selection.split(',') if part.strip()]
+    elif isinstance(selection, list):
+        parts = selection
+    else:
+        raise ValueError('pages must be a list or a string like "1-3,5"')
+
+    indices = []
+    for part in parts:
+        try:
+            if isinstance(part, str) and '-' in part:
+                start, end = (int(value) for value in part.split('-', 1))
+            elif isinstance(part, list) and len(part) == 2:
+                start, end = int(part[0]), int(part[1])
+            else:
+                start = end = int(part)
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid page selection: {part!r}')
+        if start < 1 or end > total_pages or start > end:
+            raise ValueError(f'Page selection {part!r} is outside of 1-{total_pages}')
+        indices.extend(range(start - 1, end))
+    return indices
+
+
+def merge_inputs(data):
+    """
+    Collect the inputs of a merge request, in order
+
+    Returns dicts with name, data (base64 string or stream) and pages (a
+    page selection, see parse_page_selection). Both merge endpoints accept
+    every shape:
+    - "pdfs": list of base64 strings or {"pdf_base64", "name", "pages"} objects
+    - "pdf_files": list of {"pdf_base64", "name", "pages"} objects
+    - repeated "pdfs" or "pdf_files" file parts, with an optional "pages"
+      form field holding a JSON list of selections, one per part
+    - pdf_1_base64 (or a pdf_1 file part), pdf_1_name, pdf_1_pages, pdf_2_..., ...
+    Raises ValueError for malformed entries.
+    """
+    inputs = []
+
+    for field in ('pdfs', 'pdf_files'):
+        uploads = request.files.getlist(field)
+        if uploads:
+            selections = data.get('pages') or []
+            if isinstance(selections, str):
+                selections = json.loads(selections)
+            for idx, upload in enumerate(uploads):
+                inputs.append({
+                    'name': upload.filename or f'PDF {idx + 1}',
+                    'data': upload.stream,
+                    'pages': selections[idx] if idx < len(selections) else None
+                })
+            return inputs
+
+        entries = data.get(field)
+        if isinstance(entries, str):
+            entries = json.loads(entries)
+        if not entries:
+            continue
+        if not isinstance(entries, list):
+            raise ValueError(f'{field} must be an array')
+
+        for idx, entry in enumerate(entries):
+            if isinstance(entry, str):
+                entry = {'pdf_base64': entry}
+            if not isinstance(entry, dict) or not entry.get('pdf_base64'):
+                raise ValueError(f'{field}[{idx}] must be a base64 string or an object with pdf_base64')
+            inputs.append({
+                'name': entry.get('name') or f'PDF {idx + 1}',
+                'data': entry['pdf_base64'],
+                'pages': entry.get('pages')
+            })
+        return inputs
+
+    i = 1
+    while f'pdf_{i}_base64' in data or f'pdf_{i}' in request.files:
+        upload = request.files.get(f'pdf_{i}')
+        inputs.append({
+            'name': data.get(f'pdf_{i}_name', upload.filename if upload else f'PDF {i}'),
+            'data': upload.stream if upload else data[f'pdf_{i}_base64'],
+            'pages': data.get(f'pdf_{i}_pages')
+        })
+        i += 1
+    return inputs
+
+
+def open_merge_input(source, endpoint):
+    """Decode and parse one merge input (runs in the merge thread pool)"""
+    from pypdf import PdfReader
+
+    stream = as_pdf_stream(source, endpoint)
+    with stage_timer('parse', endpoint):
+        reader = PdfReader(stream)
+        if reader.is_encrypted and not reader.decrypt(''):
+            raise ValueError('PDF is encrypted')
+        # Loads the page tree, so the writer only has to copy
+        len(reader.pages)
+    return reader
+
+
+def merge_documents(inputs):
+    """
+    Merge PDFs into a spooled temp file
+
+    inputs is an iterable of dicts as returned by merge_inputs. Up to
+    MERGE_PREFETCH inputs are decoded and parsed ahead in the merge thread
+    pool while the writer copies the current one; the writer takes them
+    strictly in order and releases each input once it is copied, so
+    memory stays bounded by a few inputs. Identical objects are written
+    once (see MergeWriter). Returns (file, page_count, bytes_saved) with
+    the file positioned at 0. Raises ValueError naming the input that
+    failed.
+    """
+    executor = get_merge_executor()
+    queue = iter(inputs)
+    ahead = deque()
+    endpoint = metric_endpoint()
+
+    def submit_next():
+        for item in queue:
+            ahead.append((item, executor.submit(open_merge_input, item['data'], endpoint)))
+            return
+
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    writer = MergeWriter(output)
+    try:
+        for _ in range(MERGE_PREFETCH + 1):
+            submit_next()
+
+        idx = 0
+        while ahead:
+            item, future = ahead.popleft()
+            try:
+                reader = future.result()
+                page_indices = parse_page_selection(item.get('pages'), len(reader.pages))
+                with stage_timer('serialize'):
+                    page_count = writer.add_document(reader, page_indices)
+            except Exception as e:
+                raise ValueError(f'Failed to process PDF {idx + 1} ({item["name"]}): {str(e)}')
+            del reader, future
+            logger.info(f'Added {page_count} pages from {item["name"]}')
+            submit_next()
+            idx += 1
+
+        with stage_timer('serialize'):
+            writer.finish()
+    except Exception:
+        for _, future in ahead:
+            future.cancel()
+        output.close()
+        raise
+
+    if writer.objects_deduplicated:
+        logger.info(f'Deduplicated {writer.objects_deduplicated} objects ({writer.bytes_saved} bytes)')
+    output.seek(0)
+    observe_pages(writer.page_count)
+    return output, writer.page_count, writer.bytes_saved
+
+
+class ZipStream:
+    """Write-only file object that collects zipfile output so it can be streamed"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def unique_name(name, used):
+    """Make an archive member name unique by appending a counter"""
+    candidate = name
+    stem, ext = os.path.splitext(name)
+    counter = 2
+    while candidate in used:
+        candidate = f'{stem}_{counter}{ext}'
+        counter += 1
+    used.add(candidate)
+    return candidate
+
+
+def safe_filename(name, default):
+    """Client-supplied file name reduced to a safe one for headers and archive members"""
+    from werkzeug.utils import secure_filename
+
+    return secure_filename(str(name or '')) or default
+
+
+def async_job(view):
+    """Let an endpoint run as a background job when the client asks for it"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if wants_async():
+            return submit_job()
+        return view(*args, **kwargs)
+    return wrapper
+
+# Request fields that control how a result is delivered, not what it is
+RESULT_CACHE_IGNORED = ('async', 'callback_url')
+
+
+def stream_digest(stream):
+    """SHA-256 digest of a seekable stream's content, leaves it at position 0"""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    while True:
+        chunk = stream.read(1024 * 1024)
+        if not chunk:
+            break
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.digest()
+
+
+def result_cache_key():
+    """
+    Content hash of the current request: path, parameters, input bytes and
+    the file version of a referenced template
+
+    JSON bodies are hashed in canonical form (sorted keys), query and form
+    fields sorted, uploads and raw bodies by content. Requests that differ
+    only in key order, async or callback_url get the same key. A raw body
+    is spooled to a temp file on the way and left in the environ for
+    open_binary_input.
+    """
+    digest = hashlib.sha256()
+
+    def add(label, value):
+        digest.update(label.encode('utf-8') + b'\0' + value + b'\0')
+
+    def fields(items):
+        return json.dumps(sorted((key, value) for key, value in items if key not in RESULT_CACHE_IGNORED))
+
+    add('path', request.path.encode('utf-8'))
+    add('args', fields(request.args.items(multi=True)).encode('utf-8'))
+    add('accept', str(request.accept_mimetypes.best_match(['application/json', 'application/pdf'])).encode('utf-8'))
+
+    template_id = None
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            body = {key: value for key, value in body.items() if key not in RESULT_CACHE_IGNORED}
+            template_id = body.get('template_id')
+        add('json', json.dumps(body, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+    elif request.mimetype in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+        add('form', fields(request.form.items(multi=True)).encode('utf-8'))
+        for name, upload in request.files.items(multi=True):
+            add('file', name.encode('utf-8') + b'\0' + stream_digest(upload.stream))
+        template_id = request.form.get('template_id')
+    else:
+        body = spool_stream(request.stream)
+        request.environ['zugferd.body'] = body
+        add('body', request.mimetype.encode('utf-8') + b'\0' + stream_digest(body))
+
+    # A deleted or re-registered template must not be answered from results
+    # rendered with the old file
+    if template_id:
+        add('template', str(template_version(template_id)).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def cached_result(view):
+    """
+    Serve repeated identical requests from the result cache
+
+    The cache key doubles as a strong ETag: a client that sends it back in
+    If-None-Match gets 304 Not Modified without any work being done.
+    "Cache-Control: no-cache" skips the lookup but still refreshes the
+    entry. Only 200 responses are stored, and only if their body did not
+    report an error while streaming (see mark_result_failed).
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if RESULT_CACHE_MAX_BYTES <= 0:
+            return view(*args, **kwargs)
+
+        key = result_cache_key()
+        if request.if_none_match.contains(key):
+            response = Response(status=304)
+            response.set_etag(key)
+            return response
+
+        response = None
+        if 'no-cache' not in request.headers.get('Cache-Control', ''):
+            response = result_cache.get(key)
+        if response is not None:
+            logger.info(f'Result cache hit for {request.path}')
+            response.headers['X-Cache'] = 'HIT'
+        else:
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            response = result_cache.store(key, response)
+            response.headers['X-Cache'] = 'MISS'
+
+        response.set_etag(key)
+        return response
+    return wrapper
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint for Docker and monitoring"""
     return jsonify({'status': 'healthy', 'service': 'zugferd-generator'}), 200
 
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    Readiness probe with the report of the startup warm-up
+
+    503 until the warm-up has finished. With WARMUP=false the warm-up is
+    reported as skipped, not finished, and the worker is ready at once.
+    """
+    is_ready = warmup_state['finished'] or warmup_state['skipped']
+    payload = {'ready': is_ready, 'pid': os.getpid(), 'warmup': warmup_state}
+    return jsonify(payload), 200 if is_ready else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics, summed over all gunicorn workers when PROMETHEUS_MULTIPROC_DIR is set"""
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
+
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+@app.before_request
+def start_request_metrics():
+    """Count the request as in progress and remember when it started"""
+    labels = (metric_endpoint(), 'job' if 'zugferd.job_id' in request.environ else 'http')
+    request.environ['zugferd.metrics'] = (labels, time.perf_counter())
+    requests_in_progress.labels(*labels).inc()
+
+
+@app.after_request
+def finish_request_metrics(response):
+    """
+    Record status, sizes and latency once the response has been sent
+
+    Streamed responses are only complete when the server closes them, so
+    everything is recorded from call_on_close; bodies without a
+    Content-Length are counted while they stream.
+    """
+    started = request.environ.pop('zugferd.metrics', None)
+    if started is None:
+        return response
+    labels, started = started
+
+    if request.content_length is not None:
+        request_bytes.labels(*labels).observe(request.content_length)
+
+    sent = [0]
+    if response.is_streamed and response.content_length is None:
+        def counted(body):
+            try:
+                for chunk in body:
+                    # Streamed text bodies are ASCII JSON, so characters are bytes
+                    sent[0] += len(chunk)
+                    yield chunk
+            finally:
+                # Response.close() now only reaches this generator
+                if hasattr(body, 'close'):
+                    body.close()
+        response.response = counted(response.response)
+
+    def finish():
+        requests_in_progress.labels(*labels).dec()
+        requests_total.labels(*labels, str(response.status_code)).inc()
+        request_seconds.labels(*labels).observe(time.perf_counter() - started)
+        size = response.content_length
+        response_bytes.labels(*labels).observe(size if size is not None else sent[0])
+
+    response.call_on_close(finish)
+    return response
+
 @app.route('/generate', methods=['POST'])
+@async_job
 def generate_zugferd():
     """
     Generate ZUGFeRD PDF from base64 PDF and XML content
@@ -24,86 +2560,61 @@ def generate_zugferd():
     {
         "pdf_base64": "base64 encoded PDF",
         "xml_content": "ZUGFeRD XML string",
-        "filename": "optional filename"
+        "filename": "optional filename",
+        "validate": false (optional, check the XML first, see /zugferd/validate)
     }
+
+    OR multipart/form-data with "pdf" and "xml" file parts.
     """
     try:
         # Accept both JSON and form data
         if request.is_json:
             data = request.get_json()
         else:
-            data = request.form.to_dict()
+            data = get_form_data()
 
-        if not data:
-            return jsonify({'success': False, 'error': 'Request body required'}), 400
+        xml_content = get_text_input(data, 'xml_content', 'xml')
+        filename = data.get('filename', 'zugferd.pdf') if data else 'zugferd.pdf'
 
-        pdf_base64 = data.get('pdf_base64', '')
-        xml_content = data.get('xml_content', '')
-        filename = data.get('filename', 'zugferd.pdf')
+        # Open PDF from upload, raw body or base64
+        try:
+            pdf_stream = open_pdf_input(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
 
-        if not pdf_base64 or not xml_content:
+        if pdf_stream is None or not xml_content:
             return jsonify({
                 'success': False,
                 'error': 'pdf_base64 und xml_content sind erforderlich'
             }), 400
 
-        # Decode PDF from base64
-        try:
-            pdf_bytes = base64.b64decode(pdf_base64)
-        except Exception as e:
-            return jsonify({
-                'success': False,
-                'error': f'Invalid base64 PDF: {str(e)}'
-            }), 400
-
         # Convert XML to bytes
         xml_bytes = xml_content.encode('utf-8')
 
-        # Import pypdf for ZUGFeRD embedding
-        from pypdf import PdfReader, PdfWriter
-        from io import BytesIO
-
-        # Read the original PDF
-        pdf_reader = PdfReader(BytesIO(pdf_bytes))
-        pdf_writer = PdfWriter()
-
-        # Copy all pages
-        for page in pdf_reader.pages:
-            pdf_writer.add_page(page)
-
-        # Attach ZUGFeRD XML as embedded file
-        pdf_writer.add_attachment("factur-x.xml", xml_bytes)
-
-        # Set PDF/A-3 metadata for ZUGFeRD compliance
-        pdf_writer.add_metadata({
-            '/Title': 'ZUGFeRD Rechnung',
-            '/Author': 'futalis GmbH',
-            '/Subject': 'ZUGFeRD Invoice',
-            '/Producer': 'futalis ZUGFeRD Generator'
-        })
-
-        # Write to bytes
-        output = BytesIO()
-        pdf_writer.write(output)
-        zugferd_pdf_bytes = output.getvalue()
+        if wants_validation(data):
+            validation = validate_zugferd_xml(xml_bytes)
+            if not validation['valid']:
+                return invalid_xml_response(validation)
 
-        # Encode result to base64
-        zugferd_base64 = base64.b64encode(zugferd_pdf_bytes).decode('utf-8')
+        try:
+            zugferd_pdf_bytes, page_count = append_zugferd(pdf_stream, xml_bytes)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
 
         logger.info(f'Successfully generated ZUGFeRD PDF: {filename} ({len(zugferd_pdf_bytes)} bytes)')
 
-        return jsonify({
-            'success': True,
-            'zugferd_pdf_base64': zugferd_base64,
-            'pdf_size': len(zugferd_pdf_bytes),
-            'filename': filename
-        }), 200
+        return pdf_response(
+            zugferd_pdf_bytes, filename, wants_binary(data),
+            base64_key='zugferd_pdf_base64', page_count=page_count
+        )
 
     except Exception as e:
         logger.error(f'Error generating ZUGFeRD PDF: {str(e)}', exc_info=True)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/generate-pdf', methods=['POST'])
+@async_job
+@cached_result
 def generate_pdf():
     """
     Generate PDF from HTML content
@@ -116,6 +2627,14 @@ def generate_pdf():
         "css": "optional CSS string",
         "filename": "optional filename"
     }
+
+    OR render a registered template (see POST /templates):
+    {
+        "template_id": "ID returned by POST /templates",
+        "data": {"invoice_number": "2024-001", ...},
+        "css": "optional additional CSS string",
+        "filename": "optional filename"
+    }
     """
     try:
         logger.info('=== generate_pdf called ===')
@@ -136,13 +2655,19 @@ def generate_pdf():
         html_content = data.get('html_content', '')
         css = data.get('css', '')
         filename = data.get('filename', 'document.pdf')
+        stylesheets = []
 
-        logger.info(f'html_content length: {len(html_content)}, css length: {len(css)}')
+        if data.get('template_id'):
+            # Render registered template with per-invoice data
+            try:
+                html_content, stylesheets = render_template_request(data)
+            except LookupError as e:
+                return jsonify({'success': False, 'error': str(e)}), 404
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e)}), 400
+            logger.info(f'Rendered template {data["template_id"]}')
 
-        # Log first 500 chars of HTML for debugging
-        if html_content:
-            preview = html_content[:500].replace('\n', '\\n')
-            logger.info(f'HTML preview: {preview}...')
+        logger.info(f'html_content length: {len(html_content)}, css length: {len(css)}')
 
         if not html_content:
             return jsonify({
@@ -160,120 +2685,463 @@ def generate_pdf():
             if not html_content.startswith('<'):
                 html_content = f'<html><body>{html_content}</body></html>'
 
-        # Generate PDF from HTML
-        logger.info('Creating HTML object...')
-        html_obj = HTML(string=html_content)
-
-        logger.info(f'Generating PDF (with CSS: {bool(css)})...')
         if css:
-            # Create CSS stylesheet separately
-            css_obj = CSS(string=css)
-            pdf_bytes = html_obj.write_pdf(stylesheets=[css_obj])
-        else:
-            pdf_bytes = html_obj.write_pdf()
+            # Parsed stylesheets are cached by content hash
+            stylesheets = stylesheets + [get_css(css)]
 
-        logger.info(f'PDF generated: {len(pdf_bytes)} bytes')
+        # Generate PDF from HTML
+        logger.info(f'Generating PDF (with CSS: {bool(stylesheets)})...')
+        pdf_bytes, page_count = render_pdf(html_content, stylesheets)
 
-        # Encode to base64
-        pdf_base64 = base64.b64encode(pdf_bytes).decode('utf-8')
+        logger.info(f'PDF generated: {len(pdf_bytes)} bytes')
 
         logger.info(f'Successfully generated PDF: {filename} ({len(pdf_bytes)} bytes)')
 
-        return jsonify({
-            'success': True,
-            'pdf_base64': pdf_base64,
-            'pdf_size': len(pdf_bytes),
-            'filename': filename
-        }), 200
+        return pdf_response(pdf_bytes, filename, wants_binary(data), page_count=page_count)
 
     except Exception as e:
         logger.error(f'Error generating PDF: {str(e)}', exc_info=True)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/generate-complete', methods=['POST'])
+@async_job
 def generate_complete():
     """
-    Generate PDF from HTML and embed ZUGFeRD XML in one step
+    Generate PDF from HTML and embed ZUGFeRD XML in one step
+
+    Expected JSON body:
+    {
+        "html_content": "HTML string",
+        "css": "optional CSS string",
+        "xml_content": "ZUGFeRD XML string",
+        "filename": "optional filename",
+        "validate": false (optional, check the XML first, see /zugferd/validate)
+    }
+
+    "template_id" and "data" may be sent instead of "html_content" to render
+    a registered template (see POST /templates).
+    """
+    try:
+        data = request.get_json()
+
+        if not data:
+            return jsonify({'success': False, 'error': 'JSON body required'}), 400
+
+        html_content = data.get('html_content', '')
+        css = data.get('css', '')
+        xml_content = data.get('xml_content', '')
+        filename = data.get('filename', 'zugferd.pdf')
+        stylesheets = []
+
+        if data.get('template_id'):
+            try:
+                html_content, stylesheets = render_template_request(data)
+            except LookupError as e:
+                return jsonify({'success': False, 'error': str(e)}), 404
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e)}), 400
+
+        if not html_content or not xml_content:
+            return jsonify({
+                'success': False,
+                'error': 'html_content und xml_content sind erforderlich'
+            }), 400
+
+        if wants_validation(data):
+            validation = validate_zugferd_xml(xml_content.encode('utf-8'))
+            if not validation['valid']:
+                return invalid_xml_response(validation)
+
+        # Step 1: Generate PDF from HTML
+        if css:
+            stylesheets = stylesheets + [get_css(css)]
+
+        # Step 2: Embed ZUGFeRD XML
+        try:
+            zugferd_pdf_bytes, page_count = generate_complete_pdf(html_content, stylesheets, xml_content)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        logger.info(f'Successfully generated complete ZUGFeRD PDF: {filename} ({len(zugferd_pdf_bytes)} bytes)')
+
+        return pdf_response(
+            zugferd_pdf_bytes, filename, wants_binary(data),
+            base64_key='zugferd_pdf_base64', page_count=page_count
+        )
+
+    except Exception as e:
+        logger.error(f'Error generating complete ZUGFeRD PDF: {str(e)}', exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/generate-complete/batch', methods=['POST'])
+@async_job
+def generate_complete_batch():
+    """
+    Generate many ZUGFeRD invoices in one request, rendered in parallel
+
+    Expected JSON body:
+    {
+        "items": [
+            {"html_content": "...", "xml_content": "...", "filename": "invoice_1.pdf"},
+            {"template_id": "...", "data": {...}, "xml_content": "...", "filename": "invoice_2.pdf"}
+        ],
+        "css": "optional CSS applied to items without their own css",
+        "template_id": "optional template used by items without html_content",
+        "validate": false (optional, validate every item's XML, items may override),
+        "output": "ndjson|zip" (optional, default: ndjson)
+    }
+
+    Items are rendered across a process pool and streamed back as they
+    finish (not in input order). NDJSON: one JSON object per item, then a
+    final summary line. ZIP: one PDF per successful item, plus errors.json
+    if any item failed.
+    """
+    try:
+        logger.info('=== generate_complete_batch called ===')
+
+        data = request.get_json()
+
+        if not data or not isinstance(data.get('items'), list) or not data['items']:
+            return jsonify({'success': False, 'error': 'items array required'}), 400
+
+        output = data.get('output', 'ndjson')
+        if output not in ('ndjson', 'zip'):
+            return jsonify({'success': False, 'error': 'output must be ndjson or zip'}), 400
+
+        # Batch-level defaults apply to items that do not set them
+        defaults = {key: data[key] for key in ('css', 'template_id') if data.get(key)}
+        validate = wants_validation(data)
+        items = []
+        for idx, item in enumerate(data['items']):
+            if not isinstance(item, dict):
+                return jsonify({'success': False, 'error': f'Item {idx + 1} must be an object'}), 400
+            if not item.get('html_content'):
+                item = {**defaults, **item}
+            elif 'css' in defaults and 'css' not in item:
+                item = {**item, 'css': defaults['css']}
+            # An item's own flag wins over ?validate= and the body default
+            if 'validate' in item:
+                item_validate = str(item['validate']).lower() in ('1', 'true', 'yes')
+            else:
+                item_validate = validate
+            items.append({**item, 'validate': item_validate})
+
+        logger.info(f'Rendering batch of {len(items)} invoices on {BATCH_PROCESSES} processes')
+
+        def failed(index, error):
+            return {
+                'filename': items[index].get('filename') or 'zugferd.pdf',
+                'success': False,
+                'error': str(error)
+            }
+
+        def results():
+            finished = set()
+            try:
+                for index, result in iter_pool_results(render_batch_item, items):
+                    if isinstance(result, Exception):
+                        result = failed(index, result)
+                    result['index'] = index
+                    finished.add(index)
+                    yield result
+            except Exception as e:
+                # Pool broke down: report every unfinished item instead of cutting the stream
+                logger.error(f'Batch process pool failed: {str(e)}', exc_info=True)
+                for index in range(len(items)):
+                    if index not in finished:
+                        yield {**failed(index, e), 'index': index}
+
+        if output == 'zip':
+            body = stream_batch_zip(results(), len(items))
+            mimetype = 'application/zip'
+        else:
+            body = stream_batch_ndjson(results(), len(items))
+            mimetype = 'application/x-ndjson'
+
+        response = Response(stream_with_context(body), mimetype=mimetype)
+        if output == 'zip':
+            filename = safe_filename(data.get('filename'), 'invoices.zip')
+            response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response.headers['X-Item-Count'] = str(len(items))
+        return response
+
+    except Exception as e:
+        logger.error(f'Error generating batch: {str(e)}', exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+def stream_batch_ndjson(results, total):
+    """NDJSON body for a batch: one line per finished item, then a summary line"""
+    succeeded = 0
+    for result in results:
+        if result['success']:
+            succeeded += 1
+            if 'pdf' in result:
+                pdf_bytes = result.pop('pdf')
+                with stage_timer('base64'):
+                    result['zugferd_pdf_base64'] = base64.b64encode(pdf_bytes).decode('utf-8')
+                result['pdf_size'] = len(pdf_bytes)
+        yield json.dumps(result) + '\n'
+
+    logger.info(f'Batch finished: {succeeded}/{total} succeeded')
+    yield json.dumps({'done': True, 'total': total, 'succeeded': succeeded, 'failed': total - succeeded}) + '\n'
+
+
+def stream_batch_zip(results, total):
+    """ZIP body for a batch, written member by member as items finish"""
+    stream = ZipStream()
+    errors = []
+    used_names = set()
+
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as archive:
+        for result in results:
+            if result['success']:
+                # PDFs are already compressed, store them as-is
+                member = safe_filename(result['filename'], 'zugferd.pdf')
+                archive.writestr(unique_name(member, used_names), result['pdf'])
+            else:
+                errors.append({key: result[key] for key in ('index', 'filename', 'error', 'validation') if key in result})
+            yield stream.pop()
+
+        if errors:
+            archive.writestr('errors.json', json.dumps(errors, indent=2), compress_type=zipfile.ZIP_DEFLATED)
+
+    logger.info(f'Batch finished: {total - len(errors)}/{total} succeeded')
+    yield stream.pop()
+
+@app.route('/zugferd/validate', methods=['POST'])
+def validate_zugferd():
+    """
+    Validate ZUGFeRD/Factur-X XML without generating a PDF
+
+    Expected JSON body:
+    {
+        "xml_content": "ZUGFeRD XML string"
+    }
+
+    OR multipart/form-data with an "xml" file part, OR a raw application/xml
+    body. Checks well-formedness plus the XSD (ZUGFERD_XSD_PATH) and
+    Schematron (ZUGFERD_SCHEMATRON_PATH) configured on the server.
+    """
+    try:
+        logger.info('=== validate_zugferd called ===')
+
+        if request.is_json:
+            data = request.get_json()
+            xml_bytes = (data.get('xml_content', '') if data else '').encode('utf-8')
+        elif request.mimetype in ('application/xml', 'text/xml'):
+            xml_bytes = request.get_data()
+        else:
+            xml_bytes = get_text_input(get_form_data(), 'xml_content', 'xml').encode('utf-8')
+
+        if not xml_bytes:
+            return jsonify({'success': False, 'error': 'xml_content ist erforderlich'}), 400
+
+        validation = validate_zugferd_xml(xml_bytes)
+        if validation['valid']:
+            validation['conformance_level'] = conformance_level(xml_bytes)
+
+        logger.info(f"Validation finished: valid={validation['valid']}, {len(validation['errors'])} errors")
+
+        return jsonify({'success': True, **validation}), 200
+
+    except Exception as e:
+        logger.error(f'Error validating ZUGFeRD XML: {str(e)}', exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/zugferd/extract', methods=['POST'])
+@async_job
+def extract_zugferd_pdf():
+    """
+    Extract the ZUGFeRD/Factur-X XML from a received invoice PDF
+
+    Expected body:
+    {
+        "pdf_base64": "base64 encoded PDF",
+        "include_xml": true (optional, return the raw XML as well)
+    }
+
+    OR multipart/form-data with a "pdf" file part, OR a raw application/pdf
+    body (options in the query string).
+    """
+    try:
+        logger.info('=== extract_zugferd called ===')
+
+        if request.is_json:
+            data = request.get_json()
+        else:
+            data = get_form_data()
+
+        try:
+            pdf_stream = open_pdf_input(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        if pdf_stream is None:
+            return jsonify({'success': False, 'error': 'pdf_base64 ist erforderlich'}), 400
+
+        include_xml = str(data.get('include_xml', True) if data else True).lower() in ('1', 'true', 'yes')
+
+        try:
+            result = extract_zugferd(pdf_stream, include_xml)
+        except LookupError as e:
+            return jsonify({'success': False, 'error': str(e)}), 404
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        logger.info(f"Extracted {result['attachment']} ({result['conformance_level']})")
+
+        return jsonify({'success': True, **result}), 200
+
+    except Exception as e:
+        logger.error(f'Error extracting ZUGFeRD XML: {str(e)}', exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/zugferd/extract/batch', methods=['POST'])
+@async_job
+def extract_zugferd_batch():
+    """
+    Extract the ZUGFeRD XML of many PDFs in parallel
+
+    Expected JSON body:
+    {
+        "pdfs": [
+            {"pdf_base64": "...", "filename": "supplier_1.pdf"},
+            "base64 encoded PDF"
+        ],
+        "include_xml": true (optional)
+    }
+
+    OR multipart/form-data with repeated "pdfs" file parts.
+
+    PDFs are processed on the process pool and streamed back as NDJSON in
+    completion order (one line per PDF with "index", then a summary line).
+    """
+    try:
+        logger.info('=== extract_zugferd_batch called ===')
+
+        if request.is_json:
+            data = request.get_json() or {}
+            pdfs = data.get('pdfs')
+            if not isinstance(pdfs, list) or not pdfs:
+                return jsonify({'success': False, 'error': 'pdfs array required'}), 400
+        else:
+            data = get_form_data()
+            pdfs = request.files.getlist('pdfs')
+            if not pdfs:
+                return jsonify({'success': False, 'error': 'pdfs file parts required'}), 400
+
+        include_xml = str(data.get('include_xml', True)).lower() in ('1', 'true', 'yes')
+
+        def items():
+            # Uploads are read one at a time as the pool asks for more work
+            for idx, pdf in enumerate(pdfs):
+                if isinstance(pdf, dict):
+                    yield {**pdf, 'filename': pdf.get('filename') or f'invoice_{idx + 1}.pdf', 'include_xml': include_xml}
+                elif isinstance(pdf, str):
+                    yield {'pdf_base64': pdf, 'filename': f'invoice_{idx + 1}.pdf', 'include_xml': include_xml}
+                elif hasattr(pdf, 'read'):
+                    yield {'pdf': pdf.read(), 'filename': pdf.filename or f'invoice_{idx + 1}.pdf',
+                           'include_xml': include_xml}
+                else:
+                    yield {'filename': f'invoice_{idx + 1}.pdf', 'include_xml': include_xml}
+
+        logger.info(f'Extracting {len(pdfs)} invoices on {BATCH_PROCESSES} processes')
+
+        def results():
+            finished = set()
+            try:
+                for index, result in iter_pool_results(extract_zugferd_item, items()):
+                    if isinstance(result, Exception):
+                        result = {'filename': f'invoice_{index + 1}.pdf', 'success': False, 'error': str(result)}
+                    result['index'] = index
+                    finished.add(index)
+                    yield result
+            except Exception as e:
+                logger.error(f'Extraction process pool failed: {str(e)}', exc_info=True)
+                for index in range(len(pdfs)):
+                    if index not in finished:
+                        yield {'filename': f'invoice_{index + 1}.pdf', 'success': False, 'error': str(e), 'index': index}
+
+        response = Response(stream_with_context(stream_batch_ndjson(results(), len(pdfs))),
+                            mimetype='application/x-ndjson')
+        response.headers['X-Item-Count'] = str(len(pdfs))
+        return response
+
+    except Exception as e:
+        logger.error(f'Error extracting batch: {str(e)}', exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/templates', methods=['POST'])
+def register_template():
+    """
+    Register an HTML/CSS template for repeated rendering
 
-    Expected JSON body:
+    Accepts both JSON and form data.
+
+    Expected body:
     {
-        "html_content": "HTML string",
-        "css": "optional CSS string",
-        "xml_content": "ZUGFeRD XML string",
-        "filename": "optional filename"
+        "html_content": "Jinja2 HTML template, e.g. <h1>Invoice {{ invoice_number }}</h1>",
+        "css": "optional CSS string"
     }
+
+    The returned template_id is derived from the content, so registering the
+    same template twice returns the same ID.
     """
     try:
-        data = request.get_json()
+        if request.is_json:
+            data = request.get_json()
+        else:
+            data = request.form.to_dict()
 
-        if not data:
-            return jsonify({'success': False, 'error': 'JSON body required'}), 400
+        if not data or not data.get('html_content'):
+            return jsonify({'success': False, 'error': 'html_content ist erforderlich'}), 400
 
         html_content = data.get('html_content', '')
         css = data.get('css', '')
-        xml_content = data.get('xml_content', '')
-        filename = data.get('filename', 'zugferd.pdf')
-
-        if not html_content or not xml_content:
-            return jsonify({
-                'success': False,
-                'error': 'html_content und xml_content sind erforderlich'
-            }), 400
-
-        # Step 1: Generate PDF from HTML
-        html_obj = HTML(string=html_content)
 
-        if css:
-            pdf_bytes = html_obj.write_pdf(stylesheets=[CSS(string=css)])
-        else:
-            pdf_bytes = html_obj.write_pdf()
-
-        # Step 2: Embed ZUGFeRD XML
-        xml_bytes = xml_content.encode('utf-8')
+        # Compile once up front so syntax errors surface at upload time
+        try:
+            jinja_env.from_string(html_content)
+        except Exception as e:
+            return jsonify({'success': False, 'error': f'Invalid template: {str(e)}'}), 400
 
-        # Import pypdf for ZUGFeRD embedding
-        from pypdf import PdfReader, PdfWriter
-        from io import BytesIO
+        template_id = save_template(html_content, css)
 
-        # Read the generated PDF
-        pdf_reader = PdfReader(BytesIO(pdf_bytes))
-        pdf_writer = PdfWriter()
+        logger.info(f'Registered template {template_id} ({len(html_content)} bytes HTML, {len(css)} bytes CSS)')
 
-        # Copy all pages
-        for page in pdf_reader.pages:
-            pdf_writer.add_page(page)
+        return jsonify({
+            'success': True,
+            'template_id': template_id,
+            'html_size': len(html_content),
+            'css_size': len(css)
+        }), 201
 
-        # Attach ZUGFeRD XML as embedded file
-        pdf_writer.add_attachment("factur-x.xml", xml_bytes)
+    except Exception as e:
+        logger.error(f'Error registering template: {str(e)}', exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        # Set PDF/A-3 metadata for ZUGFeRD compliance
-        pdf_writer.add_metadata({
-            '/Title': 'ZUGFeRD Rechnung',
-            '/Author': 'futalis GmbH',
-            '/Subject': 'ZUGFeRD Invoice',
-            '/Producer': 'futalis ZUGFeRD Generator'
-        })
+@app.route('/templates/<template_id>', methods=['GET'])
+def get_template(template_id):
+    """Check whether a template is registered"""
+    if load_template(template_id) is None:
+        return jsonify({'success': False, 'error': f'Unknown template_id: {template_id}'}), 404
 
-        # Write to bytes
-        output = BytesIO()
-        pdf_writer.write(output)
-        zugferd_pdf_bytes = output.getvalue()
+    return jsonify({'success': True, 'template_id': template_id}), 200
 
-        # Encode to base64
-        zugferd_base64 = base64.b64encode(zugferd_pdf_bytes).decode('utf-8')
+@app.route('/templates/<template_id>', methods=['DELETE'])
+def delete_template(template_id):
+    """Remove a registered template"""
+    if load_template(template_id) is None:
+        return jsonify({'success': False, 'error': f'Unknown template_id: {template_id}'}), 404
 
-        logger.info(f'Successfully generated complete ZUGFeRD PDF: {filename} ({len(zugferd_pdf_bytes)} bytes)')
+    os.remove(template_path(template_id))
+    template_cache.discard(template_id)
 
-        return jsonify({
-            'success': True,
-            'zugferd_pdf_base64': zugferd_base64,
-            'pdf_size': len(zugferd_pdf_bytes),
-            'filename': filename
-        }), 200
+    logger.info(f'Deleted template {template_id}')
 
-    except Exception as e:
-        logger.error(f'Error generating complete ZUGFeRD PDF: {str(e)}', exc_info=True)
-        return jsonify({'success': False, 'error': str(e)}), 500
+    return jsonify({'success': True, 'template_id': template_id}), 200
 
 @app.route('/test', methods=['GET'])
 def test():
@@ -300,9 +3168,7 @@ def test():
 
     # Test 3: Generate simple HTML to PDF
     try:
-        from weasyprint import HTML
-        html = HTML(string='<html><body><h1>Test</h1></body></html>')
-        pdf_bytes = html.write_pdf()
+        pdf_bytes, _ = render_pdf('<html><body><h1>Test</h1></body></html>')
         results['tests']['html_to_pdf'] = f'OK ({len(pdf_bytes)} bytes)'
     except Exception as e:
         results['tests']['html_to_pdf'] = f'FAILED: {str(e)}'
@@ -316,6 +3182,17 @@ def test():
 
     return jsonify(results), 200
 
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Hit/miss counters of this worker's caches, plus the size of the shared result cache"""
+    return jsonify({
+        'pid': os.getpid(),
+        'templates': template_cache.stats(),
+        'css': css_cache.stats(),
+        'watermarks': watermark_cache.stats(),
+        'results': result_cache.stats()
+    }), 200
+
 @app.route('/test-pdf-generation', methods=['GET'])
 def test_pdf_generation():
     """Test endpoint that generates a simple PDF to verify PDF generation works"""
@@ -344,9 +3221,7 @@ def test_pdf_generation():
         </html>
         """
 
-        from weasyprint import HTML
-        html_obj = HTML(string=test_html)
-        pdf_bytes = html_obj.write_pdf()
+        pdf_bytes, _ = render_pdf(test_html)
 
         pdf_base64 = base64.b64encode(pdf_bytes).decode('utf-8')
 
@@ -366,225 +3241,420 @@ def test_pdf_generation():
             'message': 'PDF generation is not working'
         }), 500
 
-@app.route('/image-to-pdf', methods=['POST'])
-def image_to_pdf():
-    """
-    Convert image directly to PDF (supports all formats including HEIC)
+image_executor = None
+image_executor_pid = None
+image_executor_lock = threading.Lock()
 
-    Accepts both JSON and form data.
+# Settings every image of an /image-to-pdf request can override
+IMAGE_PAGE_SETTINGS = ('page_size', 'fit', 'orientation', 'max_dimension', 'quality', 'passthrough')
 
-    Expected body:
-    {
-        "image_base64": "base64 encoded image",
-        "filename": "optional filename",
-        "page_size": "A4|Letter|A3" (optional, default: A4),
-        "fit": "contain|cover|stretch" (optional, default: contain),
-        "orientation": "portrait|landscape" (optional, default: portrait),
-        "max_dimension": integer (optional, max width/height in pixels, default: 2400),
-        "quality": 1-100 (optional, JPEG quality %, default: 85)
-    }
-    """
+# Formats whose frames are separate pages; other multi-frame images (MPO
+# depth maps, animated GIFs) only give their first frame unless asked
+MULTI_PAGE_IMAGE_FORMATS = ('TIFF', 'HEIF')
+
+
+def get_image_executor():
+    """Per-process thread pool that decodes and resizes /image-to-pdf pages"""
+    global image_executor, image_executor_pid
+    with image_executor_lock:
+        if image_executor is None or image_executor_pid != os.getpid():
+            image_executor = ThreadPoolExecutor(max_workers=IMAGE_THREADS, thread_name_prefix='image')
+            image_executor_pid = os.getpid()
+        return image_executor
+
+
+@lru_cache(maxsize=None)
+def register_heif():
+    """Register the HEIF/HEIC opener with Pillow, once per process"""
     try:
-        logger.info('=== image_to_pdf called ===')
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+        logger.info('HEIF support enabled')
+        return True
+    except Exception as e:
+        logger.warning(f'HEIF support not available: {str(e)}')
+        return False
 
-        # Accept both JSON and form data
-        if request.is_json:
-            data = request.get_json()
-        else:
-            data = request.form.to_dict()
 
-        if not data or 'image_base64' not in data:
-            return jsonify({'success': False, 'error': 'image_base64 required'}), 400
+def image_page_settings(data, defaults=None):
+    """Validated page settings from a request or one of its images, on top of defaults"""
+    settings = dict(defaults or {})
+    settings.update({key: data[key] for key in IMAGE_PAGE_SETTINGS if data.get(key) not in (None, '')})
+
+    settings['page_size'] = str(settings.get('page_size', 'A4')).upper()
+    settings['fit'] = settings.get('fit', 'contain')
+    settings['orientation'] = settings.get('orientation', 'portrait')
+    try:
+        settings['max_dimension'] = int(settings.get('max_dimension', 2400))
+        # JPEG quality, clamped between 1-100
+        settings['quality'] = max(1, min(100, int(settings.get('quality', 85))))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'Invalid max_dimension or quality: {str(e)}')
+    settings['passthrough'] = str(settings.get('passthrough', True)).lower() in ('1', 'true', 'yes')
+    return settings
 
-        image_base64 = data.get('image_base64', '')
-        filename = data.get('filename', 'image.pdf')
-        page_size = data.get('page_size', 'A4').upper()
-        fit_mode = data.get('fit', 'contain')
-        orientation = data.get('orientation', 'portrait')
 
-        # Optimization parameters (optional)
-        max_dimension = int(data.get('max_dimension', 2400))  # Max width/height in pixels
-        quality = int(data.get('quality', 85))  # JPEG quality 1-100
+def image_inputs(data):
+    """
+    Collect the images of an /image-to-pdf request, in order
+
+    Returns dicts with name, data (base64 string or stream), settings
+    (see IMAGE_PAGE_SETTINGS) and frames (a page selection of a
+    multi-frame image). Accepts:
+    - "images": list of base64 strings or {"image_base64", "name",
+      "frames", <settings>} objects
+    - repeated "images" file parts
+    - a single image as "image_base64", an "image" file part or a raw
+      image/* body
+    Raises ValueError for malformed entries.
+    """
+    defaults = image_page_settings(data)
+
+    uploads = request.files.getlist('images')
+    if uploads:
+        return [
+            {'name': upload.filename or f'Image {idx + 1}', 'data': upload.stream, 'settings': defaults, 'frames': None}
+            for idx, upload in enumerate(uploads)
+        ]
+
+    entries = data.get('images')
+    if isinstance(entries, str):
+        entries = json.loads(entries)
+    if entries:
+        if not isinstance(entries, list):
+            raise ValueError('images must be an array')
+        inputs = []
+        for idx, entry in enumerate(entries):
+            if isinstance(entry, str):
+                entry = {'image_base64': entry}
+            if not isinstance(entry, dict) or not entry.get('image_base64'):
+                raise ValueError(f'images[{idx}] must be a base64 string or an object with image_base64')
+            inputs.append({
+                'name': entry.get('name') or f'Image {idx + 1}',
+                'data': entry['image_base64'],
+                'settings': image_page_settings(entry, defaults),
+                'frames': entry.get('frames')
+            })
+        return inputs
+
+    # Image from upload, raw image/* body or base64
+    image_stream = open_binary_input(data, 'image_base64', 'image', ('image/*', 'application/octet-stream'))
+    if image_stream is None:
+        return []
+    return [{'name': 'Image 1', 'data': image_stream, 'settings': defaults, 'frames': data.get('frames')}]
+
 
-        # Validate quality parameter
-        quality = max(1, min(100, quality))  # Clamp between 1-100
+def image_page_tasks(inputs):
+    """
+    Yield one task per output page: the image bytes, frame number and settings
 
-        logger.info(f'Converting image to PDF: page_size={page_size}, fit={fit_mode}, orientation={orientation}, max_dimension={max_dimension}, quality={quality}')
+    Each input is read only when the pages before it have been queued, and
+    its frames are counted without being decoded. All frames of one input
+    share its bytes, so they can be decoded in parallel.
+    """
+    from PIL import Image
 
-        # Decode base64 image
+    for idx, item in enumerate(inputs):
         try:
-            image_bytes = base64.b64decode(image_base64)
+            source = item['data']
+            if isinstance(source, str):
+                with stage_timer('decode'):
+                    source = base64.b64decode(source)
+            else:
+                source.seek(0)
+                source = source.read()
+
+            image = Image.open(io.BytesIO(source))
+            frame_count = getattr(image, 'n_frames', 1)
+            image_format = image.format
+            image.close()
         except Exception as e:
-            return jsonify({
-                'success': False,
-                'error': f'Invalid base64 image: {str(e)}'
-            }), 400
+            raise ValueError(f'Failed to open image {idx + 1} ({item["name"]}): {str(e)}. Format may not be supported.')
 
-        from PIL import Image
-        from io import BytesIO
-        from reportlab.pdfgen import canvas
-        from reportlab.lib.pagesizes import A4, LETTER, A3, landscape, portrait
-        from reportlab.lib.utils import ImageReader
+        try:
+            frames = parse_page_selection(item.get('frames'), frame_count)
+        except ValueError as e:
+            raise ValueError(f'Image {idx + 1} ({item["name"]}) frames: {str(e)}')
+        if frames is None:
+            frames = range(frame_count) if image_format in MULTI_PAGE_IMAGE_FORMATS else [0]
+
+        # The page is prepared in a pool thread, outside of the request context
+        endpoint = metric_endpoint()
+        for frame in frames:
+            yield {
+                'index': idx, 'name': item['name'], 'data': source, 'frame': frame,
+                'settings': item['settings'], 'endpoint': endpoint
+            }
+
+
+def jpeg_passthrough_allowed(img, data, settings):
+    """
+    Check whether a JPEG can be embedded as it is, without decoding it
+
+    It must be a plain baseline or progressive JPEG in RGB or greyscale,
+    already upright (no EXIF rotation) and within max_dimension. Only the
+    headers are read.
+    """
+    from reportlab.pdfbase.pdfutils import readJPEGInfo
+
+    if not settings['passthrough'] or img.format != 'JPEG' or img.mode not in ('RGB', 'L'):
+        return False
+    max_dimension = settings['max_dimension']
+    if max_dimension > 0 and max(img.size) > max_dimension:
+        return False
+    if img.getexif().get(0x0112, 1) != 1:
+        return False
+    try:
+        # The markers reportlab can embed as DCTDecode, with 1 or 3 components
+        return readJPEGInfo(io.BytesIO(data))[2] in (1, 3)
+    except Exception:
+        return False
 
-        # Try to register HEIF support
+
+def prepare_image_page(task):
+    """
+    Decode one image frame and encode it for the PDF (runs in the image thread pool)
+
+    Applies the EXIF orientation, converts to RGB or greyscale, scales
+    down to max_dimension and encodes as JPEG. Returns a dict with the
+    JPEG bytes, the final pixel size and whether the original JPEG was
+    passed through: JPEGs that need none of those steps are embedded
+    unchanged, which saves the decode and the quality loss of encoding
+    them a second time.
+    """
+    from PIL import Image, ImageOps
+
+    settings = task['settings']
+    with stage_timer('decode', task['endpoint']):
+        img = Image.open(io.BytesIO(task['data']))
+        if task['frame']:
+            img.seek(task['frame'])
+        elif jpeg_passthrough_allowed(img, task['data'], settings):
+            return {'image': task['data'], 'width': img.width, 'height': img.height, 'passthrough': True}
+
+        # Output size, from the full-resolution size before anything is decoded
+        img_width, img_height = img.size
+        max_dimension = settings['max_dimension']
+        target = None
+        if max_dimension > 0 and (img_width > max_dimension or img_height > max_dimension):
+            ratio = min(max_dimension / img_width, max_dimension / img_height)
+            target = (int(img_width * ratio), int(img_height * ratio))
+            # JPEGs decode straight at 1/2, 1/4 or 1/8 scale, never below target,
+            # so a 48 MP photo is never held at full resolution
+            img.draft(None, target)
+
+        # Handle EXIF orientation (important for iPhone photos)
         try:
-            from pillow_heif import register_heif_opener
-            register_heif_opener()
-            logger.info('HEIF support enabled')
+            decoded_size = img.size
+            img = ImageOps.exif_transpose(img)
+            if target and img.size != decoded_size:
+                target = (target[1], target[0])
         except Exception as e:
-            logger.warning(f'HEIF support not available: {str(e)}')
+            logger.warning(f'Could not apply EXIF orientation: {str(e)}')
+
+        # Convert to RGB if necessary (for RGBA, CMYK, etc.)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+
+        if target:
+            # reducing_gap box-reduces by an integer factor first (cheap), then
+            # LANCZOS covers the last factor of at most 3
+            decoded_width, decoded_height = img.size
+            img = img.resize(target, Image.Resampling.LANCZOS, reducing_gap=3.0)
+            logger.info(f'Resized image from {img_width}x{img_height} (decoded at {decoded_width}x{decoded_height}) '
+                        f'to {target[0]}x{target[1]}')
+            img_width, img_height = target
+        else:
+            img_width, img_height = img.size
 
-        # Open image with Pillow (supports HEIC, PNG, JPEG, etc.)
-        try:
-            img = Image.open(BytesIO(image_bytes))
+    img_buffer = io.BytesIO()
+    with stage_timer('serialize', task['endpoint']):
+        img.save(img_buffer, format='JPEG', quality=settings['quality'], optimize=True)
+    return {'image': img_buffer.getvalue(), 'width': img_width, 'height': img_height, 'passthrough': False}
+
+
+def image_page_size(settings, img_width, img_height):
+    """Page size in points for an image's page_size and orientation ("auto" follows the image)"""
+    from reportlab.lib.pagesizes import A4, LETTER, A3, landscape, portrait
 
-            # Handle EXIF orientation (important for iPhone photos)
+    base_page_size = {'A4': A4, 'LETTER': LETTER, 'A3': A3}.get(settings['page_size'], A4)
+    orientation = settings['orientation']
+    if orientation == 'auto':
+        orientation = 'landscape' if img_width > img_height else 'portrait'
+    return landscape(base_page_size) if orientation == 'landscape' else portrait(base_page_size)
+
+
+def image_placement(fit_mode, img_width, img_height, page_width, page_height):
+    """(x, y, width, height) of an image on the page for a fit mode"""
+    img_aspect = img_width / img_height
+    page_aspect = page_width / page_height
+
+    if fit_mode == 'contain':
+        # Fit image within page maintaining aspect ratio
+        if img_aspect > page_aspect:
+            # Image is wider - fit to width
+            return 0, (page_height - page_width / img_aspect) / 2, page_width, page_width / img_aspect
+        # Image is taller - fit to height
+        return (page_width - page_height * img_aspect) / 2, 0, page_height * img_aspect, page_height
+
+    if fit_mode == 'cover':
+        # Fill entire page, may crop image
+        if img_aspect < page_aspect:
+            # Image is taller - fit to width
+            return 0, (page_height - page_width / img_aspect) / 2, page_width, page_width / img_aspect
+        # Image is wider - fit to height
+        return (page_width - page_height * img_aspect) / 2, 0, page_height * img_aspect, page_height
+
+    # Stretch to fill page (may distort)
+    return 0, 0, page_width, page_height
+
+
+def images_to_pdf(inputs, output):
+    """
+    Write every page of the inputs into one reportlab canvas on output
+
+    Pages are decoded in the image thread pool, at most 2 * IMAGE_THREADS
+    ahead of the canvas, which draws them strictly in order. Returns a
+    list with the image and page dimensions of every page. Raises
+    ValueError naming the image that failed.
+    """
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.utils import ImageReader
+
+    executor = get_image_executor()
+    tasks = image_page_tasks(inputs)
+    ahead = deque()
+
+    def submit_next():
+        for task in tasks:
+            ahead.append((task, executor.submit(prepare_image_page, task)))
+            return
+
+    pages = []
+    pdf_canvas = canvas.Canvas(output)
+    try:
+        for _ in range(2 * IMAGE_THREADS):
+            submit_next()
+
+        while ahead:
+            task, future = ahead.popleft()
             try:
-                from PIL import ImageOps
-                img = ImageOps.exif_transpose(img)
-                logger.info('Applied EXIF orientation correction')
+                page = future.result()
             except Exception as e:
-                logger.warning(f'Could not apply EXIF orientation: {str(e)}')
+                raise ValueError(f'Failed to open image {task["index"] + 1} ({task["name"]}): {str(e)}. Format may not be supported.')
+            del task['data']
+            submit_next()
+
+            settings = task['settings']
+            page_width, page_height = image_page_size(settings, page['width'], page['height'])
+            x, y, draw_width, draw_height = image_placement(
+                settings['fit'], page['width'], page['height'], page_width, page_height)
+
+            with stage_timer('render'):
+                pdf_canvas.setPageSize((page_width, page_height))
+                pdf_canvas.drawImage(ImageReader(io.BytesIO(page['image'])), x, y, width=draw_width, height=draw_height)
+                pdf_canvas.showPage()
+            pages.append({
+                'image_dimensions': {'width': page['width'], 'height': page['height']},
+                'page_dimensions': {'width': float(page_width), 'height': float(page_height)},
+                'passthrough': page['passthrough']
+            })
+    except Exception:
+        for _, future in ahead:
+            future.cancel()
+        raise
 
-            # Convert to RGB if necessary (for RGBA, CMYK, etc.)
-            if img.mode not in ('RGB', 'L'):
-                logger.info(f'Converting image from {img.mode} to RGB')
-                img = img.convert('RGB')
+    with stage_timer('serialize'):
+        pdf_canvas.save()
+    return pages
 
-            img_width, img_height = img.size
-            logger.info(f'Image size: {img_width}x{img_height}, mode: {img.mode}')
-        except Exception as e:
-            return jsonify({
-                'success': False,
-                'error': f'Failed to open image: {str(e)}. Format may not be supported.'
-            }), 400
 
-        # Define page sizes
-        page_sizes = {
-            'A4': A4,
-            'LETTER': LETTER,
-            'A3': A3
-        }
+@app.route('/image-to-pdf', methods=['POST'])
+@async_job
+def image_to_pdf():
+    """
+    Convert images directly to a PDF (supports all formats including HEIC)
 
-        base_page_size = page_sizes.get(page_size, A4)
+    Accepts both JSON and form data. Every image becomes one page, multi-page
+    TIFF and HEIC files one page per frame.
 
-        # Apply orientation
-        if orientation == 'landscape':
-            page_width, page_height = landscape(base_page_size)
-        else:
-            page_width, page_height = portrait(base_page_size)
-
-        logger.info(f'PDF page size: {page_width}x{page_height}')
-
-        # Calculate image placement based on fit mode
-        if fit_mode == 'contain':
-            # Fit image within page maintaining aspect ratio
-            img_aspect = img_width / img_height
-            page_aspect = page_width / page_height
-
-            if img_aspect > page_aspect:
-                # Image is wider - fit to width
-                draw_width = page_width
-                draw_height = page_width / img_aspect
-                x = 0
-                y = (page_height - draw_height) / 2
-            else:
-                # Image is taller - fit to height
-                draw_height = page_height
-                draw_width = page_height * img_aspect
-                x = (page_width - draw_width) / 2
-                y = 0
-
-        elif fit_mode == 'cover':
-            # Fill entire page, may crop image
-            img_aspect = img_width / img_height
-            page_aspect = page_width / page_height
-
-            if img_aspect < page_aspect:
-                # Image is taller - fit to width
-                draw_width = page_width
-                draw_height = page_width / img_aspect
-                x = 0
-                y = (page_height - draw_height) / 2
-            else:
-                # Image is wider - fit to height
-                draw_height = page_height
-                draw_width = page_height * img_aspect
-                x = (page_width - draw_width) / 2
-                y = 0
-
-        else:  # stretch
-            # Stretch to fill page (may distort)
-            draw_width = page_width
-            draw_height = page_height
-            x = 0
-            y = 0
-
-        # Create PDF with image
-        packet = BytesIO()
-        pdf_canvas = canvas.Canvas(packet, pagesize=(page_width, page_height))
-
-        # Convert PIL Image to something reportlab can use
-        # Optimize: Use JPEG for photos, PNG for graphics
-        img_buffer = BytesIO()
-
-        # Determine optimal format and quality
-        if img.mode == 'RGB' or img.mode == 'L':
-            # For photos, use JPEG with configurable quality optimization
-            # Scale down if image is very large (based on max_dimension parameter)
-            if max_dimension > 0 and (img_width > max_dimension or img_height > max_dimension):
-                ratio = min(max_dimension / img_width, max_dimension / img_height)
-                new_width = int(img_width * ratio)
-                new_height = int(img_height * ratio)
-                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                logger.info(f'Resized image from {img_width}x{img_height} to {new_width}x{new_height}')
-                img_width, img_height = new_width, new_height
-
-            img.save(img_buffer, format='JPEG', quality=quality, optimize=True)
-            logger.info(f'Saved as optimized JPEG (quality={quality})')
+    Expected body:
+    {
+        "image_base64": "base64 encoded image",
+        OR "images": ["base64", {"image_base64": "...", "fit": "cover", "frames": "1-2"}, ...],
+        "filename": "optional filename",
+        "page_size": "A4|Letter|A3" (optional, default: A4),
+        "fit": "contain|cover|stretch" (optional, default: contain),
+        "orientation": "portrait|landscape|auto" (optional, default: portrait),
+        "max_dimension": integer (optional, max width/height in pixels, default: 2400),
+        "quality": 1-100 (optional, JPEG quality %, default: 85),
+        "passthrough": true (optional, embed fitting JPEGs unchanged)
+    }
+
+    page_size, fit, orientation, max_dimension, quality and passthrough
+    apply to every image and can be overridden per image.
+    """
+    try:
+        logger.info('=== image_to_pdf called ===')
+
+        # Accept both JSON and form data
+        if request.is_json:
+            data = request.get_json() or {}
         else:
-            # For graphics/transparency, use PNG
-            img.save(img_buffer, format='PNG', optimize=True)
-            logger.info('Saved as optimized PNG')
+            data = get_form_data()
 
-        img_buffer.seek(0)
+        try:
+            inputs = image_inputs(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
 
-        # Draw image on canvas
-        pdf_canvas.drawImage(ImageReader(img_buffer), x, y, width=draw_width, height=draw_height)
-        pdf_canvas.save()
+        if not inputs:
+            return jsonify({'success': False, 'error': 'image_base64 or images required'}), 400
 
-        # Get PDF bytes
-        packet.seek(0)
-        pdf_bytes = packet.getvalue()
+        filename = data.get('filename', 'image.pdf')
 
-        # Encode to base64
-        pdf_base64 = base64.b64encode(pdf_bytes).decode('utf-8')
+        logger.info(f'Converting {len(inputs)} images to PDF: {inputs[0]["settings"]}')
 
-        logger.info(f'Successfully converted image to PDF: {filename} ({len(pdf_bytes)} bytes)')
+        register_heif()
 
-        return jsonify({
-            'success': True,
-            'pdf_base64': pdf_base64,
-            'pdf_size': len(pdf_bytes),
-            'filename': filename,
-            'image_dimensions': {'width': img_width, 'height': img_height},
-            'page_dimensions': {'width': float(page_width), 'height': float(page_height)}
-        }), 200
+        output = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        try:
+            pages = images_to_pdf(inputs, output)
+        except ValueError as e:
+            output.close()
+            return jsonify({'success': False, 'error': str(e)}), 400
+        output.seek(0)
+        observe_pages(len(pages))
+
+        passthrough_pages = sum(1 for page in pages if page['passthrough'])
+        logger.info(f'Successfully converted {len(inputs)} images to PDF: {filename} '
+                    f'({len(pages)} pages, {passthrough_pages} JPEGs passed through, {stream_size(output)} bytes)')
+
+        return pdf_file_response(
+            output, filename, wants_binary(data),
+            image_dimensions=pages[0]['image_dimensions'],
+            page_dimensions=pages[0]['page_dimensions'],
+            page_count=len(pages),
+            passthrough=passthrough_pages == len(pages),
+            passthrough_pages=passthrough_pages
+        )
 
     except Exception as e:
         logger.error(f'Error converting image to PDF: {str(e)}', exc_info=True)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/pdf/merge', methods=['POST'])
+@async_job
 def merge_pdfs():
     """
     Merge multiple PDFs into one
 
-    Accepts both JSON and form data.
+    Accepts both JSON and form data. Takes the same inputs as /merge-pdf
+    (see merge_inputs), each input can select pages.
 
     Expected body:
     {
-        "pdfs": ["base64_pdf1", "base64_pdf2", ...],
+        "pdfs": ["base64_pdf1", {"pdf_base64": "base64_pdf2", "pages": "1-3"}, ...],
         "filename": "optional filename"
     }
     """
@@ -593,77 +3663,250 @@ def merge_pdfs():
 
         # Accept both JSON and form data
         if request.is_json:
-            data = request.get_json()
+            data = request.get_json() or {}
         else:
-            data = request.form.to_dict()
-            # Parse pdfs array from form data if it's a JSON string
-            if 'pdfs' in data and isinstance(data['pdfs'], str):
-                import json
-                data['pdfs'] = json.loads(data['pdfs'])
+            data = get_form_data()
+
+        try:
+            inputs = merge_inputs(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
 
-        if not data or 'pdfs' not in data:
+        if not inputs:
             return jsonify({'success': False, 'error': 'pdfs array required'}), 400
 
-        pdfs = data.get('pdfs', [])
         filename = data.get('filename', 'merged.pdf')
 
-        if not pdfs or len(pdfs) < 2:
+        # A single input is fine when it only selects pages
+        if len(inputs) < 2 and not inputs[0]['pages']:
             return jsonify({'success': False, 'error': 'At least 2 PDFs required'}), 400
 
-        from pypdf import PdfReader, PdfWriter
-        from io import BytesIO
+        try:
+            merged, page_count, bytes_saved = merge_documents(inputs)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
 
-        pdf_writer = PdfWriter()
+        logger.info(f'Successfully merged {len(inputs)} PDFs: {filename} ({stream_size(merged)} bytes)')
 
-        # Merge all PDFs
-        for idx, pdf_base64 in enumerate(pdfs):
-            try:
-                pdf_bytes = base64.b64decode(pdf_base64)
-                pdf_reader = PdfReader(BytesIO(pdf_bytes))
+        return pdf_file_response(
+            merged, filename, wants_binary(data),
+            page_count=page_count,
+            bytes_saved=bytes_saved
+        )
 
-                for page in pdf_reader.pages:
-                    pdf_writer.add_page(page)
+    except Exception as e:
+        logger.error(f'Error merging PDFs: {str(e)}', exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-                logger.info(f'Added PDF {idx + 1}: {len(pdf_reader.pages)} pages')
-            except Exception as e:
-                return jsonify({
-                    'success': False,
-                    'error': f'Error processing PDF {idx + 1}: {str(e)}'
-                }), 400
+def page_footprint(page):
+    """
+    Estimated output size of a page and every object it needs
 
-        # Write merged PDF
-        output = BytesIO()
-        pdf_writer.write(output)
-        merged_bytes = output.getvalue()
+    Returns {(idnum, generation): bytes}. Stream sizes are their encoded
+    length, other objects are measured by serializing them. Used to pack
+    pages into parts for split mode "size": objects shared by several
+    pages of a part count only once.
+    """
+    from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+    def measure(obj):
+        if isinstance(obj, StreamObject):
+            return len(obj._data) + 100
+        buffer = io.BytesIO()
+        obj.write_to_stream(buffer)
+        return len(buffer.getvalue()) + 20
+
+    ref = page.indirect_reference
+    sizes = {(ref.idnum, ref.generation): measure(page)}
+    stack = [value for key, value in page.items() if key != '/Parent']
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, IndirectObject):
+            key = (obj.idnum, obj.generation)
+            if key in sizes:
+                continue
+            target = obj.get_object()
+            if target is None or (isinstance(target, DictionaryObject)
+                                  and target.get('/Type') in ('/Page', '/Pages')):
+                sizes[key] = 0
+                continue
+            sizes[key] = measure(target)
+            stack.append(target)
+        elif isinstance(obj, DictionaryObject):
+            stack.extend(obj.values())
+        elif isinstance(obj, ArrayObject):
+            stack.extend(obj)
+    return sizes
+
+
+def split_prefix(data):
+    """filename_prefix reduced to a safe file name, it ends up in headers and ZIP member names"""
+    return safe_filename(data.get('filename_prefix'), 'split')
+
+
+def split_plan(reader, data):
+    """
+    Work out the parts of a split as dicts with filename and 1-based pages
 
-        merged_base64 = base64.b64encode(merged_bytes).decode('utf-8')
+    Modes: "pages" (one part per listed page, default all), "ranges"
+    ([start, end] pairs), "every" (pages_per_part pages each), "bookmarks"
+    (one part per top-level bookmark) and "size" (consecutive pages packed
+    up to max_part_size bytes). Out-of-range pages and ranges are skipped.
+    Raises ValueError for missing or invalid mode parameters.
+    """
+    mode = data.get('mode', 'pages')
+    prefix = split_prefix(data)
+    total_pages = len(reader.pages)
+    parts = []
 
-        logger.info(f'Successfully merged {len(pdfs)} PDFs: {filename} ({len(merged_bytes)} bytes)')
+    def consecutive(start, end):
+        return {'filename': f'{prefix}_pages_{start}-{end}.pdf', 'pages': list(range(start, end + 1))}
 
-        return jsonify({
-            'success': True,
-            'pdf_base64': merged_base64,
-            'pdf_size': len(merged_bytes),
-            'filename': filename,
-            'page_count': len(pdf_writer.pages)
-        }), 200
+    if mode == 'pages':
+        for page_num in data.get('pages') or range(1, total_pages + 1):
+            if 1 <= page_num <= total_pages:
+                parts.append({'filename': f'{prefix}_page_{page_num}.pdf', 'pages': [page_num]})
+
+    elif mode == 'ranges':
+        ranges = data.get('ranges', [])
+        if not ranges:
+            raise ValueError('ranges required for mode=ranges')
+        for start, end in (page_range[:2] for page_range in ranges):
+            if 1 <= start <= end <= total_pages:
+                parts.append({'filename': f'{prefix}_range_{start}-{end}.pdf', 'pages': list(range(start, end + 1))})
+
+    elif mode == 'every':
+        try:
+            per_part = int(data.get('pages_per_part', 0))
+        except (TypeError, ValueError):
+            per_part = 0
+        if per_part < 1:
+            raise ValueError('pages_per_part (positive integer) required for mode=every')
+        for start in range(1, total_pages + 1, per_part):
+            parts.append(consecutive(start, min(start + per_part - 1, total_pages)))
+
+    elif mode == 'bookmarks':
+        starts = {}
+        for item in reader.outline:
+            # Nested lists are the children of the previous bookmark
+            if isinstance(item, list):
+                continue
+            page_index = reader.get_destination_page_number(item)
+            if page_index is not None and page_index >= 0:
+                starts.setdefault(page_index, item.title or '')
+        if not starts:
+            raise ValueError('PDF has no bookmarks pointing to pages')
+
+        # Pages before the first bookmark go into the first part
+        indices = sorted(starts)
+        ends = indices[1:] + [total_pages]
+        for number, (start, end) in enumerate(zip([0] + indices[1:], ends), 1):
+            slug = re.sub(r'[^\w.-]+', '_', starts[indices[number - 1]]).strip('_') or 'part'
+            parts.append({
+                'filename': f'{prefix}_{number:02d}_{slug}.pdf',
+                'pages': list(range(start + 1, end + 1)),
+                'bookmark': starts[indices[number - 1]]
+            })
+
+    elif mode == 'size':
+        try:
+            budget = int(data.get('max_part_size', 0))
+        except (TypeError, ValueError):
+            budget = 0
+        if budget < 1:
+            raise ValueError('max_part_size (bytes) required for mode=size')
+
+        # Greedy: a page that alone exceeds the budget becomes its own part
+        start, part_objects, part_size = 1, set(), 0
+        for page_num, page in enumerate(reader.pages, 1):
+            footprint = page_footprint(page)
+            added = sum(size for key, size in footprint.items() if key not in part_objects)
+            if part_objects and part_size + added > budget:
+                parts.append(consecutive(start, page_num - 1))
+                start, part_objects, part_size = page_num, set(), 0
+                added = sum(footprint.values())
+            part_objects.update(footprint)
+            part_size += added
+        parts.append(consecutive(start, total_pages))
+
+    else:
+        raise ValueError(f'Unknown mode: {mode} (use pages, ranges, every, bookmarks or size)')
+
+    return parts
+
+
+def write_split_part(reader, pages):
+    """Copy the given 1-based pages of reader into a new PDF, return its bytes"""
+    output = io.BytesIO()
+    with stage_timer('serialize'):
+        writer = MergeWriter(output)
+        writer.add_document(reader, [page_num - 1 for page_num in pages])
+        writer.finish()
+    return output.getvalue()
+
+
+def iter_split_parts(reader, parts):
+    """Yield (part, pdf_bytes or exception) for every planned part, one at a time"""
+    for part in parts:
+        try:
+            yield part, write_split_part(reader, part['pages'])
+        except Exception as e:
+            logger.error(f'Error writing split part {part["filename"]}: {str(e)}')
+            yield part, e
+
+
+def stream_split_zip(reader, parts):
+    """ZIP body for a split, one member per part as it is written"""
+    stream = ZipStream()
+    errors = []
+
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as archive:
+        for part, result in iter_split_parts(reader, parts):
+            if isinstance(result, Exception):
+                errors.append({'filename': part['filename'], 'pages': part['pages'], 'error': str(result)})
+            else:
+                archive.writestr(part['filename'], result)
+            yield stream.pop()
+
+        if errors:
+            archive.writestr('errors.json', json.dumps(errors, indent=2), compress_type=zipfile.ZIP_DEFLATED)
+
+    logger.info(f'Split finished: {len(parts) - len(errors)}/{len(parts)} parts written')
+    yield stream.pop()
+
+
+def stream_split_multipart(reader, parts, boundary):
+    """multipart/mixed body for a split, one application/pdf part per part as it is written"""
+    for part, result in iter_split_parts(reader, parts):
+        headers = [f'--{boundary}']
+        if isinstance(result, Exception):
+            result = json.dumps({'success': False, 'filename': part['filename'], 'error': str(result)}).encode()
+            headers.append('Content-Type: application/json')
+        else:
+            headers.append('Content-Type: application/pdf')
+            headers.append(f'Content-Disposition: attachment; filename="{part["filename"]}"')
+        headers.append(f'X-Pages: {part["pages"][0]}-{part["pages"][-1]}')
+        yield ('\r\n'.join(headers) + '\r\n\r\n').encode() + result + b'\r\n'
+    yield f'--{boundary}--\r\n'.encode()
 
-    except Exception as e:
-        logger.error(f'Error merging PDFs: {str(e)}', exc_info=True)
-        return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/pdf/split', methods=['POST'])
+@async_job
 def split_pdf():
     """
     Split PDF into multiple PDFs or extract specific pages
 
-    Accepts both JSON and form data.
+    Accepts both JSON and form data. The source is parsed once, each part
+    copies its pages and their objects without re-encoding (MergeWriter).
 
     Expected body:
     {
         "pdf_base64": "base64 encoded PDF",
-        "mode": "pages" or "ranges",
+        "mode": "pages", "ranges", "every", "bookmarks" or "size",
         "pages": [1, 3, 5] or "ranges": [[1,3], [4,6]],
+        "pages_per_part": 10 (mode every),
+        "max_part_size": 5000000 (mode size, bytes),
+        "output": "json" (default), "zip" or "multipart",
         "filename_prefix": "optional prefix"
     }
     """
@@ -671,83 +3914,66 @@ def split_pdf():
         logger.info('=== split_pdf called ===')
 
         if request.is_json:
-            data = request.get_json()
+            data = request.get_json() or {}
         else:
-            data = request.form.to_dict()
+            data = get_form_data()
             # Parse arrays from form data
             if 'pages' in data and isinstance(data['pages'], str):
-                import json
                 data['pages'] = json.loads(data['pages'])
             if 'ranges' in data and isinstance(data['ranges'], str):
-                import json
                 data['ranges'] = json.loads(data['ranges'])
 
-        if not data or 'pdf_base64' not in data:
-            return jsonify({'success': False, 'error': 'pdf_base64 required'}), 400
-
-        pdf_base64 = data.get('pdf_base64', '')
-        mode = data.get('mode', 'pages')
-        pages = data.get('pages', [])
-        ranges = data.get('ranges', [])
-        filename_prefix = data.get('filename_prefix', 'split')
-
-        from pypdf import PdfReader, PdfWriter
-        from io import BytesIO
-
-        pdf_bytes = base64.b64decode(pdf_base64)
-        pdf_reader = PdfReader(BytesIO(pdf_bytes))
-        total_pages = len(pdf_reader.pages)
-
-        result_pdfs = []
-
-        if mode == 'pages':
-            # Split by individual pages
-            if not pages:
-                pages = list(range(1, total_pages + 1))
-
-            for page_num in pages:
-                if page_num < 1 or page_num > total_pages:
-                    continue
-
-                pdf_writer = PdfWriter()
-                pdf_writer.add_page(pdf_reader.pages[page_num - 1])
-
-                output = BytesIO()
-                pdf_writer.write(output)
-                pdf_bytes_out = output.getvalue()
-
-                result_pdfs.append({
-                    'pdf_base64': base64.b64encode(pdf_bytes_out).decode('utf-8'),
-                    'filename': f'{filename_prefix}_page_{page_num}.pdf',
-                    'pages': [page_num],
-                    'size': len(pdf_bytes_out)
-                })
+        try:
+            pdf_stream = open_pdf_input(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
 
-        elif mode == 'ranges':
-            # Split by page ranges
-            if not ranges:
-                return jsonify({'success': False, 'error': 'ranges required for mode=ranges'}), 400
+        if pdf_stream is None:
+            return jsonify({'success': False, 'error': 'pdf_base64 required'}), 400
 
-            for idx, page_range in enumerate(ranges):
-                start, end = page_range[0], page_range[1]
+        output = data.get('output', 'json')
+        if output not in ('json', 'zip', 'multipart'):
+            return jsonify({'success': False, 'error': 'output must be json, zip or multipart'}), 400
 
-                if start < 1 or end > total_pages or start > end:
-                    continue
+        from pypdf import PdfReader
 
-                pdf_writer = PdfWriter()
-                for page_num in range(start - 1, end):
-                    pdf_writer.add_page(pdf_reader.pages[page_num])
+        with stage_timer('parse'):
+            pdf_reader = PdfReader(pdf_stream)
+            total_pages = len(pdf_reader.pages)
+        observe_pages(total_pages)
 
-                output = BytesIO()
-                pdf_writer.write(output)
-                pdf_bytes_out = output.getvalue()
+        try:
+            parts = split_plan(pdf_reader, data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        logger.info(f'Splitting {total_pages} pages into {len(parts)} parts ({output})')
+
+        if output != 'json':
+            if output == 'zip':
+                body = stream_split_zip(pdf_reader, parts)
+                response = Response(stream_with_context(body), mimetype='application/zip')
+                filename = f'{split_prefix(data)}.zip'
+                response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+            else:
+                boundary = uuid.uuid4().hex
+                body = stream_split_multipart(pdf_reader, parts, boundary)
+                response = Response(stream_with_context(body), content_type=f'multipart/mixed; boundary={boundary}')
+            response.headers['X-Total-Pages'] = str(total_pages)
+            response.headers['X-Split-Count'] = str(len(parts))
+            return response
 
-                result_pdfs.append({
-                    'pdf_base64': base64.b64encode(pdf_bytes_out).decode('utf-8'),
-                    'filename': f'{filename_prefix}_range_{start}-{end}.pdf',
-                    'pages': list(range(start, end + 1)),
-                    'size': len(pdf_bytes_out)
-                })
+        result_pdfs = []
+        for part, pdf_bytes_out in iter_split_parts(pdf_reader, parts):
+            if isinstance(pdf_bytes_out, Exception):
+                raise pdf_bytes_out
+            with stage_timer('base64'):
+                encoded = base64.b64encode(pdf_bytes_out).decode('utf-8')
+            result_pdfs.append({
+                'pdf_base64': encoded,
+                **part,
+                'size': len(pdf_bytes_out)
+            })
 
         logger.info(f'Successfully split PDF into {len(result_pdfs)} parts')
 
@@ -762,7 +3988,127 @@ def split_pdf():
         logger.error(f'Error splitting PDF: {str(e)}', exc_info=True)
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def extract_text_pages(source, page_indices, options):
+    """
+    Text of the given 0-based pages of a PDF file or stream, as one dict per page
+
+    Word boxes, tables and layout-preserving text are only computed when
+    options asks for them; the plain text path does no extra work.
+    """
+    import pdfplumber
+
+    results = []
+    with stage_timer('parse'), pdfplumber.open(source) as pdf:
+        for page_idx in page_indices:
+            page = pdf.pages[page_idx]
+            result = {'page': page_idx + 1, 'text': page.extract_text(layout=options.get('layout', False)) or ''}
+            if options.get('words'):
+                result['words'] = [
+                    {
+                        'text': word['text'],
+                        'x0': round(word['x0'], 2),
+                        'top': round(word['top'], 2),
+                        'x1': round(word['x1'], 2),
+                        'bottom': round(word['bottom'], 2)
+                    }
+                    for word in page.extract_words()
+                ]
+            if options.get('tables'):
+                result['tables'] = page.extract_tables()
+            # Drop the parsed layout objects before the next page
+            page.close()
+            results.append(result)
+    return results
+
+
+def extract_text_shard(item):
+    """Process pool task: extract one shard of pages from the PDF at item['path']"""
+    return extract_text_pages(item['path'], item['pages'], item['options'])
+
+
+def iter_extracted_pages(pdf_stream, page_indices, options):
+    """
+    Yield the extracted pages in page order
+
+    Short documents are extracted in this thread. Longer ones are split
+    into shards of EXTRACT_SHARD_PAGES pages run on the process pool;
+    the PDF is written to a temp file once so the shards do not each get
+    a pickled copy. Finished shards are yielded as soon as every earlier
+    one is done. If the pool breaks down, the remaining shards (or a
+    shard the pool keeps crashing on) are extracted here instead.
+    """
+    shard_size = max(EXTRACT_SHARD_PAGES, 1)
+    shards = [page_indices[i:i + shard_size] for i in range(0, len(page_indices), shard_size)]
+
+    if len(shards) <= 1 or BATCH_PROCESSES <= 1:
+        if page_indices:
+            yield from extract_text_pages(pdf_stream, page_indices, options)
+        return
+
+    pdf_stream.seek(0)
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as pdf_file:
+        shutil.copyfileobj(pdf_stream, pdf_file)
+
+    try:
+        items = ({'path': pdf_file.name, 'pages': shard, 'options': options} for shard in shards)
+        results = iter_pool_results(extract_text_shard, items)
+        finished = {}
+        next_shard = 0
+        while next_shard < len(shards):
+            try:
+                index, result = next(results)
+            except StopIteration:
+                break
+            except Exception as e:
+                logger.warning(f'Text extraction pool failed, continuing in-process: {str(e)}')
+                for index in range(next_shard, len(shards)):
+                    if index in finished:
+                        yield from finished.pop(index)
+                    else:
+                        yield from extract_text_pages(pdf_file.name, shards[index], options)
+                return
+
+            if isinstance(result, BrokenProcessPool):
+                # The pool crashed on this shard even after a retry
+                logger.warning(f'Text extraction pool failed on shard {index + 1}, extracting it in-process')
+                result = extract_text_pages(pdf_file.name, shards[index], options)
+            elif isinstance(result, Exception):
+                raise ValueError(f'Failed to extract pages {shards[index][0] + 1}-{shards[index][-1] + 1}: {str(result)}')
+            finished[index] = result
+            while next_shard in finished:
+                yield from finished.pop(next_shard)
+                next_shard += 1
+    finally:
+        os.unlink(pdf_file.name)
+
+
+def stream_extracted_ndjson(pages, total_pages):
+    """NDJSON body for extract-text: one line per page in page order, then a summary line"""
+    extracted = 0
+    character_count = 0
+    try:
+        for result in pages:
+            extracted += 1
+            character_count += len(result['text'])
+            yield json.dumps(result) + '\n'
+    except Exception as e:
+        logger.error(f'Error extracting text: {str(e)}', exc_info=True)
+        mark_result_failed()
+        yield json.dumps({'success': False, 'error': str(e)}) + '\n'
+        return
+
+    logger.info(f'Extracted text from {extracted} pages')
+    yield json.dumps({
+        'done': True,
+        'total_pages': total_pages,
+        'pages_extracted': extracted,
+        'character_count': character_count
+    }) + '\n'
+
+
 @app.route('/pdf/extract-text', methods=['POST'])
+@async_job
+@cached_result
 def extract_text():
     """
     Extract text from PDF
@@ -772,67 +4118,245 @@ def extract_text():
     Expected body:
     {
         "pdf_base64": "base64 encoded PDF",
-        "pages": [1, 2, 3] or "all" (optional, defaults to all)
+        "pages": [1, 2, 3], "2-5,8" or "all" (optional, defaults to all),
+        "layout": false (optional, keep the visual layout with spaces),
+        "words": false (optional, add word bounding boxes),
+        "tables": false (optional, add detected tables as rows of cells),
+        "output": "json|ndjson" (optional, default: json)
     }
+
+    Long documents are extracted in parallel shards on the process pool.
+    NDJSON streams one line per page in page order, then a summary line.
     """
     try:
         logger.info('=== extract_text called ===')
 
         if request.is_json:
-            data = request.get_json()
+            data = request.get_json() or {}
         else:
-            data = request.form.to_dict()
+            data = get_form_data()
             if 'pages' in data and isinstance(data['pages'], str):
-                import json
                 try:
                     data['pages'] = json.loads(data['pages'])
-                except:
+                except (ValueError, TypeError):
+                    # Not JSON: "all" or a selection like "2-5,8", parsed below
                     pass
 
-        if not data or 'pdf_base64' not in data:
+        try:
+            pdf_stream = open_pdf_input(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        if pdf_stream is None:
             return jsonify({'success': False, 'error': 'pdf_base64 required'}), 400
 
-        pdf_base64 = data.get('pdf_base64', '')
+        output = data.get('output', 'json')
+        if output not in ('json', 'ndjson'):
+            return jsonify({'success': False, 'error': 'output must be json or ndjson'}), 400
+
+        options = {
+            key: str(data.get(key, False)).lower() in ('1', 'true', 'yes')
+            for key in ('layout', 'words', 'tables')
+        }
         pages_filter = data.get('pages', 'all')
 
-        import pdfplumber
-        from io import BytesIO
+        from pypdf import PdfReader
 
-        pdf_bytes = base64.b64decode(pdf_base64)
+        with stage_timer('parse'):
+            total_pages = len(PdfReader(pdf_stream).pages)
+        observe_pages(total_pages)
 
-        extracted_text = {}
-        full_text = ""
+        if pages_filter == 'all' or not pages_filter:
+            pages_to_extract = list(range(total_pages))
+        elif isinstance(pages_filter, list) and all(isinstance(p, int) for p in pages_filter):
+            pages_to_extract = [p - 1 for p in pages_filter if 0 < p <= total_pages]
+        else:
+            try:
+                pages_to_extract = parse_page_selection(pages_filter, total_pages)
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e)}), 400
 
-        with pdfplumber.open(BytesIO(pdf_bytes)) as pdf:
-            total_pages = len(pdf.pages)
+        pages = iter_extracted_pages(pdf_stream, pages_to_extract, options)
 
-            if pages_filter == 'all' or not pages_filter:
-                pages_to_extract = range(total_pages)
-            else:
-                pages_to_extract = [p - 1 for p in pages_filter if 0 < p <= total_pages]
+        if output == 'ndjson':
+            response = Response(stream_with_context(stream_extracted_ndjson(pages, total_pages)),
+                                mimetype='application/x-ndjson')
+            response.headers['X-Total-Pages'] = str(total_pages)
+            return response
 
-            for page_idx in pages_to_extract:
-                page = pdf.pages[page_idx]
-                text = page.extract_text() or ""
-                page_num = page_idx + 1
-                extracted_text[f'page_{page_num}'] = text
-                full_text += text + "\n\n"
+        extracted_text = {}
+        words = {}
+        tables = {}
+        for result in pages:
+            key = f'page_{result["page"]}'
+            extracted_text[key] = result['text']
+            if 'words' in result:
+                words[key] = result['words']
+            if 'tables' in result:
+                tables[key] = result['tables']
+
+        full_text = ''.join(text + '\n\n' for text in extracted_text.values())
 
         logger.info(f'Extracted text from {len(extracted_text)} pages')
 
-        return jsonify({
+        response = {
             'success': True,
             'text': full_text.strip(),
             'pages': extracted_text,
             'total_pages': total_pages,
             'character_count': len(full_text)
-        }), 200
-
+        }
+        if options['words']:
+            response['words'] = words
+        if options['tables']:
+            response['tables'] = tables
+        return jsonify(response), 200
+
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         logger.error(f'Error extracting text: {str(e)}', exc_info=True)
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# Page attributes a page inherits from its ancestors in the page tree
+INHERITABLE_PAGE_ATTRIBUTES = ('/MediaBox', '/CropBox', '/Rotate')
+
+
+def iter_page_tree(root, start=0, stop=None):
+    """
+    Yield (index, page, inherited) for the pages start <= index < stop
+
+    Walks the page tree itself instead of PdfReader.pages, which loads
+    every page dictionary of the document. Subtrees outside the range are
+    skipped by their /Count, so only the nodes on the way to the selected
+    pages are read. inherited holds the attributes the page inherits from
+    its ancestors (see INHERITABLE_PAGE_ATTRIBUTES).
+    """
+    from pypdf.generic import IndirectObject
+
+    seen = set()
+
+    def walk(node, offset, inherited):
+        if isinstance(node, IndirectObject):
+            if node.idnum in seen:
+                raise ValueError('Page tree contains a cycle')
+            seen.add(node.idnum)
+        node = node.get_object()
+
+        if '/Kids' not in node:
+            if offset >= start and (stop is None or offset < stop):
+                yield offset, node, inherited
+            return offset + 1
+
+        inherited = {**inherited, **{key: node[key] for key in INHERITABLE_PAGE_ATTRIBUTES if key in node}}
+        for kid in node['/Kids']:
+            if stop is not None and offset >= stop:
+                break
+            kid_node = kid.get_object()
+            count = kid_node.get('/Count') if '/Kids' in kid_node else 1
+            if isinstance(count, int) and count >= 0 and offset + count <= start:
+                offset += count
+                continue
+            offset = yield from walk(kid, offset, inherited)
+        return offset
+
+    yield from walk(root, 0, {})
+
+
+def page_details(index, page, inherited):
+    """page_number, size and rotation of one page from iter_page_tree"""
+    box = page.get('/MediaBox', inherited.get('/MediaBox'))
+    rotation = page.get('/Rotate', inherited.get('/Rotate', 0))
+    details = {'page_number': index + 1, 'width': None, 'height': None, 'rotation': int(rotation)}
+    if box is not None:
+        box = [float(value) for value in box.get_object()]
+        details['width'], details['height'] = box[2] - box[0], box[3] - box[1]
+    return details
+
+
+def xmp_properties(root):
+    """
+    Simple properties of the catalog's XMP packet as {"prefix:name": value}
+
+    Language alternatives (rdf:Alt) give their first value, sequences and
+    bags a list. Returns None if the document has no XMP metadata.
+    """
+    if '/Metadata' not in root:
+        return None
+
+    rdf = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+    tree = parse_xml(root['/Metadata'].get_object().get_data())
+
+    def qualified_name(element, name):
+        namespace, _, local = name[1:].partition('}')
+        prefixes = {uri: prefix for prefix, uri in element.nsmap.items()}
+        return f'{prefixes[namespace]}:{local}' if prefixes.get(namespace) else local
+
+    properties = {}
+    for description in tree.iter(f'{{{rdf}}}Description'):
+        for name, value in description.attrib.items():
+            if not name.startswith(f'{{{rdf}}}'):
+                properties[qualified_name(description, name)] = value
+        for child in description:
+            if not isinstance(child.tag, str):
+                continue
+            container = next((item for item in child if isinstance(item.tag, str)), None)
+            if container is not None and container.tag in (f'{{{rdf}}}Alt', f'{{{rdf}}}Seq', f'{{{rdf}}}Bag'):
+                values = [(item.text or '').strip() for item in container if item.tag == f'{{{rdf}}}li']
+                value = values[0] if container.tag == f'{{{rdf}}}Alt' and values else values
+            elif container is None:
+                value = (child.text or '').strip()
+            else:
+                continue
+            properties[qualified_name(child, child.tag)] = value
+    return properties
+
+
+def list_attachments(root):
+    """Name, size, MIME type and relationship of the catalog's embedded files, without reading their data"""
+    names = root.get('/Names')
+    if names is None or '/EmbeddedFiles' not in names.get_object():
+        return []
+
+    attachments = []
+    for name, value in iter_name_tree(names.get_object()['/EmbeddedFiles']):
+        file_spec = value.get_object()
+        attachment = {'name': str(file_spec.get('/UF', file_spec.get('/F', name)))}
+        if '/Desc' in file_spec:
+            attachment['description'] = str(file_spec['/Desc'])
+        if '/AFRelationship' in file_spec:
+            attachment['relationship'] = str(file_spec['/AFRelationship'])[1:]
+
+        embedded_files = file_spec.get('/EF')
+        if embedded_files is not None:
+            embedded_files = embedded_files.get_object()
+            # The stream dictionary is read, its data is never decoded
+            embedded_file = embedded_files.get('/UF', embedded_files.get('/F'))
+            if embedded_file is not None:
+                embedded_file = embedded_file.get_object()
+                if '/Subtype' in embedded_file:
+                    attachment['mime_type'] = str(embedded_file['/Subtype'])[1:]
+                params = embedded_file.get('/Params')
+                if params is not None and '/Size' in params.get_object():
+                    attachment['size'] = int(params.get_object()['/Size'])
+        attachments.append(attachment)
+    return attachments
+
+
+def page_runs(indices):
+    """Split sorted page indices into (start, stop) ranges of consecutive pages"""
+    runs = []
+    for index in indices:
+        if runs and runs[-1][1] == index:
+            runs[-1][1] = index + 1
+        else:
+            runs.append([index, index + 1])
+    return runs
+
+
 @app.route('/pdf/metadata', methods=['POST'])
+@async_job
+@cached_result
 def get_metadata():
     """
     Extract PDF metadata and information
@@ -841,58 +4365,280 @@ def get_metadata():
 
     Expected body:
     {
-        "pdf_base64": "base64 encoded PDF"
+        "pdf_base64": "base64 encoded PDF",
+        "pages": "all" or "1-50" (optional, per-page details, default: none)
     }
+
+    Only the trailer, the catalog and the objects it points to are read.
+    The page count comes from the root of the page tree, and page details
+    are looked up by walking the tree to the selected pages, so the
+    default answers from a handful of objects however long the document
+    is. At most METADATA_PAGE_LIMIT pages are detailed per response;
+    "pages_next" holds the selection to send for the next batch.
     """
     try:
         logger.info('=== get_metadata called ===')
 
         if request.is_json:
-            data = request.get_json()
+            data = request.get_json() or {}
         else:
-            data = request.form.to_dict()
+            data = get_form_data()
 
-        if not data or 'pdf_base64' not in data:
+        try:
+            pdf_stream = open_pdf_input(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        if pdf_stream is None:
             return jsonify({'success': False, 'error': 'pdf_base64 required'}), 400
 
-        pdf_base64 = data.get('pdf_base64', '')
+        from pypdf import PdfReader, __version__ as pypdf_version
 
-        from pypdf import PdfReader
-        from io import BytesIO
+        # Uploads and raw bodies are spooled files: the reader seeks to the
+        # cross-reference data at the end and loads objects on demand
+        with stage_timer('parse'):
+            pdf_reader = PdfReader(pdf_stream)
+
+        encryption = None
+        if pdf_reader.is_encrypted:
+            # Strings and streams can still be read if there is no user password
+            try:
+                readable = bool(pdf_reader.decrypt(''))
+            except Exception:
+                readable = False
+            encrypt = pdf_reader.trailer['/Encrypt'].get_object()
+            encryption = {
+                'filter': str(encrypt.get('/Filter', ''))[1:],
+                'version': int(encrypt.get('/V', 0)),
+                'revision': int(encrypt.get('/R', 0)),
+                'key_length': int(encrypt.get('/Length', 40)),
+                'readable': readable
+            }
+            if not readable:
+                # The page tree's numbers are not encrypted, only strings and
+                # streams, but pypdf has no public way to read objects without
+                # the password. Its private _override_encryption flag makes
+                # get_object skip decryption; it is only used on the pypdf
+                # major version it was checked against (4.x, 4.3.1 is pinned).
+                # Otherwise only what the trailer says is reported.
+                if not pypdf_version.startswith('4.'):
+                    return jsonify({
+                        'success': True,
+                        'metadata': {},
+                        'page_count': None,
+                        'file_size': stream_size(pdf_stream),
+                        'encrypted': True,
+                        'pdf_version': pdf_reader.pdf_header[5:],
+                        'encryption': encryption
+                    }), 200
+                pdf_reader._override_encryption = True
+
+        root = pdf_reader.trailer['/Root'].get_object()
+        page_tree = root['/Pages']
+
+        page_count = page_tree.get_object().get('/Count')
+        if not isinstance(page_count, int) or page_count < 0:
+            page_count = sum(1 for _ in iter_page_tree(page_tree))
+        observe_pages(page_count)
+
+        pages_filter = data.get('pages')
+        if pages_filter is None or pages_filter is False or str(pages_filter).lower() in ('false', '0', 'no', 'none', ''):
+            selected = None
+        elif pages_filter is True or str(pages_filter).lower() in ('all', 'true', 'yes'):
+            selected = list(range(page_count))
+        else:
+            try:
+                selected = sorted(set(parse_page_selection(pages_filter, page_count)))
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e)}), 400
 
-        pdf_bytes = base64.b64decode(pdf_base64)
-        pdf_reader = PdfReader(BytesIO(pdf_bytes))
+        readable = encryption is None or encryption['readable']
 
         metadata = {}
-        if pdf_reader.metadata:
+        if readable and pdf_reader.metadata:
             for key, value in pdf_reader.metadata.items():
                 metadata[key] = str(value)
 
-        page_info = []
-        for idx, page in enumerate(pdf_reader.pages):
-            page_info.append({
-                'page_number': idx + 1,
-                'width': float(page.mediabox.width),
-                'height': float(page.mediabox.height),
-                'rotation': page.get('/Rotate', 0)
-            })
-
-        logger.info(f'Extracted metadata from PDF with {len(pdf_reader.pages)} pages')
-
-        return jsonify({
+        response = {
             'success': True,
             'metadata': metadata,
-            'page_count': len(pdf_reader.pages),
-            'pages': page_info,
-            'file_size': len(pdf_bytes),
-            'encrypted': pdf_reader.is_encrypted
-        }), 200
+            'page_count': page_count,
+            'file_size': stream_size(pdf_stream),
+            'encrypted': pdf_reader.is_encrypted,
+            'pdf_version': pdf_reader.pdf_header[5:],
+            'xmp': xmp_properties(root) if readable else None,
+            'attachments': list_attachments(root) if readable else []
+        }
+        if encryption is not None:
+            response['encryption'] = encryption
+
+        if selected is not None:
+            limit = max(METADATA_PAGE_LIMIT, 1)
+            selected, remaining = selected[:limit], selected[limit:]
+            response['pages'] = [
+                page_details(index, page, inherited)
+                for start, stop in page_runs(selected)
+                for index, page, inherited in iter_page_tree(page_tree, start, stop)
+            ]
+            # Selection of the pages left out, as 1-based "a-b,c" ranges
+            response['pages_next'] = ','.join(
+                f'{start + 1}-{stop}' if stop - start > 1 else str(stop)
+                for start, stop in page_runs(remaining)
+            ) or None
+
+        logger.info(f'Extracted metadata from PDF with {page_count} pages')
+
+        return jsonify(response), 200
 
     except Exception as e:
         logger.error(f'Error extracting metadata: {str(e)}', exc_info=True)
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def add_writer_stream(pdf_writer, data, **entries):
+    """Add a stream to pdf_writer (Flate-compressed unless tiny), return its reference"""
+    from pypdf.generic import NameObject, StreamObject
+
+    stream = StreamObject()
+    for key, value in entries.items():
+        stream[NameObject(f'/{key}')] = value
+    stream.set_data(data)
+    return pdf_writer._add_object(stream.flate_encode() if len(data) > 64 else stream)
+
+
+def add_page_xobject(page, prefix, ref):
+    """Register ref in a writer page's XObject resources, return the name it got"""
+    from pypdf.generic import DictionaryObject, NameObject
+
+    if '/Resources' not in page:
+        page[NameObject('/Resources')] = DictionaryObject()
+    resources = page['/Resources'].get_object()
+    if '/XObject' not in resources:
+        resources[NameObject('/XObject')] = DictionaryObject()
+    xobjects = resources['/XObject'].get_object()
+
+    name = f'/{prefix}{ref.idnum}'
+    while name in xobjects and xobjects.raw_get(name) != ref:
+        name += '_'
+    xobjects[NameObject(name)] = ref
+    return name
+
+
+def overlay_page(page, opener, closer):
+    """
+    Draw on top of a writer page without touching its content streams
+
+    The page's content is wrapped between the shared opener stream ("q")
+    and closer, which starts with "Q" and then draws the overlay, so a
+    graphics state the page leaves behind cannot leak into the overlay.
+    """
+    from pypdf.generic import ArrayObject, IndirectObject, NameObject
+
+    contents = page.raw_get('/Contents') if '/Contents' in page else None
+    if isinstance(contents, IndirectObject) and isinstance(contents.get_object(), ArrayObject):
+        contents = contents.get_object()
+    existing = list(contents) if isinstance(contents, ArrayObject) else ([contents] if contents is not None else [])
+    page[NameObject('/Contents')] = ArrayObject([opener, *existing, closer])
+
+
+WATERMARK_COLORS = {
+    'gray': (0.5, 0.5, 0.5),
+    'red': (1, 0, 0),
+    'blue': (0, 0, 1),
+    'black': (0, 0, 0)
+}
+
+
+def get_watermark_overlay(text, font_size, color, opacity, position, width, height):
+    """
+    Content stream and resources of a watermark for one page size
+
+    Rendered with reportlab the first time, then served from the
+    per-worker LRU so common stamps ("PAID", "COPY") are built once.
+    Returns (content bytes, resources); resources only holds direct
+    objects and must be cloned before it is added to a document.
+    """
+    key = (text, font_size, color, opacity, position, round(width, 2), round(height, 2))
+    overlay = watermark_cache.get(key)
+    if overlay is not None:
+        return overlay
+
+    from pypdf import PdfReader
+    from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject
+    from reportlab.pdfgen import canvas
+    from reportlab.lib import colors
+
+    packet = io.BytesIO()
+    can = canvas.Canvas(packet, pagesize=(width, height))
+    can.setFillColor(colors.Color(*WATERMARK_COLORS.get(color, WATERMARK_COLORS['gray']), alpha=opacity))
+    can.setFont("Helvetica-Bold", font_size)
+
+    if position == 'diagonal':
+        can.saveState()
+        can.translate(width / 2, height / 2)
+        can.rotate(45)
+        can.drawCentredString(0, 0, text)
+        can.restoreState()
+    else:  # center
+        can.drawCentredString(width / 2, height / 2, text)
+
+    can.save()
+    packet.seek(0)
+    page = PdfReader(packet).pages[0]
+
+    def direct(obj):
+        if isinstance(obj, IndirectObject):
+            return direct(obj.get_object())
+        if isinstance(obj, DictionaryObject):
+            return DictionaryObject({key: direct(value) for key, value in obj.items()})
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(direct(value) for value in obj)
+        return obj
+
+    overlay = (page.get_contents().get_data(), direct(page['/Resources']))
+    watermark_cache.put(key, overlay)
+    return overlay
+
+
+def apply_watermark(pdf_writer, text, font_size, color, opacity, position):
+    """
+    Stamp every page of pdf_writer with a watermark Form XObject
+
+    One Form XObject is added per distinct page size and shared by all
+    pages of that size. Each page only gets a resource entry and two
+    small shared content streams that wrap its content in q/Q and draw
+    the form on top. Returns the number of Form XObjects added.
+    """
+    from pypdf.generic import ArrayObject, FloatObject, NameObject
+
+    forms = {}
+    closers = {}
+    opener = add_writer_stream(pdf_writer, b'q\n')
+
+    for page in pdf_writer.pages:
+        box = page.mediabox
+        size = (float(box.width), float(box.height))
+        if size not in forms:
+            content, resources = get_watermark_overlay(text, font_size, color, opacity, position, *size)
+            forms[size] = add_writer_stream(
+                pdf_writer, content,
+                Type=NameObject('/XObject'),
+                Subtype=NameObject('/Form'),
+                BBox=ArrayObject([FloatObject(0), FloatObject(0), FloatObject(size[0]), FloatObject(size[1])]),
+                Resources=resources.clone(pdf_writer)
+            )
+        name = add_page_xobject(page, 'Watermark', forms[size])
+
+        # The overlay starts at the page's lower-left corner
+        closer = f'\nQ q 1 0 0 1 {float(box.left):.4f} {float(box.bottom):.4f} cm {name} Do Q\n'.encode()
+        if closer not in closers:
+            closers[closer] = add_writer_stream(pdf_writer, closer)
+        overlay_page(page, opener, closers[closer])
+
+    return len(forms)
+
+
 @app.route('/pdf/watermark', methods=['POST'])
+@async_job
 def add_watermark():
     """
     Add text watermark to PDF
@@ -913,14 +4659,18 @@ def add_watermark():
         logger.info('=== add_watermark called ===')
 
         if request.is_json:
-            data = request.get_json()
+            data = request.get_json() or {}
         else:
-            data = request.form.to_dict()
+            data = get_form_data()
 
-        if not data or 'pdf_base64' not in data or 'text' not in data:
+        try:
+            pdf_stream = open_pdf_input(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        if pdf_stream is None or 'text' not in data:
             return jsonify({'success': False, 'error': 'pdf_base64 and text required'}), 400
 
-        pdf_base64 = data.get('pdf_base64', '')
         watermark_text = data.get('text', 'WATERMARK')
         opacity = float(data.get('opacity', 0.3))
         position = data.get('position', 'diagonal')
@@ -929,76 +4679,659 @@ def add_watermark():
         filename = data.get('filename', 'watermarked.pdf')
 
         from pypdf import PdfReader, PdfWriter
-        from reportlab.pdfgen import canvas
-        from reportlab.lib.pagesizes import letter
-        from reportlab.lib import colors
         from io import BytesIO
 
-        # Decode original PDF
-        pdf_bytes = base64.b64decode(pdf_base64)
-        pdf_reader = PdfReader(BytesIO(pdf_bytes))
-        pdf_writer = PdfWriter()
-
-        # Color mapping
-        color_map = {
-            'gray': colors.Color(0.5, 0.5, 0.5, alpha=opacity),
-            'red': colors.Color(1, 0, 0, alpha=opacity),
-            'blue': colors.Color(0, 0, 1, alpha=opacity),
-            'black': colors.Color(0, 0, 0, alpha=opacity)
-        }
-        watermark_color = color_map.get(color, color_map['gray'])
-
-        # Create watermark for each page
-        for page in pdf_reader.pages:
-            # Get page dimensions
-            page_width = float(page.mediabox.width)
-            page_height = float(page.mediabox.height)
-
-            # Create watermark
-            packet = BytesIO()
-            can = canvas.Canvas(packet, pagesize=(page_width, page_height))
-            can.setFillColor(watermark_color)
-            can.setFont("Helvetica-Bold", font_size)
-
-            if position == 'diagonal':
-                can.saveState()
-                can.translate(page_width / 2, page_height / 2)
-                can.rotate(45)
-                can.drawCentredString(0, 0, watermark_text)
-                can.restoreState()
-            else:  # center
-                can.drawCentredString(page_width / 2, page_height / 2, watermark_text)
-
-            can.save()
-
-            # Merge watermark with page
-            packet.seek(0)
-            watermark_pdf = PdfReader(packet)
-            page.merge_page(watermark_pdf.pages[0])
-            pdf_writer.add_page(page)
+        # Read original PDF
+        with stage_timer('parse'):
+            pdf_reader = PdfReader(pdf_stream)
+            pdf_writer = PdfWriter()
+
+            for page in pdf_reader.pages:
+                pdf_writer.add_page(page)
+        observe_pages(len(pdf_reader.pages))
+
+        # One shared overlay per page size instead of one merge per page
+        with stage_timer('render'):
+            apply_watermark(pdf_writer, watermark_text, font_size, color, opacity, position)
 
         # Write output
         output = BytesIO()
-        pdf_writer.write(output)
+        with stage_timer('serialize'):
+            pdf_writer.write(output)
         watermarked_bytes = output.getvalue()
 
-        watermarked_base64 = base64.b64encode(watermarked_bytes).decode('utf-8')
-
         logger.info(f'Added watermark to PDF: {filename} ({len(watermarked_bytes)} bytes)')
 
-        return jsonify({
-            'success': True,
-            'pdf_base64': watermarked_base64,
-            'pdf_size': len(watermarked_bytes),
-            'filename': filename,
-            'pages_processed': len(pdf_reader.pages)
-        }), 200
+        return pdf_response(
+            watermarked_bytes, filename, wants_binary(data),
+            pages_processed=len(pdf_reader.pages),
+            page_count=len(pdf_reader.pages)
+        )
 
     except Exception as e:
         logger.error(f'Error adding watermark: {str(e)}', exc_info=True)
         return jsonify({'success': False, 'error': str(e)}), 500
 
+
+# /pdf/stamp: the standard PDF fonts (no embedding needed) and named
+# positions as (x, y) fractions of the page and of the stamp's own box
+STAMP_FONTS = (
+    'Helvetica', 'Helvetica-Bold', 'Helvetica-Oblique', 'Helvetica-BoldOblique',
+    'Times-Roman', 'Times-Bold', 'Times-Italic', 'Times-BoldItalic',
+    'Courier', 'Courier-Bold', 'Courier-Oblique', 'Courier-BoldOblique'
+)
+STAMP_POSITIONS = {
+    'top-left': (0, 1), 'top-center': (0.5, 1), 'top-right': (1, 1),
+    'center-left': (0, 0.5), 'center': (0.5, 0.5), 'center-right': (1, 0.5),
+    'bottom-left': (0, 0), 'bottom-center': (0.5, 0), 'bottom-right': (1, 0)
+}
+
+
+def parse_color(value):
+    """RGB fractions from a color name (see WATERMARK_COLORS), #rgb/#rrggbb or [r, g, b] in 0-1"""
+    if isinstance(value, str) and value in WATERMARK_COLORS:
+        return WATERMARK_COLORS[value]
+    if isinstance(value, str) and re.fullmatch(r'#([0-9a-fA-F]{3}|[0-9a-fA-F]{6})', value):
+        digits = value[1:] if len(value) == 7 else ''.join(c * 2 for c in value[1:])
+        return tuple(int(digits[i:i + 2], 16) / 255 for i in (0, 2, 4))
+    if isinstance(value, list) and len(value) == 3 and all(isinstance(c, (int, float)) and 0 <= c <= 1 for c in value):
+        return tuple(value)
+    raise ValueError(f'Invalid color: {value!r}')
+
+
+def pdf_literal(text):
+    """Text as a PDF string literal in WinAnsi encoding (unsupported characters become ?)"""
+    data = text.encode('cp1252', 'replace')
+    return b'(' + data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+
+def parse_stamp(spec, index, total_pages):
+    """
+    Validate one entry of the stamps array, return it normalized
+
+    Text stamps get font, size and color, image stamps their decoded
+    image. Both get position, margin, rotation, opacity and a set of
+    0-based page indices (None for all pages). Raises ValueError.
+    """
+    from PIL import Image
+
+    if not isinstance(spec, dict):
+        raise ValueError(f'stamps[{index}] must be an object')
+
+    kind = spec.get('type', 'image' if 'image_base64' in spec else 'text')
+    stamp = {'type': kind}
+    try:
+        stamp['opacity'] = float(spec.get('opacity', 1))
+        stamp['rotation'] = float(spec.get('rotation', 0))
+        stamp['margin'] = float(spec.get('margin', 36))
+        if 'x' in spec or 'y' in spec:
+            stamp['point'] = (float(spec.get('x', 0)), float(spec.get('y', 0)))
+            stamp['anchor'] = STAMP_POSITIONS[spec.get('anchor', 'bottom-left')]
+        else:
+            stamp['position'] = STAMP_POSITIONS[spec.get('position', 'center')]
+            stamp['anchor'] = STAMP_POSITIONS[spec.get('anchor', spec.get('position', 'center'))]
+        pages = parse_page_selection(spec.get('pages'), total_pages)
+        stamp['pages'] = None if pages is None else set(pages)
+
+        if kind == 'text':
+            stamp['text'] = str(spec['text'])
+            stamp['font'] = spec.get('font', 'Helvetica')
+            if stamp['font'] not in STAMP_FONTS:
+                raise ValueError(f'font must be one of {", ".join(STAMP_FONTS)}')
+            stamp['font_size'] = float(spec.get('font_size', 12))
+            stamp['color'] = parse_color(spec.get('color', 'black'))
+        elif kind == 'image':
+            data = base64.b64decode(spec['image_base64'])
+            image = Image.open(io.BytesIO(data))
+            image.load()
+            stamp['image'], stamp['image_bytes'] = image, data
+            width, height = spec.get('width'), spec.get('height')
+            # Without a size, images are placed at 96 dpi
+            if width is None and height is None:
+                width = image.width * 0.75
+            if width is None:
+                width = float(height) * image.width / image.height
+            if height is None:
+                height = float(width) * image.height / image.width
+            stamp['size'] = (float(width), float(height))
+        else:
+            raise ValueError('type must be text or image')
+    except KeyError as e:
+        raise ValueError(f'stamps[{index}]: invalid or missing {e}')
+    except (TypeError, ValueError, OSError) as e:
+        raise ValueError(f'stamps[{index}]: {str(e)}')
+
+    if not 0 <= stamp['opacity'] <= 1:
+        raise ValueError(f'stamps[{index}]: opacity must be between 0 and 1')
+    return stamp
+
+
+def add_image_xobject(pdf_writer, image, data):
+    """
+    Add a Pillow image to pdf_writer as an Image XObject, return its reference
+
+    RGB and greyscale JPEGs are embedded as they are, everything else is
+    stored Flate-compressed with its alpha channel as soft mask.
+    """
+    from pypdf.generic import NameObject, NumberObject
+
+    entries = {
+        'Type': NameObject('/XObject'),
+        'Subtype': NameObject('/Image'),
+        'Width': NumberObject(image.width),
+        'Height': NumberObject(image.height),
+        'BitsPerComponent': NumberObject(8)
+    }
+
+    if image.format == 'JPEG' and image.mode in ('RGB', 'L'):
+        entries['ColorSpace'] = NameObject('/DeviceRGB' if image.mode == 'RGB' else '/DeviceGray')
+        entries['Filter'] = NameObject('/DCTDecode')
+        return pdf_writer._add_object(add_raw_stream(data, entries))
+
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        entries['SMask'] = add_writer_stream(
+            pdf_writer, image.getchannel('A').tobytes(),
+            Type=NameObject('/XObject'), Subtype=NameObject('/Image'),
+            Width=NumberObject(image.width), Height=NumberObject(image.height),
+            BitsPerComponent=NumberObject(8), ColorSpace=NameObject('/DeviceGray')
+        )
+    image = image.convert('L' if image.mode in ('L', 'LA', '1') else 'RGB')
+    entries['ColorSpace'] = NameObject('/DeviceRGB' if image.mode == 'RGB' else '/DeviceGray')
+    return add_writer_stream(pdf_writer, image.tobytes(), **entries)
+
+
+def add_raw_stream(data, entries):
+    """Stream object holding already encoded data"""
+    from pypdf.generic import NameObject, StreamObject
+
+    stream = StreamObject()
+    for key, value in entries.items():
+        stream[NameObject(f'/{key}')] = value
+    stream.set_data(data)
+    return stream
+
+
+def apply_stamps(pdf_writer, stamps):
+    """
+    Draw the stamps on the pages of pdf_writer they select
+
+    Every stamp becomes a Form XObject, built once and shared by all
+    pages; text with {page}/{pages} placeholders gets one form per
+    distinct text. Fonts, images and opacity states are shared objects
+    too, so each page only gets resource entries and one content stream
+    with a "cm ... Do" per stamp. Returns the number of pages stamped.
+    """
+    import math
+    from pypdf.generic import ArrayObject, DictionaryObject, FloatObject, NameObject
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+
+    total_pages = len(pdf_writer.pages)
+    fonts = {}
+    states = {}
+    images = {}
+    forms = {}
+    closers = {}
+    opener = add_writer_stream(pdf_writer, b'q\n')
+
+    def font_ref(name):
+        if name not in fonts:
+            fonts[name] = pdf_writer._add_object(DictionaryObject({
+                NameObject('/Type'): NameObject('/Font'),
+                NameObject('/Subtype'): NameObject('/Type1'),
+                NameObject('/BaseFont'): NameObject(f'/{name}'),
+                NameObject('/Encoding'): NameObject('/WinAnsiEncoding')
+            }))
+        return fonts[name]
+
+    def state_ref(opacity):
+        if opacity not in states:
+            states[opacity] = pdf_writer._add_object(DictionaryObject({
+                NameObject('/Type'): NameObject('/ExtGState'),
+                NameObject('/ca'): FloatObject(opacity),
+                NameObject('/CA'): FloatObject(opacity)
+            }))
+        return states[opacity]
+
+    def form(index, stamp, text):
+        """Form XObject for a stamp (and its rendered text), with its box size"""
+        key = (index, text)
+        if key in forms:
+            return forms[key]
+
+        resources = DictionaryObject({
+            NameObject('/ExtGState'): DictionaryObject({NameObject('/GS0'): state_ref(stamp['opacity'])})
+        })
+        if stamp['type'] == 'text':
+            size = stamp['font_size']
+            width, height = stringWidth(text, stamp['font'], size), size
+            resources[NameObject('/Font')] = DictionaryObject({NameObject('/F0'): font_ref(stamp['font'])})
+            red, green, blue = stamp['color']
+            # Baseline above the descenders, so the box holds the whole text
+            content = (f'q /GS0 gs {red:.4f} {green:.4f} {blue:.4f} rg BT /F0 {size:.4f} Tf '
+                       f'0 {size * 0.22:.4f} Td ').encode() + pdf_literal(text) + b' Tj ET Q'
+        else:
+            if index not in images:
+                images[index] = add_image_xobject(pdf_writer, stamp['image'], stamp['image_bytes'])
+            width, height = stamp['size']
+            resources[NameObject('/XObject')] = DictionaryObject({NameObject('/Im0'): images[index]})
+            content = f'q /GS0 gs {width:.4f} 0 0 {height:.4f} 0 0 cm /Im0 Do Q'.encode()
+
+        forms[key] = (add_writer_stream(
+            pdf_writer, content,
+            Type=NameObject('/XObject'),
+            Subtype=NameObject('/Form'),
+            BBox=ArrayObject([FloatObject(0), FloatObject(0), FloatObject(width), FloatObject(height)]),
+            Resources=resources
+        ), width, height)
+        return forms[key]
+
+    stamped = 0
+    for page_index, page in enumerate(pdf_writer.pages):
+        box = page.mediabox
+        left, bottom = float(box.left), float(box.bottom)
+        page_width, page_height = float(box.width), float(box.height)
+        draws = []
+
+        for index, stamp in enumerate(stamps):
+            if stamp['pages'] is not None and page_index not in stamp['pages']:
+                continue
+            text = None
+            if stamp['type'] == 'text':
+                text = stamp['text'].replace('{page}', str(page_index + 1)).replace('{pages}', str(total_pages))
+            ref, width, height = form(index, stamp, text)
+            name = add_page_xobject(page, 'Stamp', ref)
+
+            if 'point' in stamp:
+                x, y = left + stamp['point'][0], bottom + stamp['point'][1]
+            else:
+                fx, fy = stamp['position']
+                margin = stamp['margin']
+                x = left + margin + fx * (page_width - 2 * margin)
+                y = bottom + margin + fy * (page_height - 2 * margin)
+
+            # Rotate counter-clockwise around the anchor point of the stamp's box
+            ax, ay = stamp['anchor'][0] * width, stamp['anchor'][1] * height
+            cos, sin = math.cos(math.radians(stamp['rotation'])), math.sin(math.radians(stamp['rotation']))
+            e, f = x - (cos * ax - sin * ay), y - (sin * ax + cos * ay)
+            draws.append(f'q {cos:.6f} {sin:.6f} {-sin:.6f} {cos:.6f} {e:.4f} {f:.4f} cm {name} Do Q')
+
+        if draws:
+            closer = ('\nQ ' + ' '.join(draws) + '\n').encode()
+            if closer not in closers:
+                closers[closer] = add_writer_stream(pdf_writer, closer)
+            overlay_page(page, opener, closers[closer])
+            stamped += 1
+
+    return stamped
+
+
+@app.route('/pdf/stamp', methods=['POST'])
+@async_job
+def stamp_pdf():
+    """
+    Add text and image stamps to selected pages
+
+    Accepts both JSON and form data (stamps as a JSON string).
+
+    Expected body:
+    {
+        "pdf_base64": "base64 encoded PDF",
+        "stamps": [
+            {
+                "type": "text",
+                "text": "Seite {page} von {pages}",
+                "font": "Helvetica" (optional, standard PDF font),
+                "font_size": 9 (optional, default: 12),
+                "color": "#333333" (optional, name, hex or [r, g, b]),
+                "position": "bottom-center" (optional, default: center),
+                "margin": 24 (optional, default: 36),
+                "pages": "2-5" (optional, default: all pages)
+            },
+            {
+                "type": "image",
+                "image_base64": "base64 PNG/JPEG",
+                "width": 120 (optional, points),
+                "x": 400, "y": 700 (optional, instead of position),
+                "anchor": "bottom-left" (optional),
+                "rotation": 15 (optional, degrees counter-clockwise),
+                "opacity": 0.8 (optional, 0-1),
+                "pages": [1]
+            }
+        ],
+        "filename": "stamped.pdf" (optional)
+    }
+    """
+    try:
+        logger.info('=== stamp_pdf called ===')
+
+        if request.is_json:
+            data = request.get_json() or {}
+        else:
+            data = get_form_data()
+            if 'stamps' in data and isinstance(data['stamps'], str):
+                data['stamps'] = json.loads(data['stamps'])
+
+        try:
+            pdf_stream = open_pdf_input(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        stamp_specs = data.get('stamps')
+        if pdf_stream is None or not stamp_specs or not isinstance(stamp_specs, list):
+            return jsonify({'success': False, 'error': 'pdf_base64 and stamps array required'}), 400
+
+        filename = data.get('filename', 'stamped.pdf')
+
+        from pypdf import PdfReader, PdfWriter
+
+        with stage_timer('parse'):
+            pdf_reader = PdfReader(pdf_stream)
+            pdf_writer = PdfWriter()
+            for page in pdf_reader.pages:
+                pdf_writer.add_page(page)
+        observe_pages(len(pdf_writer.pages))
+
+        try:
+            stamps = [parse_stamp(spec, idx, len(pdf_writer.pages)) for idx, spec in enumerate(stamp_specs)]
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        with stage_timer('render'):
+            pages_stamped = apply_stamps(pdf_writer, stamps)
+
+        output = io.BytesIO()
+        with stage_timer('serialize'):
+            pdf_writer.write(output)
+        stamped_bytes = output.getvalue()
+
+        logger.info(f'Applied {len(stamps)} stamps to {pages_stamped} pages: {filename} ({len(stamped_bytes)} bytes)')
+
+        return pdf_response(
+            stamped_bytes, filename, wants_binary(data),
+            stamps_applied=len(stamps),
+            pages_stamped=pages_stamped,
+            page_count=len(pdf_writer.pages)
+        )
+
+    except Exception as e:
+        logger.error(f'Error stamping PDF: {str(e)}', exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# /pdf/compress quality levels: images shown above target_dpi are
+# downsampled to it, colour and greyscale images are re-encoded as JPEG
+COMPRESS_PROFILES = {
+    'high': {'target_dpi': 200, 'jpeg_quality': 85, 'flate_level': 3},
+    'medium': {'target_dpi': 150, 'jpeg_quality': 75, 'flate_level': 6},
+    'low': {'target_dpi': 100, 'jpeg_quality': 60, 'flate_level': 9},
+}
+
+# Images smaller than this are not worth a round-trip through the pool
+COMPRESS_MIN_IMAGE_SIZE = 4096
+
+
+def image_display_sizes(page):
+    """
+    Largest size in points at which each image XObject is drawn on a page
+
+    Follows the content stream's transformation matrix (q/Q/cm) into
+    Form XObjects. Returns {object number: (width, height)}.
+    """
+    from pypdf.generic import ContentStream, IndirectObject
+
+    sizes = {}
+
+    def multiply(m, n):
+        return [
+            m[0] * n[0] + m[1] * n[2], m[0] * n[1] + m[1] * n[3],
+            m[2] * n[0] + m[3] * n[2], m[2] * n[1] + m[3] * n[3],
+            m[4] * n[0] + m[5] * n[2] + n[4], m[4] * n[1] + m[5] * n[3] + n[5]
+        ]
+
+    def walk(content, resources, ctm, depth):
+        xobjects = resources.get('/XObject') if resources else None
+        if not xobjects or depth > 8:
+            return
+        xobjects = xobjects.get_object()
+        stack = []
+        for operands, operator in content.operations:
+            if operator == b'q':
+                stack.append(ctm)
+            elif operator == b'Q' and stack:
+                ctm = stack.pop()
+            elif operator == b'cm' and len(operands) == 6:
+                ctm = multiply([float(value) for value in operands], ctm)
+            elif operator == b'Do' and operands and operands[0] in xobjects:
+                ref = xobjects.raw_get(operands[0])
+                xobject = ref.get_object()
+                subtype = xobject.get('/Subtype')
+                if subtype == '/Image' and isinstance(ref, IndirectObject):
+                    width = (ctm[0] ** 2 + ctm[1] ** 2) ** 0.5
+                    height = (ctm[2] ** 2 + ctm[3] ** 2) ** 0.5
+                    previous = sizes.get(ref.idnum, (0, 0))
+                    sizes[ref.idnum] = (max(previous[0], width), max(previous[1], height))
+                elif subtype == '/Form':
+                    matrix = [float(value) for value in xobject.get('/Matrix', [1, 0, 0, 1, 0, 0])]
+                    walk(ContentStream(xobject, xobject.indirect_reference.pdf),
+                         xobject.get('/Resources', resources), multiply(matrix, ctm), depth + 1)
+
+    contents = page.get_contents()
+    if contents is not None:
+        walk(contents, page.get('/Resources'), [1, 0, 0, 1, 0, 0], 0)
+    return sizes
+
+
+def image_recompress_item(image, display_size, profile):
+    """
+    Describe an image XObject for recompress_image, or None if it is skipped
+
+    Only 8-bit Gray/RGB images (DCT, Flate or uncompressed, optionally
+    behind ASCII85/ASCIIHex) and 1-bit greyscale images without masks by
+    colour key or Decode arrays are handled; everything else (CMYK,
+    Indexed, JBIG2, JPX, stencil masks, ...) is left alone.
+    """
+    filters = image.get('/Filter', [])
+    if not isinstance(filters, list):
+        filters = [filters]
+    filters = [str(name) for name in filters]
+    ascii_filters = [name for name in filters if name in ('/ASCII85Decode', '/ASCIIHexDecode')]
+    other_filters = filters[len(ascii_filters):]
+    if filters[:len(ascii_filters)] != ascii_filters or len(other_filters) > 1:
+        return None
+    last_filter = other_filters[0] if other_filters else None
+    if last_filter not in (None, '/DCTDecode', '/FlateDecode'):
+        return None
+    if image.get('/ImageMask') or '/Decode' in image or isinstance(image.get('/Mask'), list):
+        return None
+    if len(image._data) < COMPRESS_MIN_IMAGE_SIZE:
+        return None
+
+    color_space = image.get('/ColorSpace')
+    if isinstance(color_space, list) and len(color_space) == 2 and color_space[0] == '/ICCBased':
+        components = color_space[1].get_object().get('/N')
+    else:
+        components = {'/DeviceGray': 1, '/DeviceRGB': 3}.get(color_space)
+    bits = image.get('/BitsPerComponent', 8)
+    if components not in (1, 3) or bits not in (1, 8) or (bits == 1 and components != 1):
+        return None
+    if bits == 1 and last_filter == '/DCTDecode':
+        return None
+
+    width, height = int(image['/Width']), int(image['/Height'])
+    target_width, target_height = width, height
+    if bits == 8 and display_size[0] > 0 and display_size[1] > 0:
+        # Effective resolution of the less detailed direction decides
+        dpi = min(width / (display_size[0] / 72), height / (display_size[1] / 72))
+        if dpi > profile['target_dpi'] * 1.1:
+            scale = profile['target_dpi'] / dpi
+            target_width, target_height = max(1, round(width * scale)), max(1, round(height * scale))
+
+    # An existing JPEG is only worth touching when it gets smaller in pixels
+    if last_filter == '/DCTDecode' and (target_width, target_height) == (width, height):
+        return None
+
+    parms = image.get('/DecodeParms')
+    if isinstance(parms, list):
+        parms = parms[-1] if len(parms) == len(filters) else None
+    return {
+        'data': image._data,
+        'ascii_filters': ascii_filters,
+        'filter': last_filter,
+        'parms': {key: int(value) for key, value in parms.get_object().items()} if parms else {},
+        'width': width,
+        'height': height,
+        'bits': bits,
+        'components': components,
+        'target_width': target_width,
+        'target_height': target_height,
+        'jpeg_quality': profile['jpeg_quality']
+    }
+
+
+def recompress_image(item):
+    """
+    Downsample and re-encode one image (runs in the process pool)
+
+    Gray/RGB images become JPEG, 1-bit images CCITT G4 (Flate if Pillow
+    lacks libtiff). Returns the new data, filter, parameters and size, or
+    None if the result is not at least 10% smaller than the original.
+    """
+    from PIL import Image, features
+
+    from pypdf.filters import ASCII85Decode, ASCIIHexDecode
+
+    mode = '1' if item['bits'] == 1 else ('L' if item['components'] == 1 else 'RGB')
+    target = (item['target_width'], item['target_height'])
+
+    data = item['data']
+    for name in item['ascii_filters']:
+        data = (ASCII85Decode if name == '/ASCII85Decode' else ASCIIHexDecode).decode(data)
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+
+    if item['filter'] == '/DCTDecode':
+        image = Image.open(io.BytesIO(data))
+        # Let libjpeg decode at a reduced scale when possible
+        image.draft(image.mode, target)
+        if image.mode != mode:
+            return None
+    else:
+        if item['filter'] == '/FlateDecode':
+            from pypdf.filters import FlateDecode
+            from pypdf.generic import DictionaryObject, NameObject, NumberObject
+            parms = DictionaryObject({NameObject(key): NumberObject(value) for key, value in item['parms'].items()})
+            data = FlateDecode.decode(data, parms)
+        image = Image.frombytes(mode, (item['width'], item['height']), data)
+
+    parms = None
+    if mode == '1':
+        if features.check('libtiff'):
+            # One strip, so the G4 data can be lifted out of the TIFF as-is
+            buffer = io.BytesIO()
+            image.save(buffer, 'TIFF', compression='group4', tiffinfo={278: image.height})
+            tiff = Image.open(buffer)
+            offsets, counts = tiff.tag_v2[273], tiff.tag_v2[279]
+            if len(offsets) != 1:
+                return None
+            encoded = buffer.getvalue()[offsets[0]:offsets[0] + counts[0]]
+            # The G4 data carries Pillow's bits (0 = black) unchanged
+            filters = '/CCITTFaxDecode'
+            parms = {'/K': -1, '/Columns': image.width, '/Rows': image.height, '/BlackIs1': True}
+        else:
+            encoded = zlib.compress(image.tobytes(), 9)
+            filters = '/FlateDecode'
+    else:
+        if image.size != target:
+            image = image.resize(target, Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=item['jpeg_quality'], optimize=True)
+        encoded = buffer.getvalue()
+        filters = '/DCTDecode'
+
+    if len(encoded) > len(item['data']) * 0.9:
+        return None
+    return {
+        'data': encoded,
+        'filter': filters,
+        'parms': parms,
+        'width': image.width,
+        'height': image.height,
+        'bits': item['bits']
+    }
+
+
+def recompress_images(pdf_writer, profile):
+    """
+    Recompress the image XObjects of every page in pdf_writer in place
+
+    Images are collected once (shared images are handled once, at the
+    largest size they are drawn) and re-encoded in the process pool.
+    Returns (bytes saved, images recompressed, images left unchanged).
+    """
+    from pypdf.generic import BooleanObject, DictionaryObject, NameObject, NumberObject, StreamObject
+
+    display_sizes = {}
+    for page in pdf_writer.pages:
+        for number, (width, height) in image_display_sizes(page).items():
+            previous = display_sizes.get(number, (0, 0))
+            display_sizes[number] = (max(previous[0], width), max(previous[1], height))
+
+    numbers, items = [], []
+    for number, display_size in display_sizes.items():
+        item = image_recompress_item(pdf_writer.get_object(number), display_size, profile)
+        if item is not None:
+            numbers.append(number)
+            items.append(item)
+
+    results = []
+    try:
+        for index, result in iter_pool_results(recompress_image, items):
+            if isinstance(result, Exception):
+                logger.warning(f'Could not recompress image {numbers[index]}: {str(result)}')
+            elif result is not None:
+                results.append((index, result))
+    except Exception as e:
+        # Recompression is best effort, keep what finished
+        logger.warning(f'Image recompression failed: {str(e)}')
+
+    saved = recompressed = 0
+    for index, result in results:
+        image = pdf_writer.get_object(numbers[index])
+        replacement = StreamObject()
+        for key, value in image.items():
+            if key not in ('/Filter', '/DecodeParms', '/Length', '/Width', '/Height', '/BitsPerComponent'):
+                replacement[key] = value
+        replacement[NameObject('/Filter')] = NameObject(result['filter'])
+        replacement[NameObject('/Width')] = NumberObject(result['width'])
+        replacement[NameObject('/Height')] = NumberObject(result['height'])
+        replacement[NameObject('/BitsPerComponent')] = NumberObject(result['bits'])
+        if result['parms']:
+            replacement[NameObject('/DecodeParms')] = DictionaryObject({
+                NameObject(key): BooleanObject(value) if isinstance(value, bool) else NumberObject(value)
+                for key, value in result['parms'].items()
+            })
+        replacement.set_data(result['data'])
+
+        saved += len(image._data) - len(result['data'])
+        recompressed += 1
+        pdf_writer._replace_object(numbers[index], replacement)
+
+    return saved, recompressed, len(display_sizes) - recompressed
+
+
+def encoded_length(contents):
+    """Encoded size of a page's content stream(s)"""
+    if contents is None:
+        return 0
+    contents = contents.get_object()
+    if isinstance(contents, list):
+        return sum(len(stream.get_object()._data) for stream in contents)
+    return len(contents._data)
+
+
 @app.route('/pdf/compress', methods=['POST'])
+@async_job
+@cached_result
 def compress_pdf():
     """
     Compress PDF to reduce file size
@@ -1015,67 +5348,129 @@ def compress_pdf():
         logger.info('=== compress_pdf called ===')
 
         if request.is_json:
-            data = request.get_json()
+            data = request.get_json() or {}
         else:
-            data = request.form.to_dict()
+            data = get_form_data()
+
+        try:
+            pdf_stream = open_pdf_input(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
 
-        if not data or 'pdf_base64' not in data:
+        if pdf_stream is None:
             return jsonify({'success': False, 'error': 'pdf_base64 required'}), 400
 
-        pdf_base64 = data.get('pdf_base64', '')
         quality = data.get('quality', 'medium')
         filename = data.get('filename', 'compressed.pdf')
 
+        profile = COMPRESS_PROFILES.get(quality)
+        if profile is None:
+            return jsonify({'success': False, 'error': 'quality must be high, medium or low'}), 400
+
         from pypdf import PdfReader, PdfWriter
         from io import BytesIO
 
-        pdf_bytes = base64.b64decode(pdf_base64)
-        original_size = len(pdf_bytes)
-
-        pdf_reader = PdfReader(BytesIO(pdf_bytes))
-        pdf_writer = PdfWriter()
+        original_size = stream_size(pdf_stream)
+
+        with stage_timer('parse'):
+            pdf_reader = PdfReader(pdf_stream)
+            pdf_writer = PdfWriter()
+
+            # Copy all pages
+            for page in pdf_reader.pages:
+                pdf_writer.add_page(page)
+        observe_pages(len(pdf_writer.pages))
+
+        # Downsample and re-encode images (in parallel, see recompress_images)
+        with stage_timer('recompress'):
+            images_saved, images_recompressed, images_skipped = recompress_images(pdf_writer, profile)
+
+        with stage_timer('serialize'):
+            # Compress content streams based on quality setting
+            content_saved = 0
+            for page in pdf_writer.pages:
+                before = encoded_length(page.get('/Contents'))
+                page.compress_content_streams(level=profile['flate_level'])
+                # Streams that were stored uncompressed or with a better
+                # level can grow, they count as no saving
+                content_saved += max(before - encoded_length(page.get('/Contents')), 0)
+
+            # Remove duplicate objects
+            if hasattr(pdf_writer, 'remove_duplicates'):
+                pdf_writer.remove_duplicates()
+
+            # Write compressed PDF
+            output = BytesIO()
+            pdf_writer.write(output)
+        compressed_bytes = output.getvalue()
+        compressed_size = len(compressed_bytes)
 
-        # Copy all pages
-        for page in pdf_reader.pages:
-            pdf_writer.add_page(page)
+        compression_ratio = ((original_size - compressed_size) / original_size * 100) if original_size > 0 else 0
 
-        # Compress based on quality setting
-        for page in pdf_writer.pages:
-            if quality == 'low':
-                page.compress_content_streams(level=9)
-            elif quality == 'medium':
-                page.compress_content_streams(level=6)
-            else:  # high
-                page.compress_content_streams(level=3)
+        logger.info(f'Compressed PDF: {original_size} -> {compressed_size} bytes ({compression_ratio:.1f}% reduction), '
+                    f'{images_recompressed} images recompressed')
+
+        return pdf_response(
+            compressed_bytes, filename, wants_binary(data),
+            page_count=len(pdf_writer.pages),
+            original_size=original_size,
+            compressed_size=compressed_size,
+            compression_ratio=round(compression_ratio, 2),
+            savings={
+                'images': images_saved,
+                'content_streams': content_saved,
+                'other': max(original_size - compressed_size - images_saved - content_saved, 0)
+            },
+            images_recompressed=images_recompressed,
+            images_skipped=images_skipped
+        )
 
-        # Remove duplicate objects
-        if hasattr(pdf_writer, 'remove_duplicates'):
-            pdf_writer.remove_duplicates()
+    except Exception as e:
+        logger.error(f'Error compressing PDF: {str(e)}', exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        # Write compressed PDF
-        output = BytesIO()
-        pdf_writer.write(output)
-        compressed_bytes = output.getvalue()
-        compressed_size = len(compressed_bytes)
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status of an async job"""
+    job = read_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': f'Unknown job_id: {job_id}'}), 404
 
-        compression_ratio = ((original_size - compressed_size) / original_size * 100) if original_size > 0 else 0
+    return jsonify(job_status_payload(job)), 200
 
-        compressed_base64 = base64.b64encode(compressed_bytes).decode('utf-8')
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """
+    Result of a finished async job
 
-        logger.info(f'Compressed PDF: {original_size} -> {compressed_size} bytes ({compression_ratio:.1f}% reduction)')
+    Returns exactly the response the endpoint would have returned
+    synchronously (same status code, body and X- headers).
+    """
+    job = read_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': f'Unknown job_id: {job_id}'}), 404
 
+    if job['status'] not in ('succeeded', 'failed') or not os.path.exists(job_path(job_id, 'result')):
         return jsonify({
-            'success': True,
-            'pdf_base64': compressed_base64,
-            'original_size': original_size,
-            'compressed_size': compressed_size,
-            'compression_ratio': round(compression_ratio, 2),
-            'filename': filename
-        }), 200
+            'success': False,
+            'error': 'Job has not finished yet',
+            'status': job['status']
+        }), 409
 
-    except Exception as e:
-        logger.error(f'Error compressing PDF: {str(e)}', exc_info=True)
-        return jsonify({'success': False, 'error': str(e)}), 500
+    response = send_file(job_path(job_id, 'result'), mimetype=job.get('mimetype'), conditional=False, etag=False)
+    response.status_code = job.get('http_status') or 200
+    for key, value in (job.get('headers') or {}).items():
+        response.headers[key] = value
+    return response
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def delete_job(job_id):
+    """Remove an async job and its stored result"""
+    if read_job(job_id) is None:
+        return jsonify({'success': False, 'error': f'Unknown job_id: {job_id}'}), 404
+
+    shutil.rmtree(job_path(job_id), ignore_errors=True)
+    return jsonify({'success': True, 'job_id': job_id}), 200
 
 @app.route('/', methods=['GET'])
 def index():
@@ -1085,18 +5480,35 @@ def index():
         'version': '3.0.0',
         'endpoints': {
             'health': 'GET /health - Health check',
+            'ready': 'GET /ready - Readiness probe, 503 until the startup warm-up has finished',
+            'metrics': 'GET /metrics - Prometheus metrics (latency, sizes, pages, stage timings)',
             'test': 'GET /test - Test library compatibility',
             'test_pdf': 'GET /test-pdf-generation - Test PDF generation',
+            'cache_stats': 'GET /cache/stats - Template and CSS cache hit/miss counters',
             'info': 'GET / - Service information',
             'zugferd': {
                 'generate_pdf': 'POST /generate-pdf - Generate PDF from HTML',
-                'image_to_pdf': 'POST /image-to-pdf - Convert image to PDF (supports HEIC, PNG, JPEG, etc.)',
+                'image_to_pdf': 'POST /image-to-pdf - Convert images to one PDF (supports HEIC, multi-page TIFF, PNG, JPEG, etc.)',
                 'generate_zugferd': 'POST /generate - Add ZUGFeRD XML to existing PDF',
-                'generate_complete': 'POST /generate-complete - Generate PDF + ZUGFeRD in one step'
+                'generate_complete': 'POST /generate-complete - Generate PDF + ZUGFeRD in one step',
+                'generate_complete_batch': 'POST /generate-complete/batch - Generate many ZUGFeRD invoices in parallel (NDJSON or ZIP)',
+                'validate': 'POST /zugferd/validate - Validate ZUGFeRD XML (XSD and Schematron)',
+                'extract': 'POST /zugferd/extract - Read the ZUGFeRD XML of a received invoice as JSON',
+                'extract_batch': 'POST /zugferd/extract/batch - Extract many invoices in parallel (NDJSON)'
+            },
+            'jobs': {
+                'status': 'GET /jobs/<job_id> - Async job status',
+                'result': 'GET /jobs/<job_id>/result - Async job result',
+                'delete': 'DELETE /jobs/<job_id> - Remove an async job'
+            },
+            'templates': {
+                'register': 'POST /templates - Register an HTML/CSS template',
+                'get': 'GET /templates/<template_id> - Check a registered template',
+                'delete': 'DELETE /templates/<template_id> - Remove a registered template'
             },
             'pdf_manipulation': {
-                'merge': 'POST /pdf/merge - Merge multiple PDFs',
-                'split': 'POST /pdf/split - Split PDF by pages or ranges',
+                'merge': 'POST /pdf/merge - Merge multiple PDFs (with optional page selections)',
+                'split': 'POST /pdf/split - Split PDF by pages, ranges, every N pages, bookmarks or size',
                 'compress': 'POST /pdf/compress - Compress PDF to reduce size'
             },
             'pdf_extraction': {
@@ -1104,7 +5516,8 @@ def index():
                 'metadata': 'POST /pdf/metadata - Get PDF metadata and info'
             },
             'pdf_enhancement': {
-                'watermark': 'POST /pdf/watermark - Add watermark to PDF'
+                'watermark': 'POST /pdf/watermark - Add watermark to PDF',
+                'stamp': 'POST /pdf/stamp - Add page numbers, text and image stamps'
             }
         },
         'features': [
@@ -1115,63 +5528,56 @@ def index():
             'Watermarking and stamps',
             'PDF compression',
             'Metadata extraction',
-            'Accepts both JSON and form data'
+            'Accepts both JSON and form data',
+            'Binary PDF responses via Accept: application/pdf or response=binary',
+            'Async job mode with polling or webhook callback (async=true)',
+            'Optional XSD/Schematron validation of ZUGFeRD XML (validate=true)',
+            'ZUGFeRD extraction from received invoices (raw XML + normalized JSON)'
         ]
     }), 200
 
 @app.route('/merge-pdf', methods=['POST'])
+@async_job
 def merge_pdf():
     """
     Merge multiple PDFs into a single PDF
 
-    Accepts both JSON and form data.
+    Accepts both JSON and form data. Takes the same inputs as /pdf/merge
+    (see merge_inputs), each input can select pages.
 
     Expected body:
     {
         "pdf_files": [
-            {"pdf_base64": "base64 data", "name": "optional name"},
+            {"pdf_base64": "base64 data", "name": "optional name", "pages": [1, [3, 5]] (optional)},
             {"pdf_base64": "base64 data", "name": "optional name"}
         ],
         "filename": "merged.pdf" (optional)
     }
 
     OR send as form data with pdf_1_base64, pdf_2_base64, etc.
+    (pdf_1_name, pdf_1_pages, ... optional)
+
+    OR send multipart/form-data with pdf_1, pdf_2, ... file parts
+    (or repeated pdf_files parts).
     """
     try:
         logger.info('=== merge_pdf called ===')
 
         # Accept both JSON and form data
         if request.is_json:
-            data = request.get_json()
+            data = request.get_json() or {}
         else:
-            data = request.form.to_dict()
+            data = get_form_data()
 
-        if not data:
+        if not data and not request.files:
             return jsonify({'success': False, 'error': 'Request body required'}), 400
 
         filename = data.get('filename', 'merged.pdf')
 
-        # Collect PDF base64 data
-        pdf_list = []
-
-        # Option 1: JSON with pdf_files array
-        if 'pdf_files' in data and isinstance(data['pdf_files'], list):
-            for pdf_item in data['pdf_files']:
-                if isinstance(pdf_item, dict) and 'pdf_base64' in pdf_item:
-                    pdf_list.append({
-                        'data': pdf_item['pdf_base64'],
-                        'name': pdf_item.get('name', f'PDF {len(pdf_list) + 1}')
-                    })
-
-        # Option 2: Form data with pdf_1_base64, pdf_2_base64, etc.
-        else:
-            i = 1
-            while f'pdf_{i}_base64' in data:
-                pdf_list.append({
-                    'data': data[f'pdf_{i}_base64'],
-                    'name': data.get(f'pdf_{i}_name', f'PDF {i}')
-                })
-                i += 1
+        try:
+            pdf_list = merge_inputs(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
 
         if len(pdf_list) == 0:
             return jsonify({
@@ -1179,8 +5585,13 @@ def merge_pdf():
                 'error': 'No PDF files provided. Use pdf_files array or pdf_1_base64, pdf_2_base64, etc.'
             }), 400
 
-        if len(pdf_list) == 1:
+        if len(pdf_list) == 1 and not pdf_list[0]['pages']:
             logger.warning('Only one PDF provided, returning it unchanged')
+            if wants_binary(data) or not isinstance(pdf_list[0]['data'], str):
+                return pdf_response(
+                    as_pdf_stream(pdf_list[0]['data']).read(), filename, wants_binary(data),
+                    pages_merged=1
+                )
             return jsonify({
                 'success': True,
                 'pdf_base64': pdf_list[0]['data'],
@@ -1191,57 +5602,124 @@ def merge_pdf():
 
         logger.info(f'Merging {len(pdf_list)} PDFs')
 
-        # Import pypdf for merging
-        from pypdf import PdfReader, PdfWriter
-        from io import BytesIO
+        try:
+            merged, total_pages, bytes_saved = merge_documents(pdf_list)
+        except ValueError as e:
+            logger.error(str(e))
+            return jsonify({'success': False, 'error': str(e)}), 400
 
-        pdf_writer = PdfWriter()
-        total_pages = 0
+        logger.info(f'Successfully merged {len(pdf_list)} PDFs into {total_pages} pages ({stream_size(merged)} bytes)')
 
-        # Merge all PDFs
-        for idx, pdf_item in enumerate(pdf_list):
-            try:
-                # Decode base64
-                pdf_bytes = base64.b64decode(pdf_item['data'])
-                pdf_reader = PdfReader(BytesIO(pdf_bytes))
+        return pdf_file_response(
+            merged, filename, wants_binary(data),
+            pdfs_merged=len(pdf_list),
+            total_pages=total_pages,
+            bytes_saved=bytes_saved
+        )
 
-                # Add all pages from this PDF
-                page_count = len(pdf_reader.pages)
-                for page in pdf_reader.pages:
-                    pdf_writer.add_page(page)
+    except Exception as e:
+        logger.error(f'Error merging PDFs: {str(e)}', exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-                total_pages += page_count
-                logger.info(f'Added {page_count} pages from {pdf_item["name"]}')
+warmup_state = {'finished': False, 'skipped': not WARMUP, 'enabled': WARMUP, 'duration_ms': None, 'steps': {}, 'errors': {}}
 
-            except Exception as e:
-                logger.error(f'Error processing PDF {idx + 1} ({pdf_item["name"]}): {str(e)}')
-                return jsonify({
-                    'success': False,
-                    'error': f'Failed to process PDF {idx + 1} ({pdf_item["name"]}): {str(e)}'
-                }), 400
+WARMUP_HTML = '''<html><head><style>
+body { font-family: sans-serif; } h1 { font-weight: bold; } td { border: 1px solid #000; }
+</style></head><body><h1>Rechnung</h1><table><tr><td>Menge</td><td>1,00 €</td></tr></table></body></html>'''
 
-        # Write merged PDF to bytes
-        output = BytesIO()
-        pdf_writer.write(output)
-        merged_pdf_bytes = output.getvalue()
 
-        # Encode to base64
-        merged_base64 = base64.b64encode(merged_pdf_bytes).decode('utf-8')
+def warm_up_imports():
+    """Import every heavy dependency the request handlers import locally"""
+    import pdfplumber  # noqa: F401
+    import pypdf.generic  # noqa: F401
+    import reportlab.lib.pagesizes  # noqa: F401
+    import reportlab.pdfbase.pdfutils  # noqa: F401
+    from lxml import etree, isoschematron  # noqa: F401
+    from pypdf import PdfReader, PdfWriter  # noqa: F401
+    from PIL import Image, ImageOps  # noqa: F401
+    from reportlab.pdfgen import canvas  # noqa: F401
 
-        logger.info(f'Successfully merged {len(pdf_list)} PDFs into {total_pages} pages ({len(merged_pdf_bytes)} bytes)')
+    # Load every Pillow format plugin instead of on the first unknown format
+    Image.init()
 
-        return jsonify({
-            'success': True,
-            'pdf_base64': merged_base64,
-            'pdf_size': len(merged_pdf_bytes),
-            'filename': filename,
-            'pdfs_merged': len(pdf_list),
-            'total_pages': total_pages
-        }), 200
 
-    except Exception as e:
-        logger.error(f'Error merging PDFs: {str(e)}', exc_info=True)
-        return jsonify({'success': False, 'error': str(e)}), 500
+def warm_up_canvas():
+    """Draw text and a JPEG with reportlab, then read the result back with pypdf and pdfplumber"""
+    import pdfplumber
+    from pypdf import PdfReader
+    from PIL import Image
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+    from reportlab.pdfgen import canvas
+
+    image_buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), (255, 255, 255)).save(image_buffer, format='JPEG')
+    image_buffer.seek(0)
+
+    packet = io.BytesIO()
+    pdf_canvas = canvas.Canvas(packet)
+    pdf_canvas.setFont('Helvetica-Bold', 12)
+    pdf_canvas.drawString(72, 720, 'Rechnung')
+    stringWidth('Rechnung', 'Helvetica', 12)
+    pdf_canvas.drawImage(ImageReader(image_buffer), 72, 600, width=16, height=16)
+    pdf_canvas.save()
+
+    packet.seek(0)
+    len(PdfReader(packet).pages)
+    packet.seek(0)
+    with pdfplumber.open(packet) as pdf:
+        pdf.pages[0].extract_text()
+
+
+def warm_up_weasyprint():
+    """Render a small document so fontconfig, Pango and the shared font configuration are loaded"""
+    # Not through render_pdf, the warm-up render is no request stage
+    with render_lock:
+        HTML(string=WARMUP_HTML).write_pdf(font_config=font_config)
+
+
+def warm_up_validation():
+    """Compile the configured XSD and Schematron"""
+    get_xml_schema()
+    get_schematron()
+
+
+def warm_up():
+    """
+    Run the startup warm-up, filling warmup_state for /ready
+
+    A failing step is logged and recorded but does not stop the others:
+    the endpoint that needs it pays the cost on its first request instead.
+    """
+    started = time.time()
+    for name, step in (
+        ('imports', warm_up_imports),
+        ('heif', register_heif),
+        ('canvas', warm_up_canvas),
+        ('weasyprint', warm_up_weasyprint),
+        ('validation', warm_up_validation)
+    ):
+        step_started = time.time()
+        try:
+            step()
+        except Exception as e:
+            logger.warning(f'Warm-up step {name} failed: {str(e)}')
+            warmup_state['errors'][name] = str(e)
+        warmup_state['steps'][name] = round((time.time() - step_started) * 1000, 1)
+
+    warmup_state['duration_ms'] = round((time.time() - started) * 1000, 1)
+    warmup_state['finished'] = True
+    logger.info(f'Warm-up finished in {warmup_state["duration_ms"]} ms')
+
+
+# Spawned pool processes import app.py too; they only need what their
+# task imports, not a render and the validation schemas. parent_process()
+# is not set yet while a spawned child imports its main module, the
+# process name is (gunicorn's forked workers keep "MainProcess"). Pool
+# processes serve no requests, their warmup_state is never reported.
+if WARMUP and multiprocessing.current_process().name == 'MainProcess':
+    warm_up()
+
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,20 @@
+# Read by gunicorn from the working directory, next to the command line
+# options in the Dockerfile.
+import os
+import shutil
+import tempfile
+
+# Every worker (and its pool processes) writes its Prometheus metrics to
+# files in this directory, /metrics sums them up. Set before app.py is
+# imported, emptied on every start so counters begin at zero.
+_metrics_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'zugferd-metrics'))
+shutil.rmtree(_metrics_dir, ignore_errors=True)
+os.makedirs(_metrics_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Drop the in-progress gauge of a worker that exited or was killed"""
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
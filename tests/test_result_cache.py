@@ -0,0 +1,74 @@
+import io
+import os
+
+os.environ.setdefault('WARMUP', 'false')
+
+import pytest
+from reportlab.pdfgen import canvas
+
+import app as service
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(service, 'RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+    monkeypatch.setattr(service, 'result_cache', service.ResultCache(str(tmp_path), 64 * 1024 * 1024))
+    return service.app.test_client()
+
+
+def sample_pdf():
+    buffer = io.BytesIO()
+    pdf_canvas = canvas.Canvas(buffer)
+    pdf_canvas.drawString(72, 720, 'Rechnung 2024-001')
+    pdf_canvas.showPage()
+    pdf_canvas.save()
+    return buffer.getvalue()
+
+
+def extract(client, pdf):
+    response = client.post('/pdf/extract-text?output=ndjson', data=pdf, content_type='application/pdf')
+    body = response.get_data(as_text=True)
+    response.close()
+    return response, body
+
+
+def test_streamed_error_is_not_cached(client, monkeypatch):
+    pdf = sample_pdf()
+    extract_text_pages = service.extract_text_pages
+
+    def failing(*args, **kwargs):
+        raise RuntimeError('transient failure')
+
+    monkeypatch.setattr(service, 'extract_text_pages', failing)
+    response, body = extract(client, pdf)
+    assert response.status_code == 200
+    assert response.headers['X-Cache'] == 'MISS'
+    assert '"success": false' in body
+
+    monkeypatch.setattr(service, 'extract_text_pages', extract_text_pages)
+    response, body = extract(client, pdf)
+    assert response.headers['X-Cache'] == 'MISS'
+    assert 'Rechnung 2024-001' in body
+
+    response, _ = extract(client, pdf)
+    assert response.headers['X-Cache'] == 'HIT'
+
+
+def test_template_deleted_elsewhere_is_not_served(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(service, 'TEMPLATE_DIR', str(tmp_path / 'templates'))
+    monkeypatch.setattr(service, 'template_cache', service.LRUCache(8))
+    template_id = client.post('/templates', json={'html_content': '<p>{{ number }}</p>'}).get_json()['template_id']
+    request_body = {'template_id': template_id, 'data': {'number': '2024-001'}}
+
+    def generate():
+        response = client.post('/generate-pdf', json=request_body)
+        response.get_data()
+        response.close()
+        return response
+
+    assert generate().headers['X-Cache'] == 'MISS'
+    assert generate().headers['X-Cache'] == 'HIT'
+
+    # Another worker deletes the template: this worker's caches still hold it
+    os.remove(service.template_path(template_id))
+    assert generate().status_code == 404